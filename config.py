@@ -11,14 +11,48 @@ SILENCE_THRESHOLD = 1.0 # seconds of silence to stop recording
 VOICE_PROBABILITY = 0.35 # probability threshold of what is considered silence
 VOICE_THRESHOLD = 0.25 # Determines how much TOTAL speech (not continuous) is required for a valid command
 AUDIO_BUFFER_DURATION = 5.0 # seconds of audio to buffer during speach transcribing
+CAPTURE_HISTORY_DURATION = 10.0 # seconds of microphone audio kept readable for consumers that fall behind the capture thread
+WAKE_WORD_PREROLL_DURATION = 0.3 # seconds before the wake word detection prepended to the command, see scripts/measure_preroll.py
+VAD_CHOICE = "cobra" # ["cobra", "silero", "energy"], compare them with scripts/bench_vad.py
+SILERO_VAD_MODEL = "silero_vad.onnx" # Silero VAD v5 onnx file (github.com/snakers4/silero-vad, src/silero_vad/data/silero_vad.onnx)
+VAD_ENERGY_THRESHOLD = 500 # "energy" VAD: RMS of an int16 frame above which it can count as speech
+VAD_ENERGY_MARGIN = 3.0 # "energy" VAD: speech must also be this many times louder than the background noise
+VAD_ZCR_MAX = 0.35 # "energy" VAD: frames crossing zero more often than this (per sample) are treated as noise
+ENDPOINT_ADAPTIVE = True # adapt the end of speech wait to the command instead of always waiting SILENCE_THRESHOLD, see scripts/bench_endpointing.py
+ENDPOINT_MIN_SILENCE = 0.75 # shortest wait once the command sounds finished
+ENDPOINT_MAX_SILENCE = 1.5 # longest wait, used for hesitations and unfinished sentences
+ENDPOINT_PAUSE_FACTOR = 1.3 # wait at least this multiple of the longest pause the speaker already made in the command
+ENDPOINT_SHORT_UTTERANCE = 0.6 # seconds of speech below which the fixed SILENCE_THRESHOLD wait applies
+ENDPOINT_HESITATION_PROBABILITY = 0.15 # mean VAD probability during a pause above which it is a breath or "umm", not the end
+
+# Speech-To-Text Parameters
+STT_SPEECH_PAD = 0.2 # seconds kept around each span the recorder's VAD marked as speech, only those spans reach Whisper
+STT_STREAMING = False # transcribe while the command is still being spoken, only the last few words are left to decode at the end. Partial decodes are greedy, compare word errors with scripts/bench_stt_rtf.py --decode streaming before turning it on
+STT_STREAMING_STEP = 1.0 # seconds of new speech between partial decodes, raise it if the device can not keep up
+STT_STREAMING_TRIM = 2.0 # seconds of committed audio after which the decode window is moved past it
+STT_MODEL_SIZE = "auto" # faster-whisper model name, 'auto' = 'turbo' on cuda and STT_CPU_MODEL_SIZE on cpu
+STT_CPU_MODEL_SIZE = "small.en" # model 'auto' picks on cpu, 'base.en' for small nodes, see scripts/bench_stt_rtf.py
+STT_COMPUTE_TYPE = "auto" # 'auto' = 'int8_float16' on cuda and 'int8' on cpu (int8_float16 needs a GPU)
+STT_CPU_THREADS = 0 # threads per Whisper model on cpu, 0 = the available cores split between the models loaded
+STT_BEAM_SIZE = 5 # beam width of the beam search decode
+STT_GREEDY_FIRST = "auto" # decode greedily and only re-decode with beam search on low confidence, 'auto' = on for cpu
+STT_LOW_CONFIDENCE_LOGPROB = -0.5 # a segment below this average log probability counts as low confidence
 
 # Natural Conversation Parameters
 WAKEWORD_RESET_TIME = 45 # No wakeword needed unless no follow up command in WAKEWORD_RESET_TIME seconds. 0 = disable natural conversation
 CONTINUATION_THRESHOLD = 3.0 # Number of seconds in which another command is considered an extention to previous command. Only matters then WAKEWORD_RESET_TIME > 0
+CONTINUATION_REUSE = True # continuations reuse the previous command's classifier decision, RAG context and web search when the topic is unchanged
+CONTINUATION_MAX_NEW_WORDS = 0 # content words a continuation may add that the previous command and topic do not contain, more means the topic may have changed
 
 
 # LLM Parameters
 MAX_TOKENS = 7000 # depends on the model, enter lower value than max recomended 
+LLM_REPLY_TOKENS = 1750 # part of MAX_TOKENS kept free for the reply, the prompt gets the rest
+LLM_TOKENIZER = "Qwen/Qwen3-4B-Instruct-2507" # Hugging Face repo or tokenizer.json matching LLM_MODEL, used to count prompt tokens. "" = estimate
+CHAT_HISTORY_FILE = "data/chat_history.jsonl" # relative to project root, append-only conversation log (an old data/chat_history.json is migrated once)
+CHAT_HISTORY_MAX_MESSAGES = 5000 # messages kept in CHAT_HISTORY_FILE, beyond this the oldest half moves to data/chat_history.archive.jsonl
+CHAT_HISTORY_INDEX_STRIDE = 64 # one index entry per this many messages
+PROMPT_TRIM_BLOCK = 8 # oldest history messages dropped at once when the prompt outgrows MAX_TOKENS, fewer trims keep the LLM server's prefix cache valid longer
 LLM_MODEL = "huihui-qwen3-4b-instruct-2507-abliterated"
 ENABLE_THINK = True # Prevents model from reasoning, only works with Qwen3 models
 TEMPERATURE = 0.7 # only modify if you know what you are doing
@@ -67,4 +101,39 @@ KOKORO_TTS_VOICE = "bm_daniel" # ["af_heart", "af_bella", "af_nicole", "am_fenri
 KOKORO_TTS_LANG = "b" # "a" for american, "b" for british (must match voice)
 
 ## Websearch Parameters
-RAG_CONFIDENCE_THRESHOLD = 0.25
\ No newline at end of file
+RAG_CONFIDENCE_THRESHOLD = 0.25
+
+## Intent Classifier Parameters
+INTENT_CLASSIFIER = True # decide web search / memory locally from labelled exemplars, the LLM classifier is only asked when unsure
+INTENT_EXEMPLARS = "data/intent_exemplars.json" # relative to project root, labelled example commands
+INTENT_TOP_K = 5 # nearest exemplars that vote
+INTENT_MIN_SIMILARITY = 0.45 # cosine similarity the nearest exemplar needs, below it the command is unlike anything labelled
+INTENT_MIN_CONFIDENCE = 0.6 # how one sided the weighted vote must be, 1 = unanimous
+
+## Pipeline Parameters
+TURN_DEADLINE = 120 # seconds a turn may spend classifying, searching and generating its reply before it is abandoned
+SPEECH_BACKLOG_TURNS = 1 # finished turns the speech worker may still be playing when a new one starts, beyond this the new turn waits for it
+SPECULATIVE_REPLY = True # start the reply from the command's RAG context while the LLM classifier decides, it is dropped if a web search is needed
+
+## Server Parameters (server.py)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_MAX_SESSIONS = 16 # connections beyond this are refused
+SERVER_STT_WORKERS = 2 # Whisper processes shared by all sessions
+SERVER_TTS_WORKERS = 2 # TTS processes shared by all sessions
+SERVER_WEB_WORKERS = 1 # web search processes (one browser each)
+SERVER_VAD_CHOICE = "energy" # VAD used for every session, one instance per session (see VAD_CHOICE)
+
+## STT Service Parameters (stt_service.py)
+STT_SERVICE_ADDRESS = "" # "host:port" of a shared stt_service.py for the voice worker to use instead of loading its own Whisper, "" = load it in process
+STT_SERVICE_PORT = 8766 # port stt_service.py listens on
+STT_SERVICE_WORKERS = 1 # Whisper processes in stt_service.py, each holds one copy of the model
+STT_SERVICE_KEY_FILE = "data/stt_service.key" # relative to project root, random key a loopback service shares with local clients when STT_SERVICE_KEY is not set
+STT_SERVICE_HANDSHAKE_TIMEOUT = 5 # seconds stt_service.py waits for each reply of a connecting client's key handshake
+STT_BATCH_SIZE = 8 # most commands a Whisper worker decodes in one batch (stt_service.py and server.py)
+STT_BATCH_WINDOW = 0.03 # seconds a worker waits for more commands to batch with the first one
+STT_METRICS_INTERVAL = 60 # seconds between queue depth / wait time log lines of stt_service.py
+
+## Diagnostics Parameters
+LATENCY_TRACE = True # Records per-turn stage timings (monotonic clock) for latency analysis
+LATENCY_TRACE_FILE = "data/latency_trace.jsonl" # relative to project root, one JSON line per turn
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+Offline replay harness. Drives the full pipeline from recorded command wav files instead of the
+microphone, with a mock OpenAI server in place of LM Studio, html fixtures in place of the web and
+a null audio sink, then prints P50/P95 latency per stage from the turn traces.
+
+  python replay.py --commands data/replay/commands --web-fixtures data/replay/web
+
+Command files are played in name order with --gap seconds of silence after each one. The wake word
+is only required before the first command, pass it with --wake-word if the recordings do not
+start with it. Fixture files whose name appears in a command are treated as web search topics.
+Use a --gap shorter than the spoken reply to barge in, interrupted turns report interrupt-to-silence.
+Replayed turns are kept out of the chat history log and the memory store.
+"""
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import re
+import time
+import warnings
+warnings.filterwarnings("ignore")
+
+from src.streaming import replay_io
+from src.streaming.mock_openai_server import MockOpenAIServer
+from config import *
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Replay recorded commands through the pipeline and report stage latencies")
+  parser.add_argument("--commands", required=True, help="directory of 16 bit command wav files")
+  parser.add_argument("--web-fixtures", default=None, help="directory of html files used instead of live web search")
+  parser.add_argument("--wake-word", default=None, help="wav file with the wake word, played before the first command")
+  parser.add_argument("--gap", type=float, default=8, help="seconds of silence after each command")
+  parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between tokens from the mock LLM server")
+  parser.add_argument("--timeout", type=float, default=None, help="seconds to wait for all turns, defaults to replay length + 60s per command")
+  parser.add_argument("--report", default=None, help="write the summary as json to this file")
+  return parser.parse_args()
+
+
+def configure_environment(args):
+  os.environ[replay_io.REPLAY_DIR_ENV] = os.path.abspath(args.commands)
+  os.environ[replay_io.REPLAY_GAP_ENV] = str(args.gap)
+  os.environ[replay_io.AUDIO_SINK_ENV] = "null"
+  if args.wake_word:
+    os.environ[replay_io.REPLAY_WAKE_WORD_ENV] = os.path.abspath(args.wake_word)
+  if args.web_fixtures:
+    os.environ[replay_io.WEB_FIXTURES_ENV] = os.path.abspath(args.web_fixtures)
+
+
+def fixture_keywords(fixture_dir):
+  if not fixture_dir:
+    return []
+
+  keywords = []
+  for name in os.listdir(fixture_dir):
+    if name.lower().endswith((".html", ".htm")):
+      keywords.extend(word.lower() for word in re.findall(r"[a-zA-Z]+", os.path.splitext(name)[0]) if len(word) > 2)
+  return keywords
+
+
+def count_lines(path):
+  if not os.path.exists(path):
+    return 0
+  with open(path, "r", encoding="utf-8") as trace_file:
+    return sum(1 for line in trace_file if line.strip())
+
+
+def wait_for_turns(trace_path, start_lines, turns, workers, timeout, logger):
+  """Waits until the speech worker traced `turns` turns, returns False on timeout or when a worker exited."""
+  deadline = time.monotonic() + timeout
+  while count_lines(trace_path) - start_lines < turns:
+    if time.monotonic() > deadline:
+      logger.warning(f"Replay timed out after {timeout:.0f}s")
+      return False
+    if not all(worker.is_alive() for worker in workers):
+      logger.error("A pipeline worker exited during replay")
+      return False
+    time.sleep(0.5)
+  return True
+
+
+def print_summary(summary, turns, server):
+  print(f"\nReplayed {turns} turns, {server.completed_streams} completed and {server.cancelled_streams} cancelled LLM streams\n")
+  print(f"{'stage':<32}{'n':>5}{'p50 ms':>12}{'p95 ms':>12}")
+  for name, (count, p50, p95) in sorted(summary.items(), key=lambda item: item[1][1]):
+    print(f"{name:<32}{count:>5}{p50:>12.1f}{p95:>12.1f}")
+
+
+def main():
+  args = parse_args()
+  if not LATENCY_TRACE:
+    raise SystemExit("LATENCY_TRACE must be enabled in config.py to replay")
+
+  configure_environment(args)
+  command_files = replay_io.list_command_files(os.environ[replay_io.REPLAY_DIR_ENV])
+  if not command_files:
+    raise SystemExit(f"No wav files found in {args.commands}")
+
+  server = MockOpenAIServer(token_delay=args.token_delay, search_keywords=fixture_keywords(args.web_fixtures))
+  os.environ["OPENAI_API"] = server.start()
+  os.environ.setdefault("OPENAI_API_KEY", "replay")
+
+  # imported after the environment is set up so the worker processes inherit the replay settings
+  from src.streaming.logging_config import setup_logging, start_listener, stop_listener, get_log_queue
+  from src.streaming.latency_trace import LatencyTraceWriter, load_trace_records, summarize_traces
+  from src.streaming.s2s_pipeline import start_pipeline
+
+  os.makedirs("conversation", exist_ok=True)
+  start_listener()
+  logger = setup_logging()
+  log_queue = get_log_queue()
+
+  trace_path = LatencyTraceWriter().trace_path
+  trace_offset = os.path.getsize(trace_path) if os.path.exists(trace_path) else 0
+  start_lines = count_lines(trace_path)
+
+  replay_seconds = len(replay_io.build_replay_pcm()) / 16000
+  timeout = args.timeout if args.timeout is not None else replay_seconds + 60 * len(command_files)
+
+  workers, _ = start_pipeline(logger, log_queue)
+  try:
+    wait_for_turns(trace_path, start_lines, len(command_files), workers, timeout, logger)
+  finally:
+    for worker in workers:
+      worker.terminate()
+      worker.join()
+    server.stop()
+    stop_listener()
+
+  records = load_trace_records(trace_path, trace_offset)
+  summary = summarize_traces(records)
+  print_summary(summary, len(records), server)
+
+  if args.report:
+    with open(args.report, "w", encoding="utf-8") as report_file:
+      json.dump({
+        "turns": len(records),
+        "completed_streams": server.completed_streams,
+        "cancelled_streams": server.cancelled_streams,
+        "stages": {name: {"count": count, "p50_ms": p50, "p95_ms": p95} for name, (count, p50, p95) in summary.items()},
+      }, report_file, indent=2)
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
@@ -0,0 +1,163 @@
+"""
+Measures the per-frame cost of the capture path's buffering: the always-on pre-roll buffer and the
+command recorder. Compares the old list-of-frames ring and struct.pack/wave BytesIO recorder with the
+int16 PcmRingBuffer and PcmAccumulator, and reports how much memory each pre-roll buffer keeps alive.
+
+Frames are new Python lists of 512 samples, like PvRecorder.read() returns, and every path converts them to
+int16 for the VAD as the capture loops do. "handoff" is turning a full pre-roll buffer into the start of a
+command. From the project root:
+  python -m scripts.bench_audio_buffer --seconds 60
+"""
+import argparse
+import io
+import struct
+import time
+import tracemalloc
+import wave
+import numpy as np
+
+from src.streaming.pcm_buffer import PcmRingBuffer, PcmAccumulator
+
+SAMPLE_RATE = 16000
+FRAME_LENGTH = 512
+BUFFER_DURATION = 5.0
+
+
+class ListRing:
+  """AudioBuffer before the change, one Python list per frame."""
+
+  def __init__(self, buffer_size):
+    self.buffer_size = buffer_size
+    self.pcm_buffer = [None] * buffer_size
+    self.pos = 0
+    self.full = False
+
+  def append(self, frame):
+    self.pcm_buffer[self.pos] = frame
+    self.pos = (self.pos + 1) % self.buffer_size
+    if self.pos == 0:
+      self.full = True
+
+  def get_buffer(self):
+    if self.full:
+      return self.pcm_buffer[self.pos:] + self.pcm_buffer[:self.pos]
+    return self.pcm_buffer[:self.pos]
+
+
+def read_frames(source):
+  """Yields a fresh list per frame, the allocation PvRecorder.read() does."""
+  for frame in source:
+    yield frame.tolist()
+
+
+def hand_to_vad(pcm):
+  """Stands in for the VAD reading the frame, every variant converts and hands it over like the recorder."""
+  return int(pcm[-1])
+
+
+def old_buffer(source, buffer_size):
+  ring = ListRing(buffer_size)
+  for frame in read_frames(source):
+    hand_to_vad(np.array(frame, dtype=np.int16))
+    ring.append(frame)
+  return ring
+
+
+def new_buffer(source, buffer_size):
+  ring = PcmRingBuffer(buffer_size * FRAME_LENGTH)
+  for frame in read_frames(source):
+    pcm = np.array(frame, dtype=np.int16)
+    hand_to_vad(pcm)
+    ring.append(pcm)
+  return ring
+
+
+def new_wav_recording():
+  wav_buffer = io.BytesIO()
+  wav_file = wave.open(wav_buffer, "wb")
+  wav_file.setparams((1, 2, SAMPLE_RATE, FRAME_LENGTH, "NONE", "NONE"))
+  return wav_file
+
+
+def old_record(source, buffer_size):
+  wav_file = new_wav_recording()
+  for frame in read_frames(source):
+    hand_to_vad(np.array(frame, dtype=np.int16))
+    wav_file.writeframes(struct.pack("h" * len(frame), *frame))
+  wav_file.close()
+
+
+def new_record(source, buffer_size):
+  command_pcm = PcmAccumulator(int(2 * BUFFER_DURATION * SAMPLE_RATE))
+  for frame in read_frames(source):
+    pcm = np.array(frame, dtype=np.int16)
+    hand_to_vad(pcm)
+    command_pcm.append(pcm)
+  return command_pcm.view()
+
+
+def old_handoff(ring):
+  wav_file = new_wav_recording()
+  for frame in ring.get_buffer():
+    wav_file.writeframes(struct.pack("h" * len(frame), *frame))
+  wav_file.close()
+
+
+def new_handoff(ring):
+  command_pcm = PcmAccumulator(int(2 * BUFFER_DURATION * SAMPLE_RATE))
+  command_pcm.append(ring.view())
+
+
+def measure(target, args, repeats, frame_count):
+  """Returns the best time per frame in microseconds."""
+  best = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    target(*args)
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best / frame_count * 1e6
+
+
+def retained_kb(target, args):
+  """Memory still allocated by the buffer target returns, i.e. what the capture loop keeps alive."""
+  tracemalloc.start()
+  try:
+    result = target(*args)
+    retained, _ = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  del result
+  return retained / 1024
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Compare per-frame buffering cost of the capture path")
+  parser.add_argument("--seconds", type=float, default=60, help="seconds of audio pushed through each buffer")
+  parser.add_argument("--repeats", type=int, default=5)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  frame_count = int(args.seconds * SAMPLE_RATE / FRAME_LENGTH)
+  source = rng.integers(-3000, 3000, (frame_count, FRAME_LENGTH), dtype=np.int16)
+  buffer_size = int(BUFFER_DURATION / (FRAME_LENGTH / SAMPLE_RATE))
+  old_ring = old_buffer(source[:buffer_size], buffer_size)
+  new_ring = new_buffer(source[:buffer_size], buffer_size)
+
+  print(f"{frame_count} frames of {FRAME_LENGTH} samples, best of {args.repeats}")
+  print(f"{'path':<24}{'us/frame':>10}{'kept KB':>10}")
+  for name, target, target_args, frames in [
+    ("buffer (list ring)", old_buffer, (source, buffer_size), frame_count),
+    ("buffer (numpy ring)", new_buffer, (source, buffer_size), frame_count),
+    ("record (wave bytesio)", old_record, (source, buffer_size), frame_count),
+    ("record (accumulator)", new_record, (source, buffer_size), frame_count),
+    ("handoff (list ring)", old_handoff, (old_ring,), buffer_size),
+    ("handoff (numpy ring)", new_handoff, (new_ring,), buffer_size),
+  ]:
+    per_frame_us = measure(target, target_args, args.repeats, frames)
+    kept = f"{retained_kb(target, target_args):.0f}" if target in (old_buffer, new_buffer) else "-"
+    print(f"{name:<24}{per_frame_us:>10.2f}{kept:>10}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,60 @@
+"""
+Compares the fixed SILENCE_THRESHOLD endpoint with the adaptive Endpointer (src/streaming/endpointer.py) on
+labelled recordings, using the same wav + <name>.json layout as scripts/bench_vad.py. Record commands with
+natural mid-sentence pauses, the labels should cover every stretch of speech so the pauses show up as gaps.
+
+  latency  endpoint time - labelled end of speech, over commands that were not cut off
+  cut off  endpoint fired before the labelled end of speech, the rest of the command would be lost
+  missed   no endpoint at all
+
+From the project root:
+  python -m scripts.bench_endpointing --audio data/endpointing --vad silero
+"""
+from dotenv import load_dotenv
+import argparse
+
+from config import *
+from src.streaming.latency_trace import percentile
+from src.streaming.vad import create_vad
+from scripts.bench_vad import load_labelled_recordings, vad_probabilities, endpoint
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark fixed vs adaptive endpointing on labelled recordings")
+  parser.add_argument("--audio", required=True, help="directory of command wav files with <name>.json speech labels")
+  parser.add_argument("--vad", default=VAD_CHOICE, help="VAD backend the endpointers run on")
+  args = parser.parse_args()
+
+  recordings = load_labelled_recordings(args.audio)
+  vad = create_vad(args.vad)
+  frame_duration = vad.frame_length / vad.sample_rate
+  trailing_silence = max(SILENCE_THRESHOLD, ENDPOINT_MAX_SILENCE) + 0.5
+  runs = [(vad_probabilities(vad, pcm, trailing_silence)[0], labels) for pcm, labels in recordings]
+  vad.delete()
+
+  print(f"{len(runs)} labelled commands, {args.vad} VAD")
+  print(f"{'endpointer':<12}{'p50 ms':>9}{'p95 ms':>9}{'cut off':>9}{'missed':>8}")
+  for name, adaptive in [("fixed", False), ("adaptive", True)]:
+    latencies = []
+    cut_off = 0
+    missed = 0
+    for probabilities, labels in runs:
+      result = endpoint(probabilities, frame_duration, adaptive=adaptive)
+      if result is None:
+        missed += 1
+        continue
+
+      labelled_end = max(end for _, end in labels)
+      if result[1] < labelled_end:
+        cut_off += 1
+      else:
+        latencies.append((result[1] - labelled_end) * 1000)
+
+    p50 = percentile(latencies, 50)
+    p95 = percentile(latencies, 95)
+    print(f"{name:<12}{(p50 or 0):>9.0f}{(p95 or 0):>9.0f}{cut_off:>9}{missed:>8}")
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
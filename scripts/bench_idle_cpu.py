@@ -0,0 +1,120 @@
+"""
+Measures the CPU the pipeline's worker processes use while the assistant is idle.
+
+Drives the real pipeline with the replay harness (see replay.py): the recorded commands go through the voice
+worker, the command and speech queues and the mock LLM server like live turns. Once every turn is traced the
+workers are left listening to silence, and the CPU time of each worker process and its children (e.g. the
+web search browser) is sampled from /proc, so Linux only. From the project root:
+  python -m scripts.bench_idle_cpu --commands data/replay/commands --web-fixtures data/replay/web --seconds 30
+
+The voice worker keeps running wake word detection on the silent input, the pipeline and speech workers block
+on their queues and should stay close to 0%.
+"""
+from dotenv import load_dotenv
+import argparse
+import os
+import time
+import warnings
+warnings.filterwarnings("ignore")
+
+from src.streaming import replay_io
+from src.streaming.mock_openai_server import MockOpenAIServer
+from config import *
+from replay import configure_environment, count_lines, fixture_keywords, wait_for_turns
+
+# in the order start_pipeline returns the workers
+WORKER_NAMES = ["voice (wake_word_stt_worker)", "pipeline (websearch_llm_worker)", "speech (speech_worker)"]
+
+
+def process_tree_cpu_seconds(pid):
+  """User + system CPU seconds of pid and its descendants, children that already exited are not counted."""
+  parents = {}
+  cpu_ticks = {}
+  for name in os.listdir("/proc"):
+    if not name.isdigit():
+      continue
+    try:
+      with open(f"/proc/{name}/stat") as stat_file:
+        # the command name may contain spaces, the fields after it are fixed
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    except OSError:
+      continue
+    parents[int(name)] = int(fields[1])
+    cpu_ticks[int(name)] = int(fields[11]) + int(fields[12])
+
+  tree = {pid}
+  added = True
+  while added:
+    children = {child for child, parent in parents.items() if parent in tree} - tree
+    tree |= children
+    added = bool(children)
+
+  return sum(cpu_ticks.get(member, 0) for member in tree) / os.sysconf("SC_CLK_TCK")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure the pipeline workers' CPU use while idle, after replaying commands")
+  parser.add_argument("--commands", required=True, help="directory of 16 bit command wav files")
+  parser.add_argument("--web-fixtures", default=None, help="directory of html files used instead of live web search")
+  parser.add_argument("--wake-word", default=None, help="wav file with the wake word, played before the first command")
+  parser.add_argument("--gap", type=float, default=8, help="seconds of silence after each command")
+  parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between tokens from the mock LLM server")
+  parser.add_argument("--settle", type=float, default=5, help="seconds to wait after the last turn before measuring")
+  parser.add_argument("--seconds", type=float, default=30, help="idle time measured")
+  args = parser.parse_args()
+
+  if not os.path.exists("/proc/self/stat"):
+    raise SystemExit("Reads process CPU times from /proc, run it on Linux")
+  if not LATENCY_TRACE:
+    raise SystemExit("LATENCY_TRACE must be enabled in config.py to know when the replayed turns are done")
+
+  configure_environment(args)
+  command_files = replay_io.list_command_files(os.environ[replay_io.REPLAY_DIR_ENV])
+  if not command_files:
+    raise SystemExit(f"No wav files found in {args.commands}")
+
+  server = MockOpenAIServer(token_delay=args.token_delay, search_keywords=fixture_keywords(args.web_fixtures))
+  os.environ["OPENAI_API"] = server.start()
+  os.environ.setdefault("OPENAI_API_KEY", "replay")
+
+  # imported after the environment is set up so the worker processes inherit the replay settings
+  from src.streaming.logging_config import setup_logging, start_listener, stop_listener, get_log_queue
+  from src.streaming.latency_trace import LatencyTraceWriter
+  from src.streaming.s2s_pipeline import start_pipeline
+
+  os.makedirs("conversation", exist_ok=True)
+  start_listener()
+  logger = setup_logging()
+  log_queue = get_log_queue()
+
+  trace_path = LatencyTraceWriter().trace_path
+  start_lines = count_lines(trace_path)
+  timeout = len(replay_io.build_replay_pcm()) / 16000 + 60 * len(command_files)
+
+  workers, _ = start_pipeline(logger, log_queue)
+  try:
+    if not wait_for_turns(trace_path, start_lines, len(command_files), workers, timeout, logger):
+      raise SystemExit("The replayed turns did not finish, nothing measured")
+    time.sleep(args.settle)
+
+    start_cpu = [process_tree_cpu_seconds(worker.pid) for worker in workers]
+    start = time.monotonic()
+    time.sleep(args.seconds)
+    end_cpu = [process_tree_cpu_seconds(worker.pid) for worker in workers]
+    elapsed = time.monotonic() - start
+  finally:
+    for worker in workers:
+      worker.terminate()
+      worker.join()
+    server.stop()
+    stop_listener()
+
+  print(f"\nIdle CPU over {elapsed:.0f}s after {len(command_files)} replayed turns (percent of one core)")
+  for name, before, after in zip(WORKER_NAMES, start_cpu, end_cpu):
+    print(f"  {name:<34}{(after - before) / elapsed * 100:>7.2f}%")
+  print(f"  {'total':<34}{(sum(end_cpu) - sum(start_cpu)) / elapsed * 100:>7.2f}%")
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
@@ -0,0 +1,101 @@
+"""
+Compares the local intent classifier (src/streaming/intent_classifier.py) with the LLM classifier prompt
+(LLMWrapper.decide_websearch_memory) on a labelled set of commands, one JSON object per line:
+  {"text": "...", "websearch": "yes" | "no", "memory": true | false}
+
+  search acc   share of commands with the right web search decision
+  memory acc   share of commands with the right "something to remember" flag
+  local        share of commands the local classifier answered without the LLM
+  p50/p95 ms   classification latency per command
+
+"local vote" scores the nearest exemplar vote on every command, "local+llm" is what the pipeline does:
+the local answer when confident, the LLM otherwise. The LLM rows need LM Studio (or server.py's mock). From
+the project root:
+  python -m scripts.bench_intent --eval data/intent_eval.jsonl --llm
+"""
+from dotenv import load_dotenv
+import argparse
+import json
+import time
+
+from src.streaming.latency_trace import percentile
+from src.streaming.intent_classifier import IntentClassifier
+
+
+def load_eval_set(path):
+  with open(path, "r", encoding="utf-8") as eval_file:
+    return [json.loads(line) for line in eval_file if line.strip()]
+
+
+def llm_answer(llm, text):
+  (decision, _), memory = llm.decide_websearch_memory(text)
+  return decision == "yes", memory is not None and memory.strip().lower() != "none"
+
+
+def report(name, answers, items):
+  """answers: (search, memory, answered locally, seconds) per item"""
+  search_correct = sum(search == (item["websearch"] == "yes") for (search, _, _, _), item in zip(answers, items))
+  memory_correct = sum(memory == item["memory"] for (_, memory, _, _), item in zip(answers, items))
+  local = sum(answered for _, _, answered, _ in answers)
+  latencies = [seconds * 1000 for _, _, _, seconds in answers]
+  count = len(items)
+  print(f"{name:<12}{search_correct / count:>12.1%}{memory_correct / count:>12.1%}{local / count:>8.0%}"
+        f"{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the local intent classifier against the LLM classifier")
+  parser.add_argument("--eval", default="data/intent_eval.jsonl", help="labelled commands, one JSON object per line")
+  parser.add_argument("--llm", action="store_true", help="also run the LLM classifier prompt")
+  args = parser.parse_args()
+
+  items = load_eval_set(args.eval)
+
+  from langchain_community.embeddings import HuggingFaceEmbeddings
+  classifier = IntentClassifier(HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2"))
+  classifier.classify(items[0]["text"]) # warm up
+
+  votes = []
+  local_answers = []
+  for item in items:
+    start = time.perf_counter()
+    scores = classifier.scores(item["text"])
+    votes.append((scores["websearch"][0], scores["memory"][0], True, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    local_answers.append((classifier.classify(item["text"]), time.perf_counter() - start))
+
+  llm = None
+  if args.llm:
+    from src.streaming.llm_wrapper import LLMWrapper
+    from src.streaming.interrupt_signal import InterruptSignal
+    llm = LLMWrapper(InterruptSignal(), persist_history=False)
+
+  print(f"{len(items)} labelled commands")
+  print(f"{'classifier':<12}{'search acc':>12}{'memory acc':>12}{'local':>8}{'p50 ms':>9}{'p95 ms':>9}")
+  report("local vote", votes, items)
+  if llm is None:
+    unsure = sum(result is None for result, _ in local_answers)
+    print(f"local classifier unsure on {unsure} of {len(items)} commands, run with --llm to score the fallback")
+    return
+
+  llm_answers = []
+  combined = []
+  for item, (result, local_seconds) in zip(items, local_answers):
+    start = time.perf_counter()
+    search, memory = llm_answer(llm, item["text"])
+    seconds = time.perf_counter() - start
+    llm_answers.append((search, memory, False, seconds))
+    if result is None:
+      combined.append((search, memory, False, local_seconds + seconds))
+    else:
+      (decision, _), _ = result
+      combined.append((decision == "yes", False, True, local_seconds))
+
+  report("llm", llm_answers, items)
+  report("local+llm", combined, items)
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
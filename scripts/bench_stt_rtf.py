@@ -0,0 +1,143 @@
+"""
+Measures Whisper's real-time factor (processing time / audio duration) per STT profile on sample commands,
+to size CPU-only nodes. The audio directory holds 16 bit wav files, with an optional <name>.txt reference
+transcript next to each for word recall. Like the pipeline only the speech spans VAD_CHOICE finds are decoded.
+From the project root:
+  python -m scripts.bench_stt_rtf --audio data/commands --models base.en,small.en --threads 2,4
+
+--decode streaming feeds each command frame by frame to the IncrementalTranscriber (STT_STREAMING), its RTF
+counts every partial decode and p95 only the final one, the wait once speech has ended. Compare its WER with
+the greedy-first and beam rows before turning STT_STREAMING on.
+
+  load s     model load time
+  RTF        total decode time / total audio, below 1 is faster than real time
+  p95 s      95th percentile decode time of a single command
+  beam       commands re-decoded with beam search after a low confidence greedy pass
+  recall     word recall against the reference transcripts
+  WER        word error rate against the reference transcripts, made up words count too
+  streams    commands the node decodes in parallel in real time, one model per `threads` cores
+"""
+from dotenv import load_dotenv
+import argparse
+import itertools
+import os
+import time
+
+from config import *
+from src.streaming.latency_trace import percentile
+from src.streaming.replay_io import list_command_files, load_wav_pcm
+from src.streaming.stt_streaming import IncrementalTranscriber
+from src.streaming.stt_whisper import STTWhisper, available_cores
+from src.streaming.vad import create_vad, speech_spans
+from scripts.measure_preroll import word_error_rate, word_recall
+
+
+def load_commands(audio_dir, sample_rate=16000):
+  """(pcm, VAD decision per frame, reference transcript) per command."""
+  vad = create_vad()
+  commands = []
+  for path in list_command_files(audio_dir):
+    reference_path = os.path.splitext(path)[0] + ".txt"
+    reference = open(reference_path).read() if os.path.exists(reference_path) else None
+    pcm = load_wav_pcm(path, sample_rate)
+    vad.reset()
+    voiced = [vad.process(pcm[index:index + vad.frame_length]) > VOICE_PROBABILITY
+              for index in range(0, len(pcm) - vad.frame_length + 1, vad.frame_length)]
+    commands.append((pcm, voiced, reference))
+  if not commands:
+    raise SystemExit(f"No wav files found in {audio_dir}")
+  return commands, vad.frame_length
+
+
+def command_spans(voiced, frame_length, sample_rate=16000):
+  pad_frames = int(STT_SPEECH_PAD * sample_rate / frame_length)
+  return speech_spans(voiced, frame_length, pad_frames, merge_frames=2 * pad_frames)
+
+
+def transcribe_streaming(whisper, pcm, voiced, frame_length):
+  """Feeds pcm like the recorder does, waiting for each partial decode. Returns the text and the final decode time."""
+  transcriber = IncrementalTranscriber(whisper, frame_length)
+  for frame in range(1, len(voiced) + 1):
+    transcriber.feed(pcm[:frame * frame_length], voiced[:frame])
+    while transcriber.wake.is_set() and not transcriber.stopped:
+      time.sleep(0.001)
+  spans = command_spans(voiced, frame_length)
+  start = time.perf_counter()
+  text = transcriber.finish(end=spans[-1][1] if spans else 0)
+  return text, time.perf_counter() - start
+
+
+def run_profile(commands, frame_length, device, model_size, compute_type, cpu_threads, decode, sample_rate=16000):
+  start = time.perf_counter()
+  whisper = STTWhisper(vad_active=True, device=device, model_size=model_size, compute_type=compute_type,
+                       cpu_threads=cpu_threads, greedy_first=decode != "beam")
+  load_time = time.perf_counter() - start
+
+  # the first decode allocates the model's buffers, keep it out of the timings
+  whisper.transcribe_pcm(commands[0][0])
+  whisper.beam_fallbacks = 0
+
+  compute_time = 0.0
+  decode_times = []
+  recall = []
+  errors = []
+  audio_time = 0.0
+  for pcm, voiced, reference in commands:
+    start = time.perf_counter()
+    if decode == "streaming":
+      text, final_time = transcribe_streaming(whisper, pcm, voiced, frame_length)
+    else:
+      text = whisper.transcribe_text(pcm, command_spans(voiced, frame_length))
+      final_time = time.perf_counter() - start
+    compute_time += time.perf_counter() - start
+    decode_times.append(final_time)
+    audio_time += len(pcm) / sample_rate
+    if reference:
+      score = word_recall(reference, text)
+      if score is not None:
+        recall.append(score)
+        errors.append(word_error_rate(reference, text))
+
+  return {
+    "threads": whisper.profile.get("cpu_threads"),
+    "load": load_time,
+    "rtf": compute_time / audio_time,
+    "p95": percentile(decode_times, 95),
+    "beam": whisper.beam_fallbacks,
+    "recall": sum(recall) / len(recall) if recall else None,
+    "wer": sum(errors) / len(errors) if errors else None,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark Whisper's real-time factor per STT profile")
+  parser.add_argument("--audio", required=True, help="directory of command wav files, optional <name>.txt references")
+  parser.add_argument("--device", default="cpu")
+  parser.add_argument("--models", default=STT_MODEL_SIZE, help="comma separated model sizes, 'auto' for the device default")
+  parser.add_argument("--compute-type", default=STT_COMPUTE_TYPE)
+  parser.add_argument("--threads", default=str(STT_CPU_THREADS), help="comma separated cpu_threads values, 0 = every core")
+  parser.add_argument("--decode", default="greedy-first,beam", help="comma separated: greedy-first, beam, streaming")
+  args = parser.parse_args()
+
+  commands, frame_length = load_commands(args.audio)
+  cores = available_cores()
+  audio_time = sum(len(pcm) for pcm, _, _ in commands) / 16000
+  print(f"{len(commands)} commands, {audio_time:.1f}s of audio, {cores} cores, {args.device}")
+  print(f"{'model':<12}{'decode':<14}{'threads':>8}{'load s':>8}{'RTF':>7}{'p95 s':>8}{'beam':>6}{'recall':>8}{'WER':>8}{'streams':>9}")
+
+  profiles = itertools.product(args.models.split(","), args.decode.split(","), [int(t) for t in args.threads.split(",")])
+  for model_size, decode, threads in profiles:
+    result = run_profile(commands, frame_length, args.device, model_size, args.compute_type, threads, decode)
+    recall = f"{result['recall']:.1%}" if result["recall"] is not None else "-"
+    wer = f"{result['wer']:.1%}" if result["wer"] is not None else "-"
+    if result["threads"]:
+      streams = f"{cores // result['threads'] / result['rtf']:.1f}"
+    else:
+      streams = "-"
+    print(f"{model_size:<12}{decode:<14}{result['threads'] or '-':>8}{result['load']:>8.1f}{result['rtf']:>7.2f}"
+          f"{result['p95']:>8.2f}{result['beam']:>6}{recall:>8}{wer:>8}{streams:>9}")
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
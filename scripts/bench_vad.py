@@ -0,0 +1,137 @@
+"""
+Compares the VAD backends (src/streaming/vad.py) on recorded commands: CPU time per frame, frame accuracy
+against labelled speech and how well each one endpoints with the recorder's SILENCE_THRESHOLD rule.
+
+The audio directory holds one command per 16 bit wav file with a <name>.json label next to it,
+{"speech": [[start, end], ...]} in seconds (see replay_io.load_speech_labels). From the project root:
+  python -m scripts.bench_vad --audio data/vad --backends energy,silero,cobra
+
+  us/frame   CPU time per 32 ms frame
+  frame acc  share of frames classified the same as the labels
+  end err    median |detected end of speech - labelled end|
+  early      commands cut off before the labelled end of speech (endpoint fired mid command)
+  missed     commands never endpointed
+"""
+from dotenv import load_dotenv
+import argparse
+import time
+import numpy as np
+
+from config import *
+from src.streaming.latency_trace import percentile
+from src.streaming.replay_io import list_command_files, load_wav_pcm, load_speech_labels
+from src.streaming.vad import create_vad
+from src.streaming.endpointer import Endpointer
+
+
+def frame_labels(labels, frame_count, frame_duration):
+  centers = (np.arange(frame_count) + 0.5) * frame_duration
+  speech = np.zeros(frame_count, dtype=bool)
+  for start, end in labels:
+    speech |= (centers >= start) & (centers < end)
+  return speech
+
+
+def load_labelled_recordings(audio_dir, sample_rate=16000):
+  recordings = []
+  for path in list_command_files(audio_dir):
+    labels = load_speech_labels(path)
+    if labels:
+      recordings.append((load_wav_pcm(path, sample_rate), labels))
+  if not recordings:
+    raise SystemExit(f"No labelled wav files found in {audio_dir}")
+  return recordings
+
+
+def vad_probabilities(vad, pcm, trailing_silence):
+  """Per-frame speech probabilities of pcm followed by trailing_silence seconds of silence, and the CPU seconds spent."""
+  pcm = np.concatenate((pcm, np.zeros(int(trailing_silence * vad.sample_rate), dtype=np.int16)))
+  frame_length = vad.frame_length
+  frame_count = len(pcm) // frame_length
+  vad.reset()
+
+  probabilities = np.zeros(frame_count, dtype=np.float32)
+  start_cpu = time.process_time()
+  for index in range(frame_count):
+    probabilities[index] = vad.process(pcm[index * frame_length:(index + 1) * frame_length])
+  return probabilities, time.process_time() - start_cpu
+
+
+def endpoint(probabilities, frame_duration, adaptive=False):
+  """Runs the recorder's Endpointer from the first voiced frame. Returns (end of speech s, endpoint s) or None."""
+  endpointer = Endpointer(frame_duration, adaptive=adaptive)
+  last_voice = None
+  for index, voice_prob in enumerate(probabilities):
+    if voice_prob > VOICE_PROBABILITY:
+      last_voice = index
+    # like the recorder, leading silence before the command is not endpointed on
+    if last_voice is None:
+      continue
+    if endpointer.update(voice_prob):
+      return (last_voice + 1) * frame_duration, (index + 1) * frame_duration
+  return None
+
+
+def run_backend(vad, recordings):
+  frame_duration = vad.frame_length / vad.sample_rate
+  cpu_seconds = 0.0
+  frames = 0
+  correct = 0
+  errors = []
+  early = 0
+  missed = 0
+
+  for pcm, labels in recordings:
+    # trailing silence so every command can endpoint
+    probabilities, cpu = vad_probabilities(vad, pcm, SILENCE_THRESHOLD + 0.5)
+    voiced = probabilities > VOICE_PROBABILITY
+    cpu_seconds += cpu
+    frames += voiced.size
+
+    correct += np.count_nonzero(voiced == frame_labels(labels, voiced.size, frame_duration))
+    result = endpoint(probabilities, frame_duration)
+    if result is None:
+      missed += 1
+      continue
+
+    speech_end, endpoint_time = result
+    labelled_end = max(end for _, end in labels)
+    errors.append(abs(speech_end - labelled_end) * 1000)
+    if endpoint_time < labelled_end:
+      early += 1
+
+  return {
+    "us_per_frame": cpu_seconds / frames * 1e6,
+    "frame_accuracy": correct / frames,
+    "end_error_ms": percentile(errors, 50),
+    "early": early,
+    "missed": missed,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the VAD backends on labelled recordings")
+  parser.add_argument("--audio", required=True, help="directory of command wav files with <name>.json speech labels")
+  parser.add_argument("--backends", default="energy,silero,cobra", help="comma separated VAD_CHOICE values")
+  args = parser.parse_args()
+
+  recordings = load_labelled_recordings(args.audio)
+
+  print(f"{len(recordings)} labelled commands, SILENCE_THRESHOLD {SILENCE_THRESHOLD}s")
+  print(f"{'backend':<10}{'us/frame':>10}{'frame acc':>11}{'end err ms':>12}{'early':>7}{'missed':>8}")
+  for choice in args.backends.split(","):
+    try:
+      vad = create_vad(choice)
+    except Exception as e:
+      print(f"{choice:<10}unavailable: {e}")
+      continue
+
+    result = run_backend(vad, recordings)
+    vad.delete()
+    end_error = f"{result['end_error_ms']:.0f}" if result["end_error_ms"] is not None else "-"
+    print(f"{choice:<10}{result['us_per_frame']:>10.1f}{result['frame_accuracy']:>11.1%}{end_error:>12}{result['early']:>7}{result['missed']:>8}")
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
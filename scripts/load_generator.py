@@ -0,0 +1,135 @@
+"""
+Load generator for server.py. Opens an increasing number of concurrent sessions, each speaking recorded
+commands in real time, and measures the latency from the end of each command to the first audio byte
+of the reply. Reports the largest session count whose P95 stays within the target.
+
+Start the server first (e.g. `python server.py --device cpu --mock-llm`), then from the project root:
+  python -m scripts.load_generator --commands data/replay/commands --levels 1,2,4,8 --target-ms 2500
+"""
+import argparse
+import asyncio
+import time
+import numpy as np
+
+from src.streaming.latency_trace import percentile
+from src.streaming.replay_io import list_command_files, load_wav_pcm
+from src.streaming.session_protocol import FRAME_AUDIO, FRAME_EVENT, CLIENT_SAMPLE_RATE, read_frame, write_audio
+
+FRAME_LENGTH = 512
+
+
+async def send_realtime(writer, pcm):
+  """Sends int16 pcm in 32 ms frames, paced like a microphone."""
+  frame_duration = FRAME_LENGTH / CLIENT_SAMPLE_RATE
+  start = time.monotonic()
+  for index in range(0, len(pcm), FRAME_LENGTH):
+    write_audio(writer, pcm[index:index + FRAME_LENGTH].tobytes())
+    await writer.drain()
+    delay = start + (index // FRAME_LENGTH + 1) * frame_duration - time.monotonic()
+    if delay > 0:
+      await asyncio.sleep(delay)
+
+
+async def run_session(host, port, commands, turns, turn_timeout):
+  """Speaks `turns` commands on one connection, returns (latencies in ms, failed turns)."""
+  reader, writer = await asyncio.open_connection(host, port)
+  events = asyncio.Queue()
+  first_audio = asyncio.Queue()
+
+  async def receive():
+    while True:
+      frame_type, payload = await read_frame(reader)
+      if frame_type == FRAME_AUDIO:
+        first_audio.put_nowait(time.monotonic())
+      elif frame_type == FRAME_EVENT:
+        events.put_nowait(payload)
+
+  receiver = asyncio.create_task(receive())
+  latencies = []
+  failures = 0
+  silence = np.zeros(CLIENT_SAMPLE_RATE // 10, dtype=np.int16)
+
+  try:
+    ready = await asyncio.wait_for(events.get(), turn_timeout)
+    if ready["event"] != "ready":
+      raise ConnectionError(ready.get("message", "session refused"))
+
+    for index in range(turns):
+      await send_realtime(writer, commands[index % len(commands)])
+      speech_end = time.monotonic()
+
+      # keep the microphone stream going with silence until the turn is over
+      deadline = speech_end + turn_timeout
+      latency = None
+      turn_over = False
+      while not turn_over and time.monotonic() < deadline:
+        await send_realtime(writer, silence)
+        while not first_audio.empty():
+          audio_time = first_audio.get_nowait()
+          if latency is None:
+            latency = (audio_time - speech_end) * 1000
+        while not events.empty():
+          if events.get_nowait()["event"] == "turn_end":
+            turn_over = True
+
+      if latency is None or not turn_over:
+        failures += 1
+      else:
+        latencies.append(latency)
+  finally:
+    receiver.cancel()
+    writer.close()
+
+  return latencies, failures
+
+
+async def run_level(args, commands, sessions):
+  results = await asyncio.gather(
+    *(run_session(args.host, args.port, commands, args.turns, args.turn_timeout) for _ in range(sessions)),
+    return_exceptions=True
+  )
+
+  latencies = []
+  failures = 0
+  for result in results:
+    if isinstance(result, Exception):
+      failures += args.turns
+      continue
+    latencies.extend(result[0])
+    failures += result[1]
+
+  return latencies, failures
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure how many concurrent sessions server.py sustains at a target latency")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8765)
+  parser.add_argument("--commands", required=True, help="directory of 16 bit command wav files")
+  parser.add_argument("--levels", default="1,2,4,8,16", help="comma separated session counts to try")
+  parser.add_argument("--turns", type=int, default=3, help="commands spoken per session")
+  parser.add_argument("--target-ms", type=float, default=2500, help="P95 end of speech to first audio target")
+  parser.add_argument("--turn-timeout", type=float, default=60)
+  args = parser.parse_args()
+
+  commands = [load_wav_pcm(path, CLIENT_SAMPLE_RATE) for path in list_command_files(args.commands)]
+  if not commands:
+    raise SystemExit(f"No wav files found in {args.commands}")
+
+  sustained = 0
+  print(f"{'sessions':>8}{'turns':>7}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}")
+  for sessions in [int(level) for level in args.levels.split(",")]:
+    latencies, failures = asyncio.run(run_level(args, commands, sessions))
+    p50 = percentile(latencies, 50)
+    p95 = percentile(latencies, 95)
+    print(f"{sessions:>8}{len(latencies):>7}{failures:>8}{(p50 or 0):>10.0f}{(p95 or 0):>10.0f}")
+
+    if failures or p95 is None or p95 > args.target_ms:
+      break
+    sustained = sessions
+
+  print(f"\nSustained {sustained} concurrent sessions at P95 <= {args.target_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,134 @@
+"""
+Measures how much of a command spoken right after the wake word each capture strategy keeps.
+
+The test set is a directory of 16 bit wav files, each holding the wake word followed by a command in one
+breath, with an optional .txt next to it containing the command's reference transcript. Porcupine finds the
+detection frame in every file and the command audio is cut from three starting points:
+  restart     the recorder was stopped on detection and restarted for the command (--restart-ms lost)
+  continuous  capture keeps running and the command starts on the frame after detection
+  preroll     like continuous, plus WAKE_WORD_PREROLL_DURATION before detection
+
+Reports the voiced audio (VAD_CHOICE) each one keeps and, with --transcribe, Whisper's word recall against the
+reference transcripts. Needs PICOVOICE_API_KEY. From the project root:
+  python -m scripts.measure_preroll --utterances data/preroll --transcribe
+"""
+from dotenv import load_dotenv
+import argparse
+import difflib
+import os
+import re
+import pvporcupine
+
+from config import *
+from src.streaming.replay_io import list_command_files, load_wav_pcm
+from src.streaming.vad import create_vad
+
+
+def words(text):
+  return re.findall(r"[a-z0-9']+", text.lower())
+
+
+def word_recall(reference, hypothesis):
+  reference_words = words(reference)
+  if not reference_words:
+    return None
+  matcher = difflib.SequenceMatcher(a=reference_words, b=words(hypothesis), autojunk=False)
+  return sum(block.size for block in matcher.get_matching_blocks()) / len(reference_words)
+
+
+def word_error_rate(reference, hypothesis):
+  """(substitutions + deletions + insertions) / reference words, unlike recall it counts made up words."""
+  reference_words = words(reference)
+  if not reference_words:
+    return None
+  distances = list(range(len(words(hypothesis)) + 1))
+  for reference_word in reference_words:
+    previous, distances[0] = distances[0], distances[0] + 1
+    for index, hypothesis_word in enumerate(words(hypothesis), start=1):
+      previous, distances[index] = distances[index], min(
+        distances[index] + 1, distances[index - 1] + 1, previous + (reference_word != hypothesis_word))
+  return distances[-1] / len(reference_words)
+
+
+def detection_frame(porcupine, pcm):
+  frame_length = porcupine.frame_length
+  for index in range(len(pcm) // frame_length):
+    if porcupine.process(pcm[index * frame_length:(index + 1) * frame_length]) >= 0:
+      return index
+  return None
+
+
+def voiced_seconds(vad, pcm):
+  vad.reset()
+  frame_length = vad.frame_length
+  voiced = 0
+  for index in range(len(pcm) // frame_length):
+    if vad.process(pcm[index * frame_length:(index + 1) * frame_length]) > VOICE_PROBABILITY:
+      voiced += 1
+  return voiced * frame_length / vad.sample_rate
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Measure speech recovered by the wake word pre-roll")
+  parser.add_argument("--utterances", required=True, help="directory of wav files, wake word then command")
+  parser.add_argument("--restart-ms", type=float, default=100, help="audio lost while the recorder restarts after detection")
+  parser.add_argument("--preroll-ms", type=float, default=WAKE_WORD_PREROLL_DURATION * 1000)
+  parser.add_argument("--transcribe", action="store_true", help="run Whisper and score word recall against <name>.txt")
+  args = parser.parse_args()
+
+  vad = create_vad()
+  whisper = None
+  if args.transcribe:
+    from src.streaming.stt_whisper import STTWhisper
+    whisper = STTWhisper(vad_active=True, device=DEVICE)
+
+  sample_rate = vad.sample_rate
+  frame_length = vad.frame_length
+  offsets = {
+    "restart": int(args.restart_ms / 1000 * sample_rate),
+    "continuous": 0,
+    "preroll": -int(args.preroll_ms / 1000 / (frame_length / sample_rate)) * frame_length,
+  }
+  voiced = {name: 0.0 for name in offsets}
+  recall = {name: [] for name in offsets}
+  files = 0
+
+  for path in list_command_files(args.utterances):
+    pcm = load_wav_pcm(path, sample_rate)
+    # fresh detector per file so no state carries over between utterances
+    porcupine = pvporcupine.create(access_key=os.getenv("PICOVOICE_API_KEY"), keywords=[WAKE_KEYWORD])
+    detected = detection_frame(porcupine, pcm)
+    porcupine.delete()
+    if detected is None:
+      print(f"{os.path.basename(path)}: wake word not detected, skipped")
+      continue
+
+    files += 1
+    reference_path = os.path.splitext(path)[0] + ".txt"
+    reference = open(reference_path).read() if os.path.exists(reference_path) else None
+    command_start = (detected + 1) * frame_length
+
+    for name, offset in offsets.items():
+      command = pcm[max(0, command_start + offset):]
+      voiced[name] += voiced_seconds(vad, command)
+      if whisper and reference:
+        text = " ".join(segment.text for segment in whisper.transcribe_pcm(command))
+        score = word_recall(reference, text)
+        if score is not None:
+          recall[name].append(score)
+
+  if not files:
+    raise SystemExit(f"No utterance with a detected wake word in {args.utterances}")
+
+  print(f"\n{files} utterances")
+  print(f"{'strategy':<12}{'voiced s':>10}{'vs restart':>12}{'word recall':>13}")
+  for name in offsets:
+    gained = voiced[name] - voiced["restart"]
+    scores = recall[name]
+    score = f"{sum(scores) / len(scores):.1%}" if scores else "-"
+    print(f"{name:<12}{voiced[name]:>10.2f}{gained:>+12.2f}{score:>13}")
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
@@ -0,0 +1,80 @@
+"""
+Multi-session server. Accepts concurrent voice sessions over TCP (see src/streaming/session_protocol.py),
+with Whisper, RAG embeddings, web search and TTS loaded once in pooled worker processes.
+
+  python server.py --device cpu --mock-llm
+
+Drive it with scripts/load_generator.py to find how many sessions it sustains at a target latency.
+"""
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import os
+import warnings
+warnings.filterwarnings("ignore")
+
+from src.streaming.logging_config import setup_logging, start_listener, stop_listener, get_log_queue
+from src.streaming.model_pool import ModelPool
+from src.streaming.mock_openai_server import MockOpenAIServer
+from config import *
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Serve concurrent voice sessions over TCP")
+  parser.add_argument("--host", default=SERVER_HOST)
+  parser.add_argument("--port", type=int, default=SERVER_PORT)
+  parser.add_argument("--max-sessions", type=int, default=SERVER_MAX_SESSIONS)
+  parser.add_argument("--stt-workers", type=int, default=SERVER_STT_WORKERS)
+  parser.add_argument("--tts-workers", type=int, default=SERVER_TTS_WORKERS)
+  parser.add_argument("--web-workers", type=int, default=SERVER_WEB_WORKERS)
+  parser.add_argument("--device", default=DEVICE, help="'cuda' or 'cpu' for the Whisper workers")
+  parser.add_argument("--mock-llm", action="store_true", help="answer from a local mock OpenAI server instead of LM Studio")
+  return parser.parse_args()
+
+
+def main():
+  args = parse_args()
+
+  mock_server = None
+  if args.mock_llm:
+    mock_server = MockOpenAIServer()
+    os.environ["OPENAI_API"] = mock_server.start()
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+  # imported after the environment is set up so the pool workers inherit it
+  from src.streaming.session_server import SessionServer
+
+  os.makedirs("conversation", exist_ok=True)
+  start_listener()
+  logger = setup_logging()
+  log_queue = get_log_queue()
+
+  # the RAG store lives in memory, a single worker keeps every session on the same store
+  pools = {
+    "stt": ModelPool("stt", args.stt_workers, log_queue, device=args.device),
+    "tts": ModelPool("tts", args.tts_workers, log_queue, device=args.device),
+    "rag": ModelPool("rag", 1, log_queue, device=args.device),
+    "web": ModelPool("web", args.web_workers, log_queue, device=args.device),
+  }
+
+  try:
+    for pool in pools.values():
+      pool.start()
+
+    server = SessionServer(pools, host=args.host, port=args.port, max_sessions=args.max_sessions)
+    asyncio.run(server.serve())
+  except KeyboardInterrupt:
+    logger.info("Shutting down")
+  finally:
+    for pool in pools.values():
+      pool.stop()
+    if mock_server:
+      mock_server.stop()
+    stop_listener()
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()
@@ -0,0 +1,122 @@
+import logging
+import threading
+import numpy as np
+
+
+class AudioCapture:
+  """
+  Keeps the microphone running on one thread and publishes every frame to any number of cursors.
+  Consumers (wake word, VAD, pre-roll buffer, command recorder) read at their own position, so no frame
+  is lost when one consumer hands over to the next and the device is never restarted.
+  Frames are numbered from 0; the last `history_frames` of them stay readable.
+  """
+
+  MAX_READ_ERRORS = 10     # consecutive failed reads before capture stops and the readers get an error
+  READ_ERROR_BACKOFF = 0.1 # seconds to wait after the first failed read, doubled after each one up to 2s
+
+  def __init__(self, recorder, history_frames):
+    self.logger = logging.getLogger("speech_to_speech.audio_capture")
+    self.recorder = recorder
+    self.sample_rate = recorder.sample_rate
+    self.frame_length = recorder.frame_length
+
+    self.history_frames = history_frames
+    self.frames = [None] * history_frames
+    self.position = 0 # number of the next frame to be captured
+    self.condition = threading.Condition()
+    self.running = False
+    self.error = None # the read error capture stopped on
+    self.thread = None
+
+
+  def start(self):
+    if self.running:
+      return
+    self.running = True
+    self.recorder.start()
+    self.thread = threading.Thread(target=self._capture, daemon=True)
+    self.thread.start()
+
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify_all()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    self.recorder.stop()
+
+
+  def _capture(self):
+    errors = 0
+    while self.running:
+      try:
+        frame = self.recorder.read()
+      except Exception as e:
+        errors += 1
+        self.logger.error(f"Reading from the microphone failed ({errors}/{self.MAX_READ_ERRORS}): {e}")
+        with self.condition:
+          if errors >= self.MAX_READ_ERRORS:
+            # wakes the readers, they raise instead of waiting for frames that never come
+            self.logger.error("Stopping audio capture")
+            self.error = e
+            self.running = False
+            self.condition.notify_all()
+            return
+          self.condition.wait_for(lambda: not self.running, min(self.READ_ERROR_BACKOFF * 2 ** (errors - 1), 2.0))
+        continue
+      errors = 0
+
+      pcm = np.array(frame, dtype=np.int16)
+      with self.condition:
+        self.frames[self.position % self.history_frames] = pcm
+        self.position += 1
+        self.condition.notify_all()
+
+
+  def cursor(self, position=None):
+    """New cursor starting at `position`, or at the next live frame."""
+    with self.condition:
+      return CaptureCursor(self, self.position if position is None else position)
+
+
+  def read(self, position, timeout=None):
+    """Returns (frame, position it was read from), or (None, position) on timeout."""
+    with self.condition:
+      if not self.condition.wait_for(lambda: position < self.position or not self.running, timeout):
+        return None, position
+      if not self.running:
+        raise RuntimeError("AudioCapture is stopped") from self.error
+
+      oldest = self.position - self.history_frames
+      if position < oldest:
+        self.logger.warning(f"Capture cursor fell {oldest - position} frames behind, skipping ahead")
+        position = oldest
+      return self.frames[position % self.history_frames], position
+
+
+class CaptureCursor:
+  """One consumer's read position in an AudioCapture stream."""
+
+  def __init__(self, capture, position):
+    self.capture = capture
+    self.position = position
+
+
+  def read(self, timeout=None):
+    """Next int16 frame, blocks until it is captured. None on timeout."""
+    frame, position = self.capture.read(self.position, timeout)
+    if frame is not None:
+      self.position = position + 1
+    return frame
+
+
+  def seek(self, position):
+    self.position = position
+
+
+  def seek_live(self):
+    """Skips everything already captured, the next read returns the next new frame."""
+    with self.capture.condition:
+      self.position = self.capture.position
@@ -1,12 +1,15 @@
 import logging
+import os
 import wave
 import array
 import threading
 from pvspeaker import PvSpeaker
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.interrupt_signal import InterruptSignal
 from config import *
 import queue
 import time
+from src.streaming import latency_trace
+from src.streaming.replay_io import is_null_audio_sink, NullSpeaker
 
 
 class AudioOutputter():
@@ -17,35 +20,37 @@ class AudioOutputter():
         cls._instance = super().__new__(cls)
     return cls._instance
    
-  def __init__(self, interrupt_count: SynchronizedClass, logger: logging.Logger):
-    self.interrupt_count = interrupt_count
+  def __init__(self, interrupt_signal: InterruptSignal, logger: logging.Logger):
     self.logger = logger
+    # singleton, only the first construction in each process sets up the speaker state and interrupt subscription
+    if getattr(self, "_owner_pid", None) == os.getpid():
+      return
+    self._owner_pid = os.getpid()
+    self.interrupt_signal = interrupt_signal
 
     self.speaker = None
-    self.monitor_thread = threading.Thread(target=self._interrupt_monitor, daemon=True)
-    self._stop_monitor = threading.Event()
-    self.monitor_thread.start()
+    self._subscription = interrupt_signal.subscribe(self._on_interrupt) if interrupt_signal else None
     
     self._stream_queue = queue.Queue()  # buffer ~50 chunks
     self._stream_stop_event = threading.Event()
     self._stream_thread = None
 
+    # replay.py discards audio output while keeping playback timing
+    self._speaker_class = NullSpeaker if is_null_audio_sink() else PvSpeaker
 
-  def _interrupt_monitor(self):
-    prev_interrupt_count = 0
-    while not self._stop_monitor.is_set():
-      count = self.interrupt_count.value
-      if count > 0 and count != prev_interrupt_count:
-        if self._stream_worker:
-          self._stream_stop_event.set()
-        if self.speaker:
-          self.logger.warning("Speaker interrupted")
-          try:
-            self.speaker.stop()
-          except Exception as e:
-            self.logger.error(e)
-      prev_interrupt_count = count
-      self._stop_monitor.wait(0.25)  # check ~4 times per second
+
+  def _on_interrupt(self):
+    """Called from the interrupt signal's watcher thread as soon as the recorder fires, stops the speaker immediately."""
+    self._stream_stop_event.set()
+    speaker = self.speaker
+    if speaker:
+      self.logger.warning("Speaker interrupted")
+      try:
+        speaker.stop()
+      except Exception as e:
+        self.logger.error(e)
+      latency_trace.mark_at("interrupt_fired", self.interrupt_signal.fired_at)
+      latency_trace.mark("playback_stopped")
    
     
   def start_audio_stream(self, sample_rate: int = 24000, bits_per_sample: int = 16):
@@ -53,7 +58,7 @@ class AudioOutputter():
     if self.speaker:
         self.speaker.delete()
   
-    self.speaker = PvSpeaker(
+    self.speaker = self._speaker_class(
         sample_rate=sample_rate,
         bits_per_sample=bits_per_sample,
         buffer_size_secs=20,
@@ -72,12 +77,12 @@ class AudioOutputter():
           pcm_chunk = self._stream_queue.get(timeout=0.1)  # wait for new chunk
           total_written = 0
           while total_written < len(pcm_chunk):
-            if self.interrupt_count.value > 0:
+            if self.interrupt_signal.is_set():
               self.speaker.stop()
               break
             
-            # self.logger.error(f"Chunk written - {time.time()}")
             written = self.speaker.write(pcm_chunk[total_written:])
+            latency_trace.mark("playback_first_sample")
             total_written += written
         except queue.Empty:
             continue  # no chunk yet, loop again
@@ -87,15 +92,17 @@ class AudioOutputter():
       pcm_chunk = self._stream_queue.get(timeout=0.1)  # wait for new chunk
       total_written = 0
       while total_written < len(pcm_chunk):
-        if self.interrupt_count.value > 0:
+        if self.interrupt_signal.is_set():
           self.speaker.stop()
           break
 
         written = self.speaker.write(pcm_chunk[total_written:])
+        latency_trace.mark("playback_first_sample")
         total_written += written
 
 
   def play_stream_audio(self, pcm_chunk):
+      latency_trace.mark("tts_first_chunk")
       # Convert numpy int16 to list for PvSpeaker
       pcm_list = pcm_chunk.tolist()
       self._stream_queue.put(pcm_list)
@@ -110,6 +117,7 @@ class AudioOutputter():
         self.speaker.flush()
       except Exception as e:
         pass
+      latency_trace.mark("playback_end")
       self.speaker.stop()
       self.speaker.delete()
       self.speaker = None
@@ -119,7 +127,8 @@ class AudioOutputter():
     return [input_list[i:i + x] for i in range(0, len(input_list), x)]
 
 
-  def play_wav_file(self, wav_bytes):
+  def play_wav_file(self, wav_bytes, trace=True):
+    """Plays a wav file, trace=False keeps side announcements out of the turn's latency trace."""
     wav_file = wave.open(wav_bytes, 'rb')
     sample_rate = wav_file.getframerate()
     bits_per_sample = wav_file.getsampwidth() * 8
@@ -139,7 +148,7 @@ class AudioOutputter():
     if self.speaker:
       self.speaker.delete()
 
-    self.speaker = PvSpeaker(
+    self.speaker = self._speaker_class(
       sample_rate=sample_rate,
       bits_per_sample=bits_per_sample,
       buffer_size_secs=20,
@@ -172,15 +181,19 @@ class AudioOutputter():
           sublist_length = len(pcm_sublist)
           total_written_length = 0
           while total_written_length < sublist_length:
-            if self.interrupt_count and self.interrupt_count.value > 0:
+            if self.interrupt_signal and self.interrupt_signal.is_set():
               self.logger.warning("Speaker interrupted during write")
               return
 
             written_length = self.speaker.write(pcm_sublist[total_written_length:])
+            if trace:
+              latency_trace.mark("playback_first_sample")
             total_written_length += written_length
 
       self.logger.debug("Waiting for audio to finish...")
       self.speaker.flush()
+      if trace:
+        latency_trace.mark("playback_end")
 
     finally:
       self.speaker.stop()
@@ -192,8 +205,9 @@ class AudioOutputter():
 
 
   def shutdown(self):
-    self._stop_monitor.set()
-    self.monitor_thread.join()
+    if self._subscription is not None:
+      self.interrupt_signal.unsubscribe(self._subscription)
+      self._subscription = None
 
     if self.speaker:
       self.speaker.stop()
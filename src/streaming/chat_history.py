@@ -0,0 +1,227 @@
+import json
+import logging
+import os
+import queue
+import threading
+from array import array
+from multiprocessing.util import Finalize
+from config import *
+
+
+class ChatHistoryStore:
+  """
+  Append-only conversation log, one JSON record per line ({"message", "length", "timestamp"}). Next to it a
+  small binary index holds the byte offset of every `index_stride`-th record, so the record count and the
+  offset of any indexed record are known without parsing the log.
+
+  - appends are handed to a writer thread, the reply path never waits on the disk
+  - tail() reads records newest first in blocks from the end of the file, startup only parses what it keeps
+  - once the log holds more than `max_messages` records the writer thread moves the oldest half to
+    <name>.archive.jsonl, cutting at an indexed record so no parsing is needed
+  """
+
+  BLOCK_SIZE = 65536
+
+  def __init__(self, path, max_messages=CHAT_HISTORY_MAX_MESSAGES, index_stride=CHAT_HISTORY_INDEX_STRIDE, legacy_path=None):
+    self.logger = logging.getLogger("speech_to_speech.chat_history")
+    self.path = path
+    base = os.path.splitext(path)[0]
+    self.index_path = base + ".idx"
+    self.archive_path = base + ".archive.jsonl"
+    self.max_messages = max_messages
+    self.index_stride = index_stride
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if legacy_path and not os.path.exists(path):
+      self._migrate(legacy_path)
+    self._repair()
+    self._load_index()
+
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self._write_loop, daemon=True)
+    self.thread.start()
+    # worker processes leave through os._exit and skip atexit, multiprocessing runs its finalizers on the way out
+    Finalize(self, self.close, exitpriority=10)
+
+
+  def _migrate(self, legacy_path):
+    """Converts the chat_history.json the history used to be rewritten to on every reply."""
+    if not os.path.exists(legacy_path):
+      return
+    with open(legacy_path, "r", encoding="utf-8") as legacy_file:
+      records = json.load(legacy_file).get("history", [])
+    with open(self.path, "wb") as log_file:
+      for record in records:
+        log_file.write(self._encode(record))
+    if os.path.exists(self.index_path):
+      os.remove(self.index_path)
+    self.logger.debug(f"Migrated {len(records)} messages from {legacy_path}")
+
+
+  def _repair(self):
+    """Drops a line cut short by a crash mid write, so the next record starts on a line of its own."""
+    if not os.path.exists(self.path):
+      open(self.path, "wb").close()
+      return
+
+    size = os.path.getsize(self.path)
+    with open(self.path, "rb+") as log_file:
+      end = size
+      while end > 0:
+        start = max(0, end - self.BLOCK_SIZE)
+        log_file.seek(start)
+        block = log_file.read(end - start)
+        newline = block.rfind(b"\n")
+        if newline != -1:
+          end = start + newline + 1
+          break
+        end = start
+      if end != size:
+        log_file.truncate(end)
+        self.logger.warning(f"Dropped {size - end} bytes of an incomplete record from {self.path}")
+
+
+  def _load_index(self):
+    self.index = array("Q")
+    size = os.path.getsize(self.path)
+    if os.path.exists(self.index_path):
+      with open(self.index_path, "rb") as index_file:
+        self.index.frombytes(index_file.read())
+
+    # an index that does not match the log (deleted, older than a crash) is rebuilt from the log once
+    if not self._index_matches(size):
+      self._rebuild_index()
+      return
+
+    # only the records after the last indexed one are counted
+    with open(self.path, "rb") as log_file:
+      log_file.seek(self.index[-1] if self.index else 0)
+      unindexed = sum(1 for _ in log_file)
+    if unindexed > self.index_stride:
+      # records were written but the crash came before their index entry
+      self._rebuild_index()
+      return
+    self.count = (len(self.index) - 1) * self.index_stride + unindexed if self.index else unindexed
+
+
+  def _index_matches(self, size):
+    if not self.index:
+      return size == 0
+    if self.index[0] != 0 or self.index[-1] >= size:
+      return False
+    if self.index[-1] == 0:
+      return True
+    # an indexed record starts right after a line break
+    with open(self.path, "rb") as log_file:
+      log_file.seek(self.index[-1] - 1)
+      return log_file.read(1) == b"\n"
+
+
+  def _rebuild_index(self):
+    self.index = array("Q")
+    self.count = 0
+    offset = 0
+    with open(self.path, "rb") as log_file:
+      for line in log_file:
+        if self.count % self.index_stride == 0:
+          self.index.append(offset)
+        offset += len(line)
+        self.count += 1
+    self._write_index()
+
+
+  def _write_index(self):
+    temp_path = self.index_path + ".tmp"
+    with open(temp_path, "wb") as index_file:
+      self.index.tofile(index_file)
+    os.replace(temp_path, self.index_path)
+
+
+  def _encode(self, record):
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+  def tail(self):
+    """Yields the records newest first, reading the log backwards so only the part consumed is parsed."""
+    with open(self.path, "rb") as log_file:
+      end = log_file.seek(0, os.SEEK_END)
+      remainder = b""
+      while end > 0:
+        start = max(0, end - self.BLOCK_SIZE)
+        log_file.seek(start)
+        lines = (log_file.read(end - start) + remainder).split(b"\n")
+        end = start
+        # the first line may continue in the previous block, unless the start of the file was reached
+        remainder = lines.pop(0) if start > 0 else b""
+        for line in reversed(lines):
+          if line:
+            yield json.loads(line)
+      if remainder:
+        yield json.loads(remainder)
+
+
+  def append(self, records):
+    """Queues records for the writer thread and returns immediately."""
+    self.queue.put(records)
+
+
+  def _write_loop(self):
+    while True:
+      records = self.queue.get()
+      if records is None:
+        break
+      try:
+        self._write(records)
+        if self.count > self.max_messages:
+          self._compact()
+      except OSError as e:
+        self.logger.error(f"Failed to save conversation history: {e}")
+
+
+  def _write(self, records):
+    new_offsets = array("Q")
+    with open(self.path, "ab") as log_file:
+      offset = log_file.seek(0, os.SEEK_END)
+      for record in records:
+        line = self._encode(record)
+        if self.count % self.index_stride == 0:
+          new_offsets.append(offset)
+        log_file.write(line)
+        offset += len(line)
+        self.count += 1
+
+    if new_offsets:
+      self.index.extend(new_offsets)
+      with open(self.index_path, "ab") as index_file:
+        new_offsets.tofile(index_file)
+
+
+  def _compact(self):
+    """Moves the oldest records to the archive, keeping about half of max_messages in the log."""
+    cut_entry = (self.count - self.max_messages // 2) // self.index_stride
+    if cut_entry <= 0:
+      return
+    cut_offset = self.index[cut_entry]
+
+    temp_path = self.path + ".tmp"
+    with open(self.path, "rb") as log_file, open(self.archive_path, "ab") as archive_file, open(temp_path, "wb") as temp_file:
+      remaining = cut_offset
+      while remaining > 0:
+        block = log_file.read(min(self.BLOCK_SIZE, remaining))
+        archive_file.write(block)
+        remaining -= len(block)
+      while block := log_file.read(self.BLOCK_SIZE):
+        temp_file.write(block)
+    os.replace(temp_path, self.path)
+
+    self.index = array("Q", (offset - cut_offset for offset in self.index[cut_entry:]))
+    self.count -= cut_entry * self.index_stride
+    self._write_index()
+    self.logger.debug(f"Archived {cut_entry * self.index_stride} messages, {self.count} left in {self.path}")
+
+
+  def close(self):
+    """Writes the queued records and stops the writer thread, also run when the process exits normally."""
+    if self.thread.is_alive():
+      self.queue.put(None)
+      self.thread.join()
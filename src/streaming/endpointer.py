@@ -0,0 +1,103 @@
+import re
+from config import *
+
+# A partial transcript ending in one of these is mid sentence, the speaker is still going
+_CONTINUATION_WORDS = {
+  "a", "an", "the", "and", "or", "but", "so", "because", "to", "of", "in", "on", "at", "for", "with", "from",
+  "about", "is", "are", "was", "what", "which", "who", "how", "when", "where", "if", "that", "my", "your",
+  "um", "uh", "uhm", "er", "like",
+}
+
+
+def transcript_looks_complete(text):
+  """True/False when the text clearly ends a sentence or clearly does not, None when it cannot tell."""
+  text = text.strip()
+  if not text:
+    return None
+  if text.endswith(("...", ",", "-")):
+    return False
+  words = re.findall(r"[a-z']+", text.lower())
+  if words and words[-1] in _CONTINUATION_WORDS:
+    return False
+  if text.endswith((".", "?", "!")):
+    return True
+  return None
+
+
+class Endpointer:
+  """
+  Decides when a command is over from per-frame VAD probabilities. With adaptive=False it is the fixed rule,
+  SILENCE_THRESHOLD seconds of continuous silence. Adaptive endpointing waits between ENDPOINT_MIN_SILENCE and
+  ENDPOINT_MAX_SILENCE depending on:
+    - how much has been said: very short utterances keep the fixed SILENCE_THRESHOLD wait
+    - the speaker's own pauses: wait at least ENDPOINT_PAUSE_FACTOR times the longest pause already resumed from
+    - the VAD probability during the pause: breaths and hesitations keep it above ENDPOINT_HESITATION_PROBABILITY
+    - an optional partial transcript (hint_transcript): a trailing "and", "the", ... means keep listening
+  """
+
+  def __init__(self, frame_duration, adaptive=ENDPOINT_ADAPTIVE):
+    self.frame_duration = frame_duration
+    self.adaptive = adaptive
+    self.reset()
+
+
+  def reset(self):
+    self.voiced_frames = 0
+    self.silence_frames = 0
+    self.silence_probability = 0.0 # sum of the VAD probabilities of the current pause
+    self.longest_pause_frames = 0
+    self.transcript_complete = None
+
+
+  @property
+  def silence_time(self):
+    return self.silence_frames * self.frame_duration
+
+
+  def hint_transcript(self, text):
+    self.transcript_complete = transcript_looks_complete(text)
+
+
+  def required_silence(self):
+    if not self.adaptive:
+      return SILENCE_THRESHOLD
+    # nothing said yet, give the speaker time to start
+    if self.voiced_frames == 0:
+      return ENDPOINT_MAX_SILENCE
+
+    wait = ENDPOINT_MIN_SILENCE
+    if self.voiced_frames * self.frame_duration < ENDPOINT_SHORT_UTTERANCE:
+      wait = SILENCE_THRESHOLD
+    wait = max(wait, ENDPOINT_PAUSE_FACTOR * self.longest_pause_frames * self.frame_duration)
+    if self.silence_frames and self.silence_probability / self.silence_frames > ENDPOINT_HESITATION_PROBABILITY:
+      wait = ENDPOINT_MAX_SILENCE
+    if self.transcript_complete is False:
+      wait = ENDPOINT_MAX_SILENCE
+
+    return min(wait, ENDPOINT_MAX_SILENCE)
+
+
+  def prime(self, voiced_flags):
+    """
+    Learns from frames recorded before the command started (the pre-roll buffer) without ending on them,
+    the current pause restarts with the first live frame.
+    """
+    for voiced in voiced_flags:
+      self.update(1.0 if voiced else 0.0)
+    self.silence_frames = 0
+    self.silence_probability = 0.0
+
+
+  def update(self, voice_prob):
+    """Feeds one frame's VAD probability, returns True once the command is over."""
+    if voice_prob > VOICE_PROBABILITY:
+      if self.voiced_frames:
+        self.longest_pause_frames = max(self.longest_pause_frames, self.silence_frames)
+      self.voiced_frames += 1
+      self.silence_frames = 0
+      self.silence_probability = 0.0
+      return False
+
+    self.silence_frames += 1
+    self.silence_probability += voice_prob
+    return self.silence_frames >= int(self.required_silence() / self.frame_duration)
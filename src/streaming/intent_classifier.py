@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import re
+import numpy as np
+from config import *
+
+# Words dropped from a command to turn it into a search query ("what is the price of bitcoin" -> "price bitcoin")
+_QUERY_FILLER = {
+  "a", "an", "the", "is", "are", "was", "were", "be", "do", "does", "did", "of", "to", "in", "on", "at", "for",
+  "about", "and", "or", "what", "what's", "whats", "who", "who's", "whom", "which", "when", "where", "why", "how",
+  "how's", "can", "could", "would", "will", "you", "me", "my", "i", "i'm", "please", "tell", "show", "find", "look",
+  "up", "search", "web", "google", "know", "like", "going", "it", "it's", "there", "jarvis", "hey", "okay", "ok",
+  "um", "uh", "just",
+}
+
+
+def normalize(vectors):
+  vectors = np.asarray(vectors, dtype=np.float32)
+  return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-9)
+
+
+def extract_topic(text, max_words=10):
+  """Search query for a command: its words without question and filler words, in order, at most max_words."""
+  words = re.findall(r"[a-z0-9][a-z0-9'.\-]*", text.lower())
+  topic = [word.rstrip(".") for word in words if word.rstrip(".") not in _QUERY_FILLER]
+  return " ".join(topic[:max_words]) or text.lower().strip()
+
+
+class IntentClassifier:
+  """
+  Local stand-in for LLMWrapper.decide_websearch_memory. The labelled exemplars in INTENT_EXEMPLARS are
+  embedded once with the RAG's sentence embeddings, and the INTENT_TOP_K nearest ones vote, weighted by
+  similarity, on whether a command needs a web search and whether it holds something to remember.
+
+  classify() returns None when the LLM classifier should decide instead:
+    - the nearest exemplar is further than INTENT_MIN_SIMILARITY, nothing like the command was labelled
+    - either vote is not at least INTENT_MIN_CONFIDENCE one sided
+    - the command holds a memory, which needs the LLM to be written down
+  """
+
+  TASKS = ("websearch", "memory")
+
+  def __init__(self, embeddings, exemplars_path=INTENT_EXEMPLARS):
+    self.logger = logging.getLogger("speech_to_speech.intent_classifier")
+    self.embeddings = embeddings
+    if not os.path.isabs(exemplars_path):
+      project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+      exemplars_path = os.path.join(project_root_dir, exemplars_path)
+
+    with open(exemplars_path, "r", encoding="utf-8") as exemplars_file:
+      exemplars = json.load(exemplars_file)
+
+    self.vectors = {}
+    self.labels = {}
+    for task in self.TASKS:
+      texts = exemplars[task]["yes"] + exemplars[task]["no"]
+      self.vectors[task] = normalize(self.embeddings.embed_documents(texts))
+      self.labels[task] = np.array([True] * len(exemplars[task]["yes"]) + [False] * len(exemplars[task]["no"]))
+    self.logger.debug(f"Embedded {sum(len(labels) for labels in self.labels.values())} intent exemplars")
+
+
+  def _vote(self, task, vector):
+    """(label, confidence in [0, 1], similarity of the nearest exemplar)"""
+    similarities = self.vectors[task] @ vector
+    nearest = np.argsort(similarities)[-INTENT_TOP_K:]
+    weights = np.clip(similarities[nearest], 0, None)
+    labels = self.labels[task][nearest]
+
+    yes = float(weights[labels].sum())
+    no = float(weights[~labels].sum())
+    confidence = abs(yes - no) / (yes + no) if yes + no > 0 else 0.0
+    return yes > no, confidence, float(similarities[nearest[-1]])
+
+
+  def scores(self, text):
+    """{task: (label, confidence, nearest similarity)}, for benchmarking the votes themselves."""
+    vector = normalize(self.embeddings.embed_query(text))
+    return {task: self._vote(task, vector) for task in self.TASKS}
+
+
+  def classify(self, text):
+    """((decision, topic), memory) in decide_websearch_memory's format, or None to ask the LLM."""
+    scores = self.scores(text)
+    search, search_confidence, nearest = scores["websearch"]
+    memory, memory_confidence, _ = scores["memory"]
+
+    if nearest < INTENT_MIN_SIMILARITY or search_confidence < INTENT_MIN_CONFIDENCE:
+      return None
+    if memory or memory_confidence < INTENT_MIN_CONFIDENCE:
+      return None
+
+    if search:
+      return ("yes", extract_topic(text)), "None"
+    return ("no", "none"), "None"
@@ -0,0 +1,146 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from multiprocessing import Condition, Value
+
+
+class InterruptSignal:
+  """
+  Barge-in signal shared between the voice, pipeline and speech processes.
+
+  `value` is the number of pending interrupts (fired by the recorder, consumed by the speech worker when
+  it finishes the interrupted turn). Every fire also bumps a generation number and notifies a shared condition,
+  so threads can block on the signal instead of polling it and subscribers are called as soon as the
+  recorder decides to interrupt.
+  """
+
+  def __init__(self):
+    self._condition = Condition()
+    self._count = Value("i", 0, lock=False)
+    self._generation = Value("i", 0, lock=False)
+    self._fired_at = Value("d", 0.0, lock=False) # time.monotonic() of the last fire
+    self._init_local()
+
+
+  def _init_local(self):
+    # subscribers and the watcher thread belong to the process that created them
+    self.logger = logging.getLogger("speech_to_speech.interrupt_signal")
+    self._owner_pid = os.getpid()
+    self._subscribers = {}
+    self._subscriber_ids = itertools.count()
+    self._subscribers_lock = threading.Lock()
+    self._watcher = None
+    self._closed = False
+
+
+  def __getstate__(self):
+    return {
+      "_condition": self._condition,
+      "_count": self._count,
+      "_generation": self._generation,
+      "_fired_at": self._fired_at,
+    }
+
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._init_local()
+
+
+  @property
+  def value(self):
+    return self._count.value
+
+
+  @property
+  def generation(self):
+    return self._generation.value
+
+
+  @property
+  def fired_at(self):
+    return self._fired_at.value
+
+
+  def is_set(self):
+    return self._count.value > 0
+
+
+  def fire(self):
+    with self._condition:
+      self._count.value += 1
+      self._generation.value += 1
+      self._fired_at.value = time.monotonic()
+      self._condition.notify_all()
+
+
+  def consume(self):
+    """Consumes one pending interrupt, returns False if there was none."""
+    with self._condition:
+      if self._count.value <= 0:
+        return False
+      self._count.value -= 1
+      return True
+
+
+  def wait(self, timeout=None):
+    """Blocks until an interrupt is pending, returns False on timeout."""
+    with self._condition:
+      return self._condition.wait_for(lambda: self._count.value > 0, timeout)
+
+
+  def subscribe(self, callback):
+    """
+    Calls callback() from a watcher thread every time the signal fires. Returns an id for unsubscribe().
+    Callbacks run one after the other, so they must not block.
+    """
+    if self._owner_pid != os.getpid():
+      # forked child, the parent's watcher thread does not exist here
+      self._init_local()
+
+    with self._subscribers_lock:
+      subscriber_id = next(self._subscriber_ids)
+      self._subscribers[subscriber_id] = callback
+      if self._watcher is None and not self._closed:
+        self._watcher = threading.Thread(target=self._watch, args=(self.generation,), daemon=True)
+        self._watcher.start()
+
+    return subscriber_id
+
+
+  def unsubscribe(self, subscriber_id):
+    with self._subscribers_lock:
+      self._subscribers.pop(subscriber_id, None)
+
+
+  def close(self):
+    """Stops the watcher thread, e.g. when a server session ends. Subscribers are not called any more."""
+    with self._subscribers_lock:
+      self._subscribers.clear()
+      self._closed = True
+      watcher = self._watcher
+    if watcher is None or watcher is threading.current_thread():
+      return
+    with self._condition:
+      self._condition.notify_all()
+    watcher.join()
+
+
+  def _watch(self, seen_generation):
+    while True:
+      with self._condition:
+        self._condition.wait_for(lambda: self._closed or self._generation.value != seen_generation)
+        if self._closed:
+          return
+        seen_generation = self._generation.value
+
+      with self._subscribers_lock:
+        callbacks = list(self._subscribers.values())
+
+      for callback in callbacks:
+        try:
+          callback()
+        except Exception as e:
+          self.logger.error(f"Interrupt subscriber failed: {e}")
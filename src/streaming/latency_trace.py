@@ -0,0 +1,212 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from config import *
+
+# Trace of the turn currently being processed in this process, used by components that do not see the Turn object
+_active_trace = None
+
+
+class TurnTrace:
+  """
+  Monotonic timestamps for every stage of one turn. Instant events are stored in `events`,
+  stages with a duration are stored in `spans` as (start, end). Only the first occurrence of an
+  event or span is kept, so "first token"/"first chunk" style events can be marked in loops. Per-turn
+  measurements that are not times, like the cached prompt prefix ratio, are stored in `metrics`.
+  Picklable so it can travel with the Turn across the process boundary.
+  """
+
+  def __init__(self):
+    self.wall_clock_start = time.time()
+    self.events = {}
+    self.spans = {}
+    self.metrics = {}
+
+  def mark(self, event, timestamp=None):
+    if event not in self.events:
+      self.events[event] = timestamp if timestamp is not None else time.monotonic()
+
+  @contextmanager
+  def span(self, stage):
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      if stage not in self.spans:
+        self.spans[stage] = (start, time.monotonic())
+
+  def note(self, name, value):
+    self.metrics[name] = value
+
+  def forget(self, *events):
+    for event in events:
+      self.events.pop(event, None)
+
+  def merge(self, other):
+    """Adds the events and spans recorded by another process for the same turn."""
+    for event, timestamp in other.events.items():
+      self.events.setdefault(event, timestamp)
+    for stage, times in other.spans.items():
+      self.spans.setdefault(stage, times)
+    for name, value in other.metrics.items():
+      self.metrics.setdefault(name, value)
+
+  def to_record(self, turn_id, text):
+    """Compact record with all times in milliseconds relative to the earliest timestamp."""
+    timestamps = list(self.events.values()) + [start for start, _ in self.spans.values()]
+    origin = min(timestamps) if timestamps else 0
+
+    return {
+      "turn_id": turn_id,
+      "time": self.wall_clock_start,
+      "text": text,
+      "events": {name: round((t - origin) * 1000, 2) for name, t in sorted(self.events.items(), key=lambda x: x[1])},
+      "spans": {name: [round((s - origin) * 1000, 2), round((e - origin) * 1000, 2)] for name, (s, e) in sorted(self.spans.items(), key=lambda x: x[1][0])},
+      "metrics": self.metrics,
+    }
+
+
+def set_active_trace(trace):
+  global _active_trace
+  _active_trace = trace
+
+
+def get_active_trace():
+  return _active_trace
+
+
+def mark(event):
+  """Marks an event on the active trace of this process, no-op if tracing is off or no turn is active."""
+  trace = _active_trace
+  if trace is not None:
+    trace.mark(event)
+
+
+def mark_at(event, timestamp):
+  """Marks an event that happened earlier, timestamp must come from time.monotonic()."""
+  trace = _active_trace
+  if trace is not None:
+    trace.mark(event, timestamp)
+
+
+def note(name, value):
+  """Records a per-turn measurement on the active trace, no-op if tracing is off or no turn is active."""
+  trace = _active_trace
+  if trace is not None:
+    trace.note(name, value)
+
+
+def forget(*events):
+  """Drops events from the active trace, e.g. those marked by a speculative reply that was discarded."""
+  trace = _active_trace
+  if trace is not None:
+    trace.forget(*events)
+
+
+@contextmanager
+def span(stage):
+  trace = _active_trace
+  if trace is None:
+    yield
+    return
+
+  with trace.span(stage):
+    yield
+
+
+class LatencyTraceWriter:
+  """Appends one JSON line per finished turn to LATENCY_TRACE_FILE."""
+
+  def __init__(self):
+    self.logger = logging.getLogger("speech_to_speech.latency_trace")
+    project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    self.trace_path = os.path.join(project_root_dir, LATENCY_TRACE_FILE)
+    self.lock = threading.Lock()
+
+  def write(self, turn):
+    if not LATENCY_TRACE or turn.trace is None:
+      return
+
+    record = turn.trace.to_record(turn.turn_id, turn.text)
+    record["interrupted"] = turn.interrupted
+
+    try:
+      with self.lock:
+        os.makedirs(os.path.dirname(self.trace_path), exist_ok=True)
+        with open(self.trace_path, "a", encoding="utf-8") as trace_file:
+          trace_file.write(json.dumps(record) + "\n")
+    except OSError as e:
+      self.logger.error(f"Failed to write latency trace: {e}")
+
+
+def percentile(values, pct):
+  """Nearest-rank percentile of a list of numbers."""
+  if not values:
+    return None
+  ordered = sorted(values)
+  rank = max(1, math.ceil(pct / 100 * len(ordered)))
+  return ordered[rank - 1]
+
+
+def load_trace_records(trace_path, offset=0):
+  """Reads trace records appended after byte offset."""
+  records = []
+  if not os.path.exists(trace_path):
+    return records
+
+  with open(trace_path, "r", encoding="utf-8") as trace_file:
+    trace_file.seek(offset)
+    for line in trace_file:
+      line = line.strip()
+      if line:
+        records.append(json.loads(line))
+
+  return records
+
+
+def stage_latencies(record):
+  """
+  Flattens one trace record into stage -> milliseconds. Events are measured from end of speech
+  (the recorder's endpoint decision), spans are reported as durations.
+  """
+  events = record["events"]
+  spans = record["spans"]
+  latencies = {}
+
+  if "interrupt_fired" in events and "playback_stopped" in events:
+    latencies["interrupt_to_silence"] = events["playback_stopped"] - events["interrupt_fired"]
+
+  reference = events.get("end_of_speech")
+  if reference is not None:
+    for name, value in events.items():
+      if name not in ("end_of_speech", "wake_word", "last_voice", "interrupt_fired", "playback_stopped"):
+        latencies[name] = value - reference
+    if "last_voice" in events:
+      latencies["endpoint_wait"] = reference - events["last_voice"]
+    if "playback_first_sample" in events:
+      latencies["end_to_end"] = events["playback_first_sample"] - reference
+
+  for name, (start, end) in spans.items():
+    latencies[f"{name} (span)"] = end - start
+
+  return latencies
+
+
+def summarize_traces(records):
+  """
+  Returns {stage: (count, p50, p95)} over the given trace records. Interrupted turns only contribute
+  their interrupt-to-silence time, their other stages were cut short.
+  """
+  samples = {}
+  for record in records:
+    latencies = stage_latencies(record)
+    if record.get("interrupted"):
+      latencies = {name: value for name, value in latencies.items() if name == "interrupt_to_silence"}
+    for name, value in latencies.items():
+      samples.setdefault(name, []).append(value)
+
+  return {name: (len(values), percentile(values, 50), percentile(values, 95)) for name, values in samples.items()}
@@ -1,29 +1,37 @@
 from openai import OpenAI
 import logging
-import json
 import re
 import os
 import time
 from datetime import datetime
 from config import *
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.utils import cancel_completion_stream
+from src.streaming import latency_trace
+from src.streaming.interrupt_signal import InterruptSignal
+from src.streaming.prompt_layout import PromptLayout, load_token_counter
+from src.streaming.chat_history import ChatHistoryStore
 
 
 class LLMWrapper():
-  def __init__(self, interrupt_count:SynchronizedClass, memories = []):
+  def __init__(self, interrupt_signal: InterruptSignal, memories = [], persist_history = True):
     self.logger = logging.getLogger("speech_to_speech.llm_wrapper")
-    self.interrupt_count = interrupt_count
+    # server sessions keep their history in memory only, the local assistant persists it to CHAT_HISTORY_FILE
+    self.persist_history = persist_history
+    self.interrupt_signal = interrupt_signal
     self.interrupt_context = []
 
     self.api = os.getenv("OPENAI_API")
     self.api_key = os.getenv("OPENAI_API_KEY")
     self.model = LLM_MODEL
-    self.global_chat_history = []
-    self.current_chat_history = []
-    self.current_chat_history_length = 0
+    self.history_store = None
+    self.last_response = None
+    self.unsaved_exchange = None # (interrupt_text, timestamp, response) of a reply not saved yet
+    self.wasted_tokens = 0 # tokens streamed for replies that were cancelled by an interrupt
     project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    self.chat_history_path = os.path.join(project_root_dir, "data", "chat_history.json")
-    self.max_tokens = int(MAX_TOKENS * 0.75)
+    self.chat_history_path = os.path.join(project_root_dir, CHAT_HISTORY_FILE)
+    self.legacy_chat_history_path = os.path.join(project_root_dir, "data", "chat_history.json")
+    # prompt budget, the rest of the context window is left for the reply
+    self.max_tokens = MAX_TOKENS - LLM_REPLY_TOKENS
     
     self.memories = memories
     self.initial_prompt = INITIAL_PROMPT
@@ -33,7 +41,6 @@ class LLMWrapper():
     if TTS_CHOICE == "kokoro":
       self.initial_prompt += "Here are some rules regarding how the output should be formatted such that it could work with text-to-speech. 1. To adjust intonation, try punctuation ;:,.!?—…\"()“” or stress ˈ and ˌ"
     self.initial_prompt = self.initial_prompt.replace("\n", "")
-    self.initial_prompt_length = len(self.initial_prompt.split(" "))
     
     self.websearch_memory_classifier_prompt = """
     You are a classifier that performs TWO tasks for each user prompt.    
@@ -86,38 +93,40 @@ class LLMWrapper():
     - Second line = memory extraction result
     """
     
+    # sentence ends on terminal punctuation followed by whitespace, or on a line break
+    self.sentence_boundary = re.compile(r"([.!?…][\"')\]]*)\s+|\n+")
+    self.min_sentence_length = 20
+
     self.client = OpenAI(base_url=self.api, api_key=self.api_key)
+    self.prompt_layout = PromptLayout(self.initial_prompt, self.memories, self.max_tokens, load_token_counter())
     
-    self._load_convo_history()
+    if self.persist_history:
+      self.history_store = ChatHistoryStore(self.chat_history_path, legacy_path=self.legacy_chat_history_path)
+      self._load_convo_history()
     
     
-  def _load_convo_history(self):
-    self.logger.debug("Loading conversation history")
+  def close(self):
+    """Writes the chat history records still queued."""
+    if self.history_store is not None:
+      self.history_store.close()
 
-    chat_history_file = open(self.chat_history_path, 'r', encoding="utf-8")
-    self.global_chat_history = json.load(chat_history_file)["history"]
-    chat_history_file.close()
-    
-    index = len(self.global_chat_history) - 1
-    while index > -1 and ((self.current_chat_history_length + self.initial_prompt_length) < self.max_tokens ):
-      cur_message = self.global_chat_history[index]
-      self.current_chat_history.insert(0, cur_message["message"])
-      self.current_chat_history_length += cur_message["length"]
-      index -= 1
-      
-    # print(self.current_chat_history)
 
+  def _load_convo_history(self):
+    self.logger.debug("Loading conversation history")
 
-  def _write_chat_history(self):
-    self.logger.debug(f"Saving conversation history")
+    # newest first from the end of the log, counted again since older logs stored word counts
+    history = []
+    history_tokens = 0
+    room = self.prompt_layout.history_room()
+    for record in self.history_store.tail():
+      cur_message = record["message"]
+      tokens = self.prompt_layout.message_tokens(cur_message["content"])
+      if history_tokens + tokens > room:
+        break
+      history.append((cur_message, tokens))
+      history_tokens += tokens
 
-    chat_history_file = open(self.chat_history_path, 'w', encoding="utf-8")
-    json.dump({
-        "history" : self.global_chat_history
-      },
-      chat_history_file
-    )
-    chat_history_file.close()
+    self.prompt_layout.load_history(reversed(history))
 
 
   def _filter_think(self, text):
@@ -182,11 +191,14 @@ class LLMWrapper():
       # max_tokens=150,
     )
 
+    tokens_read = 0
     for chunk in stream:
-      if self.interrupt_count.value > 0:
-        # On interrupt
-        return None, None
+      if self.interrupt_signal.is_set():
+        # On interrupt, abort the request so the server stops generating
+        self.wasted_tokens += cancel_completion_stream(stream, tokens_read, self.logger, "Websearch/memory classifier")
+        return (None, None), None
       
+      tokens_read += 1
       data = chunk.choices[0].delta.content
       if data is not None:
         response_text += data
@@ -208,22 +220,16 @@ class LLMWrapper():
     return (require_search.lower(), topic.lower()), memory
 
 
-  def send_to_llm(self, text, timestamp, memory = "None", context = ""):
+  def add_memory(self, memory, timestamp):
+    self.prompt_layout.add_memory(f"{datetime.fromtimestamp(timestamp).strftime("%m-%d-%y %H:%M:%S")} - {memory}")
+
+
+  def _build_prompt(self, text, timestamp, memory = "None", context = ""):
     if not ENABLE_THINK and "instruct" not in LLM_MODEL:
       text = text + " /no_think" # disable reasoning
 
-    text_length = len(text.split(" "))
-    
     if memory != "None":
-      self.memories.append(f"{datetime.fromtimestamp(timestamp).strftime("%m-%d-%y %H:%M:%S")} - {memory}")
-    
-    memories_text = ""
-    for memory in self.memories:
-      memories_text += f"<memory>{memory}</memory>\n"
-
-    init_prompt_mem = self.initial_prompt + "\n\n" + memories_text
-    init_prompt_mem_length = len(init_prompt_mem.split(" "))
-
+      self.add_memory(memory, timestamp)
 
     prompt_modification = ""
     # if interrupted, let LLM know
@@ -232,27 +238,165 @@ class LLMWrapper():
         prompt_modification += "<interrupt>"+ entry + "</interrupt>\n"
         
     interrupt_text = prompt_modification + text
-    interrupt_text_length = len(interrupt_text.replace("\n", " ").split(" "))
-    
-    self.current_chat_history.append(
-      {"role": "user", "content": interrupt_text}
-    )
-    
-    self.current_chat_history_length += interrupt_text_length
-    
-    while self.current_chat_history and ((self.current_chat_history_length + init_prompt_mem_length) >= self.max_tokens ):
-      removed_chat_length = len(self.current_chat_history.pop(0).split(" "))
-      self.current_chat_history_length -= removed_chat_length
+
+    # the context goes after the user's text so the message still starts the way it is stored in the history
+    prompt_messages = self.prompt_layout.build(interrupt_text, context)
+
+    return prompt_messages, interrupt_text
+
+
+  def _save_response(self, interrupt_text, timestamp, response_text):
+    response_timestamp = time.time()
+    interrupt_text_tokens, response_tokens = self.prompt_layout.append(interrupt_text, response_text)
     
-    # print(json.dumps(self.current_chat_history, indent=2))
-    prompt_messages = [{"role": "system", "content": init_prompt_mem}]
-    prompt_messages.extend(self.current_chat_history)
+    if self.persist_history:
+      # written by the store's thread, the reply does not wait for the disk
+      self.history_store.append([
+        {"message": {"role": "user", "content": interrupt_text}, "length": interrupt_text_tokens, "timestamp": timestamp},
+        {"message": {"role": "assistant", "content": response_text}, "length": response_tokens, "timestamp": response_timestamp},
+      ])
+    self.last_response = response_text
     
-    # if context exists, add to user prompt
-    if context != "":
-      prompt_modification = "<context>"+ context.replace("\n", "") + "</context>\n\n"
+    self.logger.debug("Response returned")
+
+
+  def save_exchange(self):
+    """Saves the reply of a send_to_llm call made with save=False, e.g. once a speculative reply is confirmed."""
+    if self.unsaved_exchange is not None:
+      self._save_response(*self.unsaved_exchange)
+      self.unsaved_exchange = None
+
+
+  def _clean_response(self, text):
+    text = self._filter_think(text)
+    text = self._filter_emoji(text)
+    text = self._filter_markdown(text)
+
+    return text
+
+
+  def _pop_sentences(self, text):
+    """Split completed sentences off the front of the streamed text, returns (sentences, remainder)."""
+    sentences = []
+    start = 0
+
+    for match in self.sentence_boundary.finditer(text):
+      end = match.end(1) if match.group(1) else match.start()
+      sentences.append(text[start:end])
+      start = match.end()
+
+    return sentences, text[start:]
+
+
+  def _merge_sentences(self, pending_sentence, sentences):
+    """Cleans the sentences and merges very short ones with the next to keep TTS prosody natural, returns (chunks, remainder)."""
+    chunks = []
+    for sentence in sentences:
+      pending_sentence += self._filter_markdown(self._filter_emoji(sentence)) + " "
+      if len(pending_sentence.strip()) >= self.min_sentence_length:
+        chunks.append(pending_sentence.strip())
+        pending_sentence = ""
+    return chunks, pending_sentence
+
+
+  def _stopped(self, should_stop):
+    return self.interrupt_signal.is_set() or (should_stop is not None and should_stop())
+
+
+  def _stream_sentences(self, prompt_messages, interrupt_text, timestamp, save, should_stop):
+    """Generator that yields cleaned sentences while the completion is still streaming."""
+    response_text = ""
+    pending_text = ""
+    pending_sentence = ""
+    # a reasoning model's chat template may open the think block itself, then only "</think>" is streamed
+    inside_think = ENABLE_THINK and "instruct" not in LLM_MODEL
     
-    prompt_messages[-1]["content"] =  prompt_modification + prompt_messages[-1]["content"]
+    stream = self.client.chat.completions.create(
+      model=self.model,
+      messages=prompt_messages,
+      temperature=TEMPERATURE,
+      top_p=TOP_P,
+      stream=True
+      # max_tokens=150,
+    )
+    tokens_read = 0
+    completed = False
+    try:
+      for chunk in stream:
+        if self._stopped(should_stop):
+          # On interrupt, or once the caller gave up on the reply
+          return
+
+        tokens_read += 1
+        data = chunk.choices[0].delta.content
+        if data is None:
+          continue
+
+        latency_trace.mark("llm_first_token")
+        response_text += data
+        pending_text += data
+
+        # hold back reasoning until the think block is closed
+        if not inside_think and pending_text.lstrip().startswith("<think>"):
+          inside_think = True
+        if inside_think:
+          index = pending_text.find("</think>")
+          if index == -1:
+            continue
+          pending_text = pending_text[index + len("</think>"):]
+          inside_think = False
+        pending_text = pending_text.replace("</think>", "")
+
+        sentences, pending_text = self._pop_sentences(pending_text)
+        chunks, pending_sentence = self._merge_sentences(pending_sentence, sentences)
+        for chunk in chunks:
+          latency_trace.mark("llm_first_sentence")
+          yield chunk
+      completed = True
+      latency_trace.mark("llm_done")
+
+    finally:
+      # reached on interrupt or when the consumer closes the generator early
+      if not completed:
+        self.wasted_tokens += cancel_completion_stream(stream, tokens_read, self.logger, "LLM response")
+
+    # like _filter_think, a reply that never closed a think block is all answer unless it opened one
+    if inside_think and "<think>" not in response_text:
+      inside_think = False
+      sentences, pending_text = self._pop_sentences(pending_text)
+      chunks, pending_sentence = self._merge_sentences(pending_sentence, sentences)
+      for chunk in chunks:
+        latency_trace.mark("llm_first_sentence")
+        yield chunk
+    pending_sentence += self._filter_markdown(self._filter_emoji(pending_text))
+    if pending_sentence.strip() and not inside_think:
+      latency_trace.mark("llm_first_sentence")
+      yield pending_sentence.strip()
+
+    self._finish_response(interrupt_text, timestamp, self._clean_response(response_text), save)
+
+
+  def _finish_response(self, interrupt_text, timestamp, response_text, save):
+    if save:
+      self._save_response(interrupt_text, timestamp, response_text)
+    else:
+      self.unsaved_exchange = (interrupt_text, timestamp, response_text)
+
+
+  def send_to_llm(self, text, timestamp, memory = "None", context = "", stream = False, save = True, should_stop = None):
+    """
+    Sends prompt to the LLM. If stream is True, returns a generator yielding cleaned sentences as they complete,
+    the full response is stored in self.last_response once the generator is exhausted.
+    With save=False the exchange is kept out of the history until save_exchange() is called.
+    should_stop is checked on every chunk like the interrupt signal, the completion is cancelled and nothing is
+    saved once it returns True.
+    """
+    prompt_messages, interrupt_text = self._build_prompt(text, timestamp, memory, context)
+    self.last_response = None
+    self.unsaved_exchange = None
+
+    if stream:
+      return self._stream_sentences(prompt_messages, interrupt_text, timestamp, save, should_stop)
     
     # print(prompt_messages)
     response_text = ""
@@ -265,41 +409,21 @@ class LLMWrapper():
       stream=True
       # max_tokens=150,
     )
+    tokens_read = 0
     for chunk in stream:
-      if self.interrupt_count.value > 0:
-        # On interrupt
+      if self._stopped(should_stop):
+        # On interrupt, abort the request so the server stops generating
+        self.wasted_tokens += cancel_completion_stream(stream, tokens_read, self.logger, "LLM response")
         return None
 
+      tokens_read += 1
       data = chunk.choices[0].delta.content
       if data is not None:
+        latency_trace.mark("llm_first_token")
         response_text += data
-    response_timestamp = time.time()
-    response_text = self._filter_think(response_text)
-    response_text = self._filter_emoji(response_text)
-    response_text = self._filter_markdown(response_text)
+    latency_trace.mark("llm_done")
+    response_text = self._clean_response(response_text)
     
-    response_length = len(response_text.split(" "))
-    
-    self.global_chat_history.append({
-      "message": {"role": "user", "content": interrupt_text},
-      "length": interrupt_text_length,
-      "timestamp": timestamp
-    })
-    self.global_chat_history.append({
-      "message": {"role": "assistant", "content": response_text},
-      "length": response_length,
-      "timestamp": response_timestamp
-    })
-    self.current_chat_history.append(
-      {"role": "assistant", "content": response_text}
-    )
-    
-    self._write_chat_history()
-    
-    self.logger.debug("Response returned")
+    self._finish_response(interrupt_text, timestamp, response_text, save)
 
     return response_text
-    
-    
-    
-    
\ No newline at end of file
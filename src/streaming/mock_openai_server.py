@@ -0,0 +1,127 @@
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenAIServer:
+  """
+  Minimal OpenAI-compatible streaming server used by replay.py in place of LM Studio.
+  Serves /v1/chat/completions (LLMWrapper) and /v1/completions (TTSOrpheus speech tokens)
+  with a fixed per-token delay so latency numbers are reproducible.
+  """
+
+  def __init__(self, host="127.0.0.1", port=0, token_delay=0.02, search_keywords=None):
+    self.logger = logging.getLogger("speech_to_speech.mock_openai_server")
+    self.host = host
+    self.port = port
+    self.token_delay = token_delay
+    # user prompts containing any of these words are classified as needing a web search
+    self.search_keywords = set(search_keywords or [])
+
+    self.cancelled_streams = 0
+    self.completed_streams = 0
+    self._server = None
+    self._thread = None
+
+
+  def start(self):
+    handler = self._make_handler()
+    self._server = ThreadingHTTPServer((self.host, self.port), handler)
+    self._server.daemon_threads = True
+    self.port = self._server.server_address[1]
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+
+    return f"http://{self.host}:{self.port}/v1"
+
+
+  def stop(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+      self._server = None
+
+
+  def _classify(self, text):
+    words = set(re.findall(r"\w+", text.lower()))
+    if words & self.search_keywords:
+      topic = " ".join(word for word in re.findall(r"\w+", text) if word.lower() in self.search_keywords)
+      return f"yes+-+{topic}\n<deep_memory:None>"
+
+    return "no+-+None\n<deep_memory:None>"
+
+
+  def _chat_tokens(self, body):
+    messages = body.get("messages", [])
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    user = messages[-1]["content"] if messages else ""
+
+    if "You are a classifier" in system:
+      return [self._classify(user)]
+
+    # strip the <context>/<interrupt> blocks the pipeline prepends
+    question = re.sub(r"<(context|interrupt)>.*?</\1>", "", user, flags=re.DOTALL).strip()
+    reply = (
+      f"Certainly. You asked: {question}. "
+      "This is a placeholder reply from the replay server. "
+      "It spans a few sentences so that sentence streaming and speech synthesis can be measured. "
+      "Anything else I can help with?"
+    )
+    return [word + " " for word in reply.split(" ")]
+
+
+  def _speech_tokens(self, body):
+    # roughly 4 audio frames (7 tokens each) per word of the prompt
+    words = max(1, len(body.get("prompt", "").split(" ")))
+    return [f"<custom_token_{10 + (i % 7) * 4096 + random.randint(1, 4095)}>" for i in range(words * 4 * 7)]
+
+
+  def _make_handler(self):
+    server = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def log_message(self, format, *args):
+        pass
+
+      def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        if self.path.endswith("/chat/completions"):
+          tokens = server._chat_tokens(body)
+          make_chunk = lambda token: {
+            "id": "replay", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model", ""),
+            "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+          }
+        elif self.path.endswith("/completions"):
+          tokens = server._speech_tokens(body)
+          make_chunk = lambda token: {
+            "id": "replay", "object": "text_completion", "created": int(time.time()), "model": body.get("model", ""),
+            "choices": [{"index": 0, "text": token, "finish_reason": None, "logprobs": None}]
+          }
+        else:
+          self.send_error(404)
+          return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        try:
+          for token in tokens:
+            time.sleep(server.token_delay)
+            self.wfile.write(f"data: {json.dumps(make_chunk(token))}\n\n".encode("utf-8"))
+            self.wfile.flush()
+          self.wfile.write(b"data: [DONE]\n\n")
+          self.wfile.flush()
+          server.completed_streams += 1
+        except (BrokenPipeError, ConnectionResetError):
+          # client closed the stream, stop generating like a real inference server would
+          server.cancelled_streams += 1
+
+    return Handler
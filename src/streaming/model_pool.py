@@ -0,0 +1,278 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+import wave
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import Process, Queue
+from config import *
+from src.streaming.interrupt_signal import InterruptSignal
+from src.streaming.logging_config import setup_worker_logging, get_logger
+from src.streaming.latency_trace import percentile
+
+
+def create_tts(interrupt_signal: InterruptSignal):
+  """Creates the engine selected by TTS_CHOICE. Engines are imported here since each one pulls in torch."""
+  if TTS_CHOICE == "coqui":
+    from src.streaming.tts_coqui import TTSCoqui
+    return TTSCoqui(interrupt_signal=interrupt_signal)
+  elif TTS_CHOICE == "orpheus":
+    from src.streaming.tts_orpheus import TTSOrpheus
+    return TTSOrpheus(interrupt_signal=interrupt_signal)
+  elif TTS_CHOICE == "kokoro":
+    from src.streaming.tts_kokoro import TTSKokoro
+    return TTSKokoro(interrupt_signal=interrupt_signal)
+  elif TTS_CHOICE == "xtts":
+    from src.streaming.tts_xtts import TTSXtts
+    return TTSXtts(interrupt_signal=interrupt_signal)
+
+  raise ValueError(f"Unknown TTS_CHOICE: {TTS_CHOICE}")
+
+
+class STTService:
+  """
+  Transcribes raw 16 kHz int16 PCM sent by a server session or a voice worker. transcribe_pcm requests that
+  arrive within STT_BATCH_WINDOW of each other are decoded as one batch (see pool_worker).
+  """
+
+  batch_methods = {"transcribe_pcm": "transcribe_pcm_batch"}
+  batch_size = STT_BATCH_SIZE
+  batch_window = STT_BATCH_WINDOW
+
+  def __init__(self, device, models_per_node=1):
+    from src.streaming.stt_whisper import STTWhisper
+    # on cpu the pool's workers share the cores instead of each one starting a thread per core
+    self.whisper = STTWhisper(vad_active=True, device=device, models_per_node=models_per_node)
+
+  def transcribe_pcm(self, pcm_bytes, spans=None):
+    return self.whisper.transcribe_text(pcm_bytes, spans)
+
+
+  def transcribe_pcm_batch(self, requests):
+    return self.whisper.transcribe_batch([(args[0], args[1] if len(args) > 1 else None) for args in requests])
+
+
+  def transcribe_words(self, pcm, prompt=None, final=False):
+    """Words as (start, end, word) tuples, faster-whisper's Word objects stay in the worker."""
+    return [(word.start, word.end, word.word) for word in self.whisper.transcribe_words(pcm, prompt, final)]
+
+
+class TTSService:
+  """Synthesizes one sentence at a time and returns (int16 pcm bytes, sample rate)."""
+
+  def __init__(self, interrupt_signal):
+    self.tts = create_tts(interrupt_signal)
+
+  def synthesize_pcm(self, text):
+    output_buffer, _ = self.tts.synthesize(text)
+    output_buffer.seek(0)
+    with wave.open(output_buffer, "rb") as wav_file:
+      return wav_file.readframes(wav_file.getnframes()), wav_file.getframerate()
+
+
+def create_service(kind, interrupt_signal, device, pool_size=1):
+  if kind == "stt":
+    return STTService(device, models_per_node=pool_size)
+  elif kind == "tts":
+    return TTSService(interrupt_signal)
+  elif kind == "rag":
+    from src.streaming.rag_langchain import RAGLangchain
+    return RAGLangchain(interrupt_signal=interrupt_signal)
+  elif kind == "web":
+    from src.streaming.web_search import WebSearcher
+    return WebSearcher(interrupt_signal=interrupt_signal)
+
+  raise ValueError(f"Unknown pool kind: {kind}")
+
+
+def collect_batch(service, request_queue, first):
+  """
+  The first request plus the ones arriving within the service's batch_window, up to its batch_size, when the
+  service can batch the first one's method. Returns (batch, stop), stop is set when the shutdown sentinel was read.
+  """
+  batch = [first]
+  if first[1] not in getattr(service, "batch_methods", {}):
+    return batch, False
+
+  deadline = time.time() + service.batch_window
+  while len(batch) < service.batch_size:
+    timeout = deadline - time.time()
+    if timeout <= 0:
+      break
+    try:
+      request = request_queue.get(timeout=timeout)
+    except queue.Empty:
+      break
+    if request is None:
+      return batch, True
+    batch.append(request)
+  return batch, False
+
+
+def run_batch(service, batch):
+  """Yields (request_id, result, error), requests for a batchable method share one call."""
+  by_method = {}
+  for request in batch:
+    by_method.setdefault(request[1], []).append(request)
+
+  for method, requests in by_method.items():
+    batch_method = getattr(service, "batch_methods", {}).get(method)
+    if batch_method and len(requests) > 1:
+      try:
+        results = getattr(service, batch_method)([args for _, _, args, _ in requests])
+        for (request_id, _, _, _), result in zip(requests, results):
+          yield request_id, result, None
+      except Exception as e:
+        for request_id, _, _, _ in requests:
+          yield request_id, None, repr(e)
+      continue
+
+    for request_id, _, args, _ in requests:
+      try:
+        yield request_id, getattr(service, method)(*args), None
+      except Exception as e:
+        yield request_id, None, repr(e)
+
+
+def pool_worker(kind, device, pool_size, request_queue, result_queue, log_queue):
+  setup_worker_logging(log_queue)
+  logger = get_logger(f"speech_to_speech.{kind}_pool")
+  logger.debug(f"Loading {kind} model")
+
+  # requests are never cancelled inside a worker, sessions discard results of interrupted turns instead
+  service = create_service(kind, InterruptSignal(), device, pool_size)
+  result_queue.put((None, None, None, None))
+
+  stop = False
+  while not stop:
+    request = request_queue.get()
+    if request is None:
+      break
+
+    batch, stop = collect_batch(service, request_queue, request)
+    started = time.time()
+    # (seconds the request waited in the queue, requests decoded with it) for ModelPool.metrics
+    stats = {request_id: (started - submitted, len(batch)) for request_id, _, _, submitted in batch}
+    for request_id, result, error in run_batch(service, batch):
+      if error is not None:
+        logger.error(f"{kind} request {request_id} failed: {error}")
+      result_queue.put((request_id, result, error, stats[request_id]))
+
+
+class PoolProxy:
+  """Blocking stand-in for the pooled component, e.g. rag_pool.proxy().query(text) runs RAGLangchain.query in a worker."""
+
+  def __init__(self, pool):
+    self._pool = pool
+
+  def __getattr__(self, method):
+    return lambda *args: self._pool.call(method, *args)
+
+
+class ModelPool:
+  """
+  Worker processes that each load one copy of a model and serve requests from a shared queue, so the
+  models are loaded once for all server sessions. Requests are answered through futures.
+  """
+
+  def __init__(self, kind, size, log_queue, device=DEVICE):
+    self.logger = logging.getLogger(f"speech_to_speech.{kind}_pool")
+    self.kind = kind
+    self.size = size
+    self.device = device
+    self.log_queue = log_queue
+
+    self.request_queue = Queue()
+    self.result_queue = Queue()
+    self.workers = []
+    self.pending = {}
+    self.pending_lock = threading.Lock()
+    self.request_ids = itertools.count(1)
+    self.ready = threading.Semaphore(0)
+    self.dispatcher = None
+    self.wait_times = deque(maxlen=1000) # seconds recent requests queued before a worker took them
+    self.batch_sizes = deque(maxlen=1000)
+    self.completed = 0
+
+
+  def start(self):
+    for _ in range(self.size):
+      worker = Process(target=pool_worker, args=(self.kind, self.device, self.size, self.request_queue, self.result_queue, self.log_queue), daemon=True)
+      worker.start()
+      self.workers.append(worker)
+
+    self.dispatcher = threading.Thread(target=self._dispatch_results, daemon=True)
+    self.dispatcher.start()
+
+    # block until every worker has loaded its model
+    for _ in range(self.size):
+      self.ready.acquire()
+    self.logger.debug(f"{self.size} {self.kind} workers ready")
+
+
+  def _dispatch_results(self):
+    while True:
+      request_id, result, error, stats = self.result_queue.get()
+      if request_id is None:
+        self.ready.release()
+        continue
+
+      with self.pending_lock:
+        future = self.pending.pop(request_id, None)
+        self.wait_times.append(stats[0])
+        self.batch_sizes.append(stats[1])
+        self.completed += 1
+      if future is None:
+        continue
+
+      if error is None:
+        future.set_result(result)
+      else:
+        future.set_exception(RuntimeError(error))
+
+
+  def submit(self, method, *args):
+    future = Future()
+    request_id = next(self.request_ids)
+    with self.pending_lock:
+      self.pending[request_id] = future
+    self.request_queue.put((request_id, method, args, time.time()))
+    return future
+
+
+  def call(self, method, *args):
+    return self.submit(method, *args).result()
+
+
+  def proxy(self):
+    return PoolProxy(self)
+
+
+  def queue_depth(self):
+    with self.pending_lock:
+      return len(self.pending)
+
+
+  def metrics(self):
+    """Requests in flight, queue wait percentiles and mean batch size over the last 1000 requests."""
+    with self.pending_lock:
+      wait_ms = [wait * 1000 for wait in self.wait_times]
+      batch_sizes = list(self.batch_sizes)
+      metrics = {"queue_depth": len(self.pending), "completed": self.completed}
+
+    metrics["wait_p50_ms"] = percentile(wait_ms, 50)
+    metrics["wait_p95_ms"] = percentile(wait_ms, 95)
+    metrics["mean_batch"] = sum(batch_sizes) / len(batch_sizes) if batch_sizes else None
+    return metrics
+
+
+  def stop(self):
+    for _ in self.workers:
+      self.request_queue.put(None)
+    for worker in self.workers:
+      worker.join(timeout=5)
+      if worker.is_alive():
+        worker.terminate()
+    self.workers = []
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class PcmRingBuffer:
+  """
+  Fixed size int16 ring holding the most recent `capacity` samples. Every sample is written twice, at i and
+  i + capacity, so the buffered audio is always one contiguous slice and view() never copies.
+  Other dtypes work too, e.g. one bool per frame alongside the audio.
+  """
+
+  def __init__(self, capacity, dtype=np.int16):
+    self.capacity = capacity
+    self.dtype = dtype
+    self.data = np.zeros(2 * capacity, dtype=dtype)
+    self.pos = 0    # next write index in [0, capacity)
+    self.length = 0 # samples currently buffered
+
+
+  def __len__(self):
+    return self.length
+
+
+  def append(self, samples):
+    samples = np.asarray(samples, dtype=self.dtype).reshape(-1)
+    if samples.size > self.capacity:
+      samples = samples[-self.capacity:]
+    count = samples.size
+
+    end = self.pos + count
+    if end <= self.capacity:
+      self.data[self.pos:end] = samples
+      self.data[self.pos + self.capacity:end + self.capacity] = samples
+    else:
+      first = self.capacity - self.pos
+      self.data[self.pos:self.capacity] = samples[:first]
+      self.data[self.pos + self.capacity:] = samples[:first]
+      self.data[:count - first] = samples[first:]
+      self.data[self.capacity:self.capacity + count - first] = samples[first:]
+
+    self.pos = end % self.capacity
+    self.length = min(self.length + count, self.capacity)
+
+
+  def view(self):
+    """Buffered samples oldest first, without copying. Only valid until the next append."""
+    end = self.pos + self.capacity
+    return self.data[end - self.length:end]
+
+
+  def snapshot(self):
+    return self.view().copy()
+
+
+  def clear(self):
+    self.pos = 0
+    self.length = 0
+
+
+class PcmAccumulator:
+  """Growable int16 buffer for a recording of unknown length, doubles its storage instead of allocating per frame."""
+
+  def __init__(self, initial_capacity):
+    self.data = np.empty(max(1, initial_capacity), dtype=np.int16)
+    self.length = 0
+
+
+  def __len__(self):
+    return self.length
+
+
+  def append(self, samples):
+    samples = np.asarray(samples, dtype=np.int16)
+    end = self.length + samples.size
+    if end > self.data.size:
+      grown = np.empty(max(end, 2 * self.data.size), dtype=np.int16)
+      grown[:self.length] = self.data[:self.length]
+      self.data = grown
+
+    self.data[self.length:end] = samples
+    self.length = end
+
+
+  def view(self):
+    return self.data[:self.length]
+
+
+  def clear(self):
+    self.length = 0
@@ -0,0 +1,165 @@
+import logging
+import os
+from collections import deque
+from config import *
+from src.streaming import latency_trace
+
+# Chat template tokens around every message, "<|im_start|>role\n" ... "<|im_end|>\n" for Qwen's ChatML
+MESSAGE_OVERHEAD_TOKENS = 5
+# "<|im_start|>assistant\n" the server appends for the reply
+REPLY_PRIMER_TOKENS = 3
+
+
+def estimate_tokens(text):
+  """Rough count for when no tokenizer is available, about 4 characters per token for English."""
+  return len(text) // 4 + 1
+
+
+def load_token_counter(name=LLM_TOKENIZER):
+  """
+  Returns a function counting the tokens of a text with LLM_TOKENIZER, a Hugging Face repo or a local
+  tokenizer.json. Falls back to estimate_tokens when it is not set or cannot be loaded (e.g. offline).
+  """
+  logger = logging.getLogger("speech_to_speech.prompt_layout")
+  if not name:
+    return estimate_tokens
+  try:
+    from tokenizers import Tokenizer
+    tokenizer = Tokenizer.from_file(name) if os.path.exists(name) else Tokenizer.from_pretrained(name)
+  except Exception as e:
+    logger.warning(f"Could not load tokenizer {name}, estimating token counts instead: {e}")
+    return estimate_tokens
+
+  return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+class PromptLayout:
+  """
+  Assembles the chat prompt so consecutive turns share the longest possible byte-identical prefix, which the
+  LLM server can take from its prefix (KV) cache instead of prefilling it again:
+    system   initial prompt and the memories known at the last rebase, unchanged between rebases
+    history  past user and assistant messages exactly as they were sent, only appended to between trims
+    tail     the new user message followed by this turn's volatile parts: memories newer than the system
+             message and the RAG context. These are not kept in the history.
+  Token counts come from the LLM's own tokenizer and are computed once per message, the totals are kept
+  up to date as messages are added and evicted so checking the budget does not depend on the history length.
+  When the prompt no longer fits the budget, the oldest PROMPT_TRIM_BLOCK messages are dropped at once and the
+  new memories are folded into the system message. Dropping in blocks means the prefix is only rebuilt every
+  few turns instead of on every turn.
+  """
+
+  def __init__(self, initial_prompt, memories, budget, count_tokens=estimate_tokens):
+    self.logger = logging.getLogger("speech_to_speech.prompt_layout")
+    self.initial_prompt = initial_prompt
+    self.memories = list(memories)
+    self.budget = budget
+    self.count_tokens = count_tokens
+
+    self.history = deque() # (message, tokens)
+    self.history_tokens = 0
+    self.memory_delta_tokens = 0
+    self.prompt_tokens = 0 # exact size of the last prompt built, template tokens included
+    self.previous_prompt = [] # rendered messages of the previous prompt
+    self.cached_prefix_ratio = None
+    self._rebase()
+
+
+  def _rebase(self):
+    self.system_memories = len(self.memories)
+    memories_text = "".join(f"<memory>{memory}</memory>\n" for memory in self.memories)
+    self.system_prompt = self.initial_prompt + "\n\n" + memories_text
+    self.system_tokens = self.count_tokens(self.system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    self.memory_delta_tokens = 0
+
+
+  def add_memory(self, memory):
+    self.memories.append(memory)
+    self.memory_delta_tokens += self.count_tokens(f"<memory>{memory}</memory>\n")
+
+
+  def _memory_delta(self):
+    return "".join(f"<memory>{memory}</memory>\n" for memory in self.memories[self.system_memories:])
+
+
+  def message_tokens(self, content):
+    return self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+  def history_room(self):
+    """Tokens the history may use before the prompt is trimmed, when loading a saved conversation."""
+    return self.budget - self.system_tokens - REPLY_PRIMER_TOKENS
+
+
+  def load_history(self, messages):
+    """Fills the history from (message, tokens) pairs, oldest first, e.g. the tail of the saved conversation."""
+    for message, tokens in messages:
+      self.history.append((message, tokens))
+      self.history_tokens += tokens
+
+
+  def append(self, user_content, assistant_content):
+    """
+    Adds a finished exchange, user_content as passed to build() without the volatile parts.
+    Returns the token counts of the two messages.
+    """
+    counts = []
+    for message in ({"role": "user", "content": user_content}, {"role": "assistant", "content": assistant_content}):
+      tokens = self.message_tokens(message["content"])
+      self.history.append((message, tokens))
+      self.history_tokens += tokens
+      counts.append(tokens)
+    return tuple(counts)
+
+
+  def _total(self, tail_tokens):
+    return self.system_tokens + self.memory_delta_tokens + self.history_tokens + tail_tokens + REPLY_PRIMER_TOKENS
+
+
+  def _trim(self, tail_tokens):
+    if self._total(tail_tokens) <= self.budget:
+      return
+
+    # the cached prefix is lost anyway, so the new memories move into the system message as well
+    self._rebase()
+    while self.history and self._total(tail_tokens) > self.budget:
+      for _ in range(min(PROMPT_TRIM_BLOCK, len(self.history))):
+        _, tokens = self.history.popleft()
+        self.history_tokens -= tokens
+    self.logger.debug(f"Trimmed history to {len(self.history)} messages")
+
+
+  def build(self, user_content, context=""):
+    """Messages for the LLM, with user_content and this turn's volatile parts as the last user message."""
+    volatile = ""
+    if context != "":
+      volatile = "\n\n<context>" + context.replace("\n", "") + "</context>"
+    tail_tokens = self.message_tokens(user_content + volatile)
+    self._trim(tail_tokens)
+
+    memory_delta = self._memory_delta()
+    if memory_delta:
+      volatile = "\n\n" + memory_delta.strip() + volatile
+    self.prompt_tokens = self._total(tail_tokens)
+
+    messages = [{"role": "system", "content": self.system_prompt}]
+    messages.extend(dict(message) for message, _ in self.history)
+    messages.append({"role": "user", "content": user_content + volatile})
+    self._report(messages)
+    return messages
+
+
+  def _report(self, messages):
+    """Share of the prompt, in characters, that is identical to the start of the previous prompt."""
+    rendered = [f"{message['role']}\n{message['content']}\n" for message in messages]
+    cached = 0
+    for previous, current in zip(self.previous_prompt, rendered):
+      if previous != current:
+        cached += len(os.path.commonprefix([previous, current]))
+        break
+      cached += len(current)
+
+    self.previous_prompt = rendered
+    self.cached_prefix_ratio = cached / sum(len(message) for message in rendered)
+    latency_trace.note("cached_prefix_ratio", round(self.cached_prefix_ratio, 3))
+    latency_trace.note("prompt_tokens", self.prompt_tokens)
+    self.logger.debug(f"Prompt {self.prompt_tokens} tokens, cached prefix ratio {self.cached_prefix_ratio:.1%}")
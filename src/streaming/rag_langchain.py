@@ -5,13 +5,15 @@ from langchain_community.vectorstores import Chroma
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_core.documents import Document
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from config import *
+from src.streaming.interrupt_signal import InterruptSignal
+from src.streaming.intent_classifier import IntentClassifier
 
 
 class RAGLangchain:
-  def __init__(self, interrupt_count: SynchronizedClass):
+  def __init__(self, interrupt_signal: InterruptSignal):
     self.logger = logging.getLogger("speech_to_speech.rag_langchain")
-    self.interrupt_count = interrupt_count
+    self.interrupt_signal = interrupt_signal
 
     self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
     self.db = Chroma(
@@ -27,6 +29,15 @@ class RAGLangchain:
       embedding_function=self.embeddings,
       persist_directory=core_memory_dir
     )
+    # shares the embedding model, so classifying a command costs one more embedding
+    self.intent_classifier = IntentClassifier(self.embeddings) if INTENT_CLASSIFIER else None
+
+
+  def classify_intent(self, text):
+    """Local web search / memory decision, None when the LLM classifier has to decide."""
+    if self.intent_classifier is None:
+      return None
+    return self.intent_classifier.classify(text)
 
 
   def add_memory(self, text, timestamp):
@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+import wave
+import numpy as np
+
+# Environment variables read by the pipeline components when running under replay.py.
+# They are inherited by the worker processes, so no extra arguments need to be threaded through.
+REPLAY_DIR_ENV = "S2S_REPLAY_DIR"              # directory of recorded command wav files
+REPLAY_GAP_ENV = "S2S_REPLAY_GAP"              # seconds of silence between commands
+REPLAY_WAKE_WORD_ENV = "S2S_REPLAY_WAKE_WORD"  # optional wav containing only the wake word
+AUDIO_SINK_ENV = "S2S_AUDIO_SINK"              # "null" to discard audio output
+WEB_FIXTURES_ENV = "S2S_WEB_FIXTURES"          # directory of html files served instead of the web
+
+
+def is_replay():
+  return bool(os.getenv(REPLAY_DIR_ENV))
+
+
+def is_null_audio_sink():
+  return os.getenv(AUDIO_SINK_ENV) == "null"
+
+
+def list_command_files(replay_dir):
+  return sorted(
+    os.path.join(replay_dir, name) for name in os.listdir(replay_dir)
+    if name.lower().endswith(".wav")
+  )
+
+
+def load_wav_pcm(path, sample_rate):
+  """Reads a wav file as mono int16 at sample_rate."""
+  with wave.open(path, "rb") as wav_file:
+    channels = wav_file.getnchannels()
+    sample_width = wav_file.getsampwidth()
+    source_rate = wav_file.getframerate()
+    data = wav_file.readframes(wav_file.getnframes())
+
+  if sample_width != 2:
+    raise ValueError(f"{path}: only 16 bit wav files are supported")
+
+  pcm = np.frombuffer(data, dtype=np.int16)
+  if channels > 1:
+    pcm = pcm.reshape(-1, channels).mean(axis=1).astype(np.int16)
+
+  if source_rate != sample_rate:
+    duration = len(pcm) / source_rate
+    target_times = np.arange(int(duration * sample_rate)) / sample_rate
+    source_times = np.arange(len(pcm)) / source_rate
+    pcm = np.interp(target_times, source_times, pcm).astype(np.int16)
+
+  return pcm
+
+
+def load_speech_labels(wav_path):
+  """
+  Labelled speech for a recording, read from <name>.json next to it: {"speech": [[start, end], ...]} in seconds.
+  Returns the list of (start, end) pairs, or None when the recording has no labels.
+  """
+  label_path = os.path.splitext(wav_path)[0] + ".json"
+  if not os.path.exists(label_path):
+    return None
+  with open(label_path) as label_file:
+    return [(float(start), float(end)) for start, end in json.load(label_file)["speech"]]
+
+
+def build_replay_pcm(sample_rate=16000):
+  """Concatenates the replay commands into one int16 stream with silence gaps between them."""
+  gap = np.zeros(int(float(os.getenv(REPLAY_GAP_ENV, "8")) * sample_rate), dtype=np.int16)
+  wake_word_path = os.getenv(REPLAY_WAKE_WORD_ENV)
+
+  segments = [gap]
+  for index, path in enumerate(list_command_files(os.getenv(REPLAY_DIR_ENV))):
+    # wake word is only needed before the first command, the rest are natural conversation follow ups
+    if wake_word_path and index == 0:
+      segments.append(load_wav_pcm(wake_word_path, sample_rate))
+    segments.append(load_wav_pcm(path, sample_rate))
+    segments.append(gap)
+
+  return np.concatenate(segments)
+
+
+class WavFrameSource:
+  """
+  Drop-in replacement for PvRecorder that plays the commands of a replay directory in real time.
+  Audio keeps "playing" while the source is stopped, exactly like a microphone, so frames that
+  arrive between stop() and start() are lost the same way they are with PvRecorder.
+  """
+
+  def __init__(self, frame_length, sample_rate=16000):
+    self.logger = logging.getLogger("speech_to_speech.replay_source")
+    self.frame_length = frame_length
+    self.sample_rate = sample_rate
+    self.frame_duration = frame_length / sample_rate
+
+    self.pcm = build_replay_pcm(sample_rate)
+    self.total_frames = len(self.pcm) // frame_length
+    self.start_time = None
+    self.next_frame = 0
+    self.is_recording = False
+    self.logger.debug(f"Replaying {len(self.pcm) / sample_rate:.1f}s of audio")
+
+  def _current_frame(self):
+    if self.start_time is None:
+      self.start_time = time.monotonic()
+    return int((time.monotonic() - self.start_time) / self.frame_duration)
+
+  def start(self):
+    self.next_frame = max(self.next_frame, self._current_frame())
+    self.is_recording = True
+
+  def stop(self):
+    self.is_recording = False
+
+  def read(self):
+    if not self.is_recording:
+      raise RuntimeError("WavFrameSource is not recording")
+
+    # block until the frame has been "spoken", like a real microphone
+    due_time = self.start_time + (self.next_frame + 1) * self.frame_duration
+    delay = due_time - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+
+    index = self.next_frame
+    self.next_frame += 1
+    if index >= self.total_frames:
+      return [0] * self.frame_length
+
+    start = index * self.frame_length
+    return self.pcm[start:start + self.frame_length].tolist()
+
+  def delete(self):
+    pass
+
+
+class NullSpeaker:
+  """
+  Drop-in replacement for PvSpeaker that discards audio but keeps real-time playback timing,
+  so flush() blocks until the written audio would have finished playing.
+  """
+
+  def __init__(self, sample_rate, bits_per_sample, buffer_size_secs=20, device_index=-1):
+    self.sample_rate = sample_rate
+    self.bits_per_sample = bits_per_sample
+    self.buffer_size_secs = buffer_size_secs
+    self.play_until = 0
+    self.started = False
+    self.stopped = threading.Event()
+
+  def start(self):
+    self.started = True
+    self.stopped.clear()
+    self.play_until = time.monotonic()
+
+  def write(self, pcm):
+    now = time.monotonic()
+    self.play_until = max(self.play_until, now) + len(pcm) / self.sample_rate
+    return len(pcm)
+
+  def flush(self):
+    remaining = self.play_until - time.monotonic()
+    if remaining > 0:
+      self.stopped.wait(remaining)
+
+  def stop(self):
+    self.started = False
+    self.stopped.set()
+    self.play_until = time.monotonic()
+
+  def delete(self):
+    pass
@@ -1,50 +1,51 @@
 from dotenv import load_dotenv
 import os
-import io
-import logging
 from config import *
-from multiprocessing import Process, Queue, Event, Value, Lock
+from multiprocessing import Process, Queue, Event, Value
 from multiprocessing.synchronize import Event as EventClass
-from multiprocessing.synchronize import Lock as LockClass
 from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
 from multiprocessing.queues import Queue as QueueClass
+from src.streaming.interrupt_signal import InterruptSignal
 import threading
 import time
+import asyncio
 
 from src.streaming.logging_config import setup_logging, start_listener, stop_listener, setup_worker_logging, get_logger, get_log_queue
 from src.streaming.voice_recorder import Recorder
 from src.streaming.stt_whisper import STTWhisper
-from src.streaming.utils import save_wav_file, is_queue_empty
-from src.streaming.llm_wrapper import LLMWrapper
-from src.streaming.rag_langchain import RAGLangchain
-from src.streaming.web_search import WebSearcher
-from src.streaming.tts_orpheus import TTSOrpheus
-from src.streaming.tts_coqui import TTSCoqui
-from src.streaming.tts_kokoro import TTSKokoro
-from src.streaming.tts_xtts import TTSXtts
+from src.streaming.stt_client import RemoteWhisper
+from src.streaming.stt_streaming import IncrementalTranscriber
+from src.streaming.utils import save_wav_file, save_pcm_wav_file, fire_interrupt_if_busy
+from src.streaming.turn import Turn, SpeechMessage
+from src.streaming import latency_trace
+from src.streaming.latency_trace import TurnTrace, LatencyTraceWriter, set_active_trace
+from src.streaming.turn_pipeline import TurnPipeline
+from src.streaming.model_pool import create_tts
 from src.streaming.audio_output import AudioOutputter
+from src.streaming.replay_io import is_replay
 
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
 
 def wake_word_stt_worker(
-  interrupt_count : SynchronizedClass,
+  interrupt_signal: InterruptSignal,
   voice_setup_event : EventClass,
   pipeline_setup_event: EventClass,
   command_queue: QueueClass,
-  command_queue_lock: LockClass,
+  active_turn: SynchronizedClass,
   log_queue
 ):
   setup_worker_logging(log_queue)
   logger = get_logger("speech_to_speech.voice_worker")
   logger.debug("Setting up WakeWord and STT")
   
-  audio_speaker = AudioOutputter(interrupt_count, logger)
+  audio_speaker = AudioOutputter(interrupt_signal, logger)
   audio_buffer_signal = Event()
   audio_recorder = Recorder(audio_buffer_signal)
   audio_buffer = audio_recorder.get_audio_buffer_instance()
-  whisper = STTWhisper(vad_active=True, device=DEVICE)
+  # with a shared stt_service.py the model is loaded once for every assistant on the machine
+  whisper = RemoteWhisper() if STT_SERVICE_ADDRESS else STTWhisper(vad_active=True, device=DEVICE)
   project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
   output_dir = os.path.join(project_root_dir, "conversation")
   
@@ -58,6 +59,9 @@ def wake_word_stt_worker(
   pipeline_setup_event.wait()
 
   while True:
+    trace = TurnTrace() if LATENCY_TRACE else None
+    set_active_trace(trace)
+
     if (time.time() - last_command_time) > WAKEWORD_RESET_TIME:
       logger.warning("wakeword reset")
       ask_wakeword = True
@@ -65,38 +69,39 @@ def wake_word_stt_worker(
     if ask_wakeword:
       logger.debug("Listening for wake word...")
       audio_recorder.record_wake_word()
+      latency_trace.mark("wake_word")
       ask_wakeword = False
       audio_buffer.clear_buffer()
 
-      if not is_queue_empty(command_queue_lock, command_queue):
-        # If queue is not empty, it means that pipeline is still processing it
-        # increment interrupt count
+      # If pipeline is still processing a turn, increment interrupt count
+      if fire_interrupt_if_busy(active_turn, command_queue, interrupt_signal):
         logger.warning("interrupt fired")
-        interrupt_count.value += 1
 
     logger.debug("Listening for command...")
-    command_buffer, command_duration = audio_recorder.record_command(ask_wakeword, command_queue, command_queue_lock, interrupt_count)
-    # logger.error(f"Start - {time.time()}")
+    transcriber = IncrementalTranscriber(whisper, audio_recorder.framelength) if STT_STREAMING else None
+    command_pcm, command_duration, speech_spans = audio_recorder.record_command(ask_wakeword, command_queue, active_turn, interrupt_signal, transcriber)
 
-    command_buffer.seek(0, io.SEEK_END)
-    command_size = command_buffer.tell() # size of command buffer in bytes
-    command_buffer.seek(0)
-    
-    num_samples = command_size // 2
-    if num_samples < audio_recorder.porcupine.sample_rate * (VOICE_THRESHOLD + SILENCE_THRESHOLD):
+    num_samples = command_pcm.size
+    min_silence = ENDPOINT_MIN_SILENCE if ENDPOINT_ADAPTIVE else SILENCE_THRESHOLD
+    if num_samples < audio_recorder.porcupine.sample_rate * (VOICE_THRESHOLD + min_silence):
       logger.debug("No speech detected.")
+      if transcriber:
+        transcriber.stop()
       continue
     
     extra_time_start = time.time()
     audio_buffer.clear_buffer()
-    audio_buffer_thread  = threading.Thread(target=audio_buffer.fill_buffer, args=(), daemon=True)
+    audio_buffer_thread  = threading.Thread(target=audio_buffer.fill_buffer, args=(audio_recorder.command_end_position(),), daemon=True)
     audio_buffer_signal.set()
     audio_buffer_thread.start()
 
     logger.debug("Running Speech-To-Text")
-    command_buffer.seek(0)
-    text_segments = whisper.transcribe(command_buffer)
-    text = ", ".join([segment.text for segment in text_segments])
+    if transcriber:
+      # most of the command was transcribed while it was spoken, only the uncommitted tail is decoded here
+      text = transcriber.finish(end=speech_spans[-1][1] if speech_spans else 0)
+    else:
+      text = whisper.transcribe_text(command_pcm, speech_spans)
+    latency_trace.mark("stt_done")
     logger.info(text)
 
     if not text:
@@ -107,14 +112,15 @@ def wake_word_stt_worker(
     
     output_filename = os.path.join(output_dir, "command.wav")
     logger.debug("Saving wav file.")
-    command_buffer.seek(0)
-    save_wav_file(command_buffer, text, output_filename, logger)
+    save_pcm_wav_file(command_pcm, audio_recorder.recorder.sample_rate, text, output_filename, logger)
 
     continuation = False
+    fragment = None
     extra_time_stop = time.time()
     # if time between this command and the previous one is < threashold, then we treet as continuation of previous prompt
     if WAKEWORD_RESET_TIME > 0 and not first_loop and (time.time() - command_duration - (extra_time_stop - extra_time_start) - last_command_time) < (CONTINUATION_THRESHOLD):
       continuation = True
+      fragment = text
       text = prev_text + ", " + text
 
     last_command_time = time.time()
@@ -124,236 +130,195 @@ def wake_word_stt_worker(
 
     prev_text = text
 
-    # Add 2 events, 1 to determine when pipeline starts working, and 1 to determine when pipeline stops working on  queue
-    command_queue.put({"text": text, "marker": "start", "continuation": continuation, "timestamp": last_command_time})
-    command_queue.put({"text": text, "marker": "finish", "continuation": continuation, "timestamp": last_command_time})
+    # Turn is marked active on hand-off so there is no gap where the pipeline looks idle
+    turn = Turn(text, continuation, last_command_time, trace, fragment)
+    with active_turn.get_lock():
+      active_turn.value = turn.turn_id
+      command_queue.put(turn)
     first_loop = False
 
     audio_buffer_signal.clear()
     audio_buffer_thread.join()
 
 
-def websearch_llm_tts_worker(
-  interrupt_count : SynchronizedClass,
+def speech_worker(
+  interrupt_signal: InterruptSignal,
+  speech_setup_event: EventClass,
+  speech_queue: QueueClass,
+  speech_report_queue: QueueClass,
+  active_turn: SynchronizedClass,
+  log_queue
+):
+  """Synthesizes and plays the text handed over by the pipeline worker, then finishes the turn."""
+  setup_worker_logging(log_queue)
+  logger = get_logger("speech_to_speech.speech_worker")
+  logger.debug("Setting up TTS")
+
+  audio_speaker = AudioOutputter(interrupt_signal, logger)
+  tts = create_tts(interrupt_signal)
+
+  project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  output_dir = os.path.join(project_root_dir, "conversation")
+  trace_writer = LatencyTraceWriter()
+
+
+  def turn_segments(message, end):
+    """Yields the turn's text from the speech queue until its end message, which is appended to end."""
+    turn_id = message.turn_id
+    while message.kind != SpeechMessage.END:
+      # text queued before an interrupt, or left over from an abandoned turn, is dropped without being synthesized
+      if message.kind == SpeechMessage.SEGMENT and message.turn_id == turn_id and message.generation == interrupt_signal.generation:
+        yield message.text
+      message = speech_queue.get()
+    end.append(message)
+
+
+  def finish_turn(turn):
+    with active_turn.get_lock():
+      if active_turn.value == turn.turn_id:
+        active_turn.value = 0
+
+      # each turn consumes at most one interrupt, one that arrived after its last check has nothing left to cancel
+      if not turn.interrupted and interrupt_signal.consume():
+        logger.debug(f"Interrupt arrived after turn {turn.turn_id} completed")
+
+    trace_writer.write(turn)
+    set_active_trace(None)
+    speech_report_queue.put(turn)
+
+  speech_setup_event.set()
+  last_finished_turn_id = 0
+
+  while True:
+    message = speech_queue.get()
+
+    # sentences an interrupted LLM stream produced after its turn already ended
+    if message.turn_id <= last_finished_turn_id:
+      continue
+
+    if message.kind == SpeechMessage.ANNOUNCE:
+      if message.generation == interrupt_signal.generation:
+        output_buffer, output_duration = tts.synthesize(message.text)
+        output_buffer.seek(0)
+        audio_speaker.play_wav_file(output_buffer, trace=False)
+      continue
+
+    # events are recorded on a local trace and merged into the turn's trace once it arrives with the end message
+    trace = TurnTrace() if LATENCY_TRACE else None
+    set_active_trace(trace)
+    end = []
+    output_buffer = None
+
+    if message.kind == SpeechMessage.SEGMENT:
+      segments = turn_segments(message, end)
+      if TTS_AUDIO_STREAMING:
+        logger.debug("Streaming speech from LLM response")
+        output_buffer, output_duration = tts.synthesize_and_stream(segments)
+      else:
+        response = " ".join(segments)
+        if response and not interrupt_signal.is_set():
+          logger.debug("Synthesizing speech")
+          with latency_trace.span("tts"):
+            output_buffer, output_duration = tts.synthesize(response)
+          if not interrupt_signal.is_set():
+            logger.debug("Playing response")
+            output_buffer.seek(0)
+            audio_speaker.play_wav_file(output_buffer)
+
+      # synthesis stops early on interrupt, read the rest of the turn off the queue
+      for _ in segments:
+        pass
+    else:
+      end.append(message)
+
+    turn = end[0].turn
+    if turn.trace is not None and trace is not None:
+      turn.trace.merge(trace)
+
+    # the speech worker is the only consumer of interrupts, the pipeline worker only flags the turn
+    if interrupt_signal.is_set():
+      if not turn.interrupted:
+        logger.warning("Pipeline Interrupted: Speaking response")
+      turn.interrupted = True
+      interrupt_signal.consume()
+
+    if not turn.interrupted and output_buffer is not None:
+      output_buffer.seek(0)
+      output_filename = os.path.join(output_dir, "output.wav")
+      logger.debug("Saving wav file.")
+      save_wav_file(output_buffer, end[0].text, output_filename, logger)
+
+    finish_turn(turn)
+    last_finished_turn_id = turn.turn_id
+
+
+def websearch_llm_worker(
+  interrupt_signal: InterruptSignal,
   voice_setup_event : EventClass,
   pipeline_setup_event: EventClass,
+  speech_setup_event: EventClass,
   command_queue: QueueClass,
-  command_queue_lock: LockClass,
+  speech_queue: QueueClass,
+  speech_report_queue: QueueClass,
   log_queue
 ):
   setup_worker_logging(log_queue)
   logger = get_logger("speech_to_speech.pipeline_worker")
-  logger.debug("Setting up Websearch, LLM and TTS")
-  
-  audio_speaker = AudioOutputter(interrupt_count, logger)
-  rag = RAGLangchain(interrupt_count=interrupt_count)
-  llm = LLMWrapper(
-    interrupt_count=interrupt_count,
-    memories = rag.get_memories()
-  )
-  websearch = WebSearcher(interrupt_count=interrupt_count)
-  
-  if TTS_CHOICE == "coqui":
-    tts = TTSCoqui(interrupt_count=interrupt_count)
-  elif TTS_CHOICE == "orpheus":
-    tts = TTSOrpheus(interrupt_count=interrupt_count)
-  elif TTS_CHOICE == "kokoro":
-    tts = TTSKokoro(interrupt_count=interrupt_count)
-  elif TTS_CHOICE == "xtts":
-    tts = TTSXtts(interrupt_count=interrupt_count)
-    
-  project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-  output_dir = os.path.join(project_root_dir, "conversation")
-        
-  def interrupt_actions(text, info):
-    logger.warning(f"Pipeline Interrupted: {info}")
-    llm.interrupt_context.append(text)
-    end_marker = command_queue.get()
-    logger.debug(end_marker)
-    interrupt_count.value -= 1
-    
-    
-  def searching_speech_worker(tts, text, interrupt_count, logger):
-    audio_speaker = AudioOutputter(interrupt_count, logger)
-    output_buffer, output_duration = tts.synthesize(text)
-    output_buffer.seek(0)
-    audio_speaker.play_wav_file(output_buffer)
+  logger.debug("Setting up Websearch and LLM")
+
+  asyncio.run(run_turn_pipeline(interrupt_signal, voice_setup_event, pipeline_setup_event, speech_setup_event, command_queue, speech_queue, speech_report_queue, logger))
 
+
+async def run_turn_pipeline(interrupt_signal, voice_setup_event, pipeline_setup_event, speech_setup_event, command_queue, speech_queue, speech_report_queue, logger):
+  # the mock replies of a replay stay out of the user's chat history and memory store
+  replay = is_replay()
+  turn_pipeline = TurnPipeline(interrupt_signal, speech_queue, speech_report_queue, store_memories=not replay, persist_history=not replay)
+  await turn_pipeline.setup()
+
+  logger.debug("Waiting for speech worker to setup")
+  await asyncio.to_thread(speech_setup_event.wait)
   pipeline_setup_event.set()
   logger.debug("Waiting for voice recording to setup")
-  voice_setup_event.wait()
-  
-  while True:
-    if not is_queue_empty(command_queue_lock, command_queue):
-      work = command_queue.get()
-      logger.debug(work)
-      text = work["text"]
-      marker = work["marker"]
-      timestamp = work["timestamp"]
-      continuation = work["continuation"]
-      
-      if marker == "start":
-        
-        if continuation:
-          if len(llm.interrupt_context) > 0:
-            llm.interrupt_context.pop()
-
-        # run core pipeline
-        if interrupt_count.value > 0:
-          interrupt_actions(text, info="before pipeline start")
-          continue
-        
-        # First decide if websearch is needed for prompt
-        (decision, topic), memory = llm.decide_websearch_memory(text)
-        if interrupt_count.value > 0:
-          interrupt_actions(text, info="Decide websearch memory")
-          continue
-        logger.debug(f"Websearch recommended?: {decision} - {topic}")
-
-        query_results = []
-
-        # IF websearch recommended, check if it is really needed
-        if decision == "yes":  
-          # First query RAG to see if there exists info in RAG
-          logger.debug(f"Querying RAG")
-          query_results = rag.query(text)
-          if interrupt_count.value > 0:
-            interrupt_actions(text, info="querying RAG")
-            continue
-          # add extra 0 in case RAG is empty and returns empty list
-          query_result_scores = [query["score"] for query in query_results] + [0]
-
-          # Only perform websearch if not good data in RAG
-          if max(query_result_scores) < RAG_CONFIDENCE_THRESHOLD:
-            logger.debug(f"Not enough confident info in RAG, perform search")
-
-            # PLay search speech while web search occurs
-            speech_thread = threading.Thread(target=searching_speech_worker, args=(tts, f"Searching the web for {topic}", interrupt_count, logger), daemon=True)
-            speech_thread.start()
-            
-            # Get list of websites
-            websites = websearch.ddg_search(topic)
-            if interrupt_count.value > 0:
-              interrupt_actions(text, info="DDG Search")
-              continue
-            
-            # Fetch content from websites
-            logger.debug(f"Fetching website contents")
-            web_contents = websearch.fetch_content(websites)
-            if interrupt_count.value > 0:
-              interrupt_actions(text, info="Fetching website contents")
-              continue
-            
-            # Add website data to RAG
-            logger.debug(f"Adding contents to RAG")
-            interrupt_detected = False
-            for document in web_contents:
-              logging.info(document)
-              if interrupt_count.value > 0:
-                interrupt_actions(text, info="Adding document to RAG")
-                interrupt_detected = True
-                break
-              try:
-                rag.add_document(document)
-              except Exception as e:
-                logger.warning(e)
-                pass
-                
-            if interrupt_detected:
-              continue
-
-            speech_thread.join()
-
-          else:
-            logger.debug(f"Info in RAG exists, no search needed")
-        
-        # Query the RAG
-        logger.debug(f"Querying RAG")
-        query_results = rag.query(topic)
-        logger.info(query_results)
-        if interrupt_count.value > 0:
-          interrupt_actions(text, info="Querying RAG")
-          continue
-            
-        context = ""
-        # Parse contents from RAG query
-        for result in query_results:
-          if result["score"] >= RAG_CONFIDENCE_THRESHOLD:
-            context += result["content"]
-
-        # Send text and context to LLM for response
-        logger.debug("Sending to LLM")
-        rag.add_memory(memory, timestamp)
-        response = llm.send_to_llm(text, timestamp, memory, context)
-        if interrupt_count.value > 0:
-          interrupt_actions(text, info="LLM Query")
-          continue
-        logger.info(response)
-        
-        # Create speach from response
-        logger.debug("Synthesizing speech")
-        output_buffer = None
-        output_duration = 0
-        if TTS_AUDIO_STREAMING:
-          output_buffer, output_duration = tts.synthesize_and_stream(response)
-        else:
-          output_buffer, output_duration = tts.synthesize(response)
-        if interrupt_count.value > 0:
-          interrupt_actions(text, info="Synthesizing speach for LLM response")
-          continue
+  await asyncio.to_thread(voice_setup_event.wait)
 
-        output_buffer.seek(0)
-        output_filename = os.path.join(output_dir, "output.wav")
-        logger.debug("Saving wav file.")
-        save_wav_file(output_buffer, response, output_filename, logger)
-        output_buffer.seek(0)
-        # logger.error(f"End - {time.time()}")
-        
-        # logger.warning(output_duration)
-        
-        if not TTS_AUDIO_STREAMING:
-          logger.debug("Playing response")
-          audio_speaker.play_wav_file(output_buffer)
-          if interrupt_count.value > 0:
-            interrupt_actions(text, info="Playing Speech")
-            continue
-          output_buffer.seek(0)
-
-        # Finished without being interrupted, clear llm interrupt_context
-        llm.interrupt_context.clear()
-
-        # after finishing work, pop out end marker
-        command_queue.get()
-        
-      # elif marker == "finish":
-      #   #only possible if pipeline was interrupted
-      #   interrupt_count.value -= 1
-  
-  
+  try:
+    await turn_pipeline.run(command_queue)
+  finally:
+    turn_pipeline.shutdown()
 
 
-def main():
-  listener = start_listener()
-  logger = setup_logging()  
-  log_queue = get_log_queue()
-  
+def start_pipeline(logger, log_queue):
+  """Starts the voice, pipeline and speech worker processes, returns (workers, active_turn)."""
   command_queue = Queue()
-  command_queue_lock = Lock()
-  interrupt_count = Value("i", 0)
+  speech_queue = Queue()
+  speech_report_queue = Queue()
+  active_turn = Value("i", 0) # id of the turn handed to the pipeline, 0 when idle
+  interrupt_signal = InterruptSignal()
   voice_setup_event = Event()
   pipeline_setup_event = Event()
-  # initialize first here to prevent race condition to initialize later
-  audio_speaker = AudioOutputter(interrupt_count, logger)
-  
-  voice_worker = Process(target=wake_word_stt_worker, args=(interrupt_count, voice_setup_event, pipeline_setup_event, command_queue, command_queue_lock, log_queue))
-  pipeline_worker = Process(target=websearch_llm_tts_worker, args=(interrupt_count, voice_setup_event, pipeline_setup_event, command_queue, command_queue_lock, log_queue))
+  speech_setup_event = Event()
+
+  voice_worker = Process(target=wake_word_stt_worker, args=(interrupt_signal, voice_setup_event, pipeline_setup_event, command_queue, active_turn, log_queue))
+  pipeline_worker = Process(target=websearch_llm_worker, args=(interrupt_signal, voice_setup_event, pipeline_setup_event, speech_setup_event, command_queue, speech_queue, speech_report_queue, log_queue))
+  speech_worker_process = Process(target=speech_worker, args=(interrupt_signal, speech_setup_event, speech_queue, speech_report_queue, active_turn, log_queue))
   
   logger.debug("Starting Processes")
   voice_worker.start()
   pipeline_worker.start()
+  speech_worker_process.start()
+
+  return [voice_worker, pipeline_worker, speech_worker_process], active_turn
+
+
+def main():
+  listener = start_listener()
+  logger = setup_logging()  
+  log_queue = get_log_queue()
+  
+  workers, _ = start_pipeline(logger, log_queue)
   
-  voice_worker.join()
-  pipeline_worker.join()
+  for worker in workers:
+    worker.join()
   logger.debug("Processes Completed")
   
     
@@ -0,0 +1,29 @@
+import asyncio
+import json
+import struct
+
+# Every message is a 1 byte type and a 4 byte big endian payload length followed by the payload.
+#   AUDIO: client -> server 16 kHz mono int16 PCM, server -> client int16 PCM at the rate of the last "audio_format" event
+#   EVENT: utf-8 JSON object with an "event" key
+FRAME_AUDIO = 1
+FRAME_EVENT = 2
+HEADER = struct.Struct("!BI")
+CLIENT_SAMPLE_RATE = 16000
+
+
+async def read_frame(reader: asyncio.StreamReader):
+  """Returns (frame_type, payload), raises asyncio.IncompleteReadError when the peer disconnects."""
+  frame_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+  payload = await reader.readexactly(length) if length else b""
+  if frame_type == FRAME_EVENT:
+    return frame_type, json.loads(payload.decode("utf-8"))
+  return frame_type, payload
+
+
+def write_audio(writer: asyncio.StreamWriter, pcm_bytes):
+  writer.write(HEADER.pack(FRAME_AUDIO, len(pcm_bytes)) + pcm_bytes)
+
+
+def write_event(writer: asyncio.StreamWriter, event, **fields):
+  payload = json.dumps({"event": event, **fields}).encode("utf-8")
+  writer.write(HEADER.pack(FRAME_EVENT, len(payload)) + payload)
@@ -0,0 +1,248 @@
+import asyncio
+import itertools
+import logging
+import queue
+import time
+import numpy as np
+from config import *
+from src.streaming.interrupt_signal import InterruptSignal
+from src.streaming.llm_wrapper import LLMWrapper
+from src.streaming.session_protocol import FRAME_AUDIO, CLIENT_SAMPLE_RATE, read_frame, write_audio, write_event
+from src.streaming.turn import Turn, SpeechMessage
+from src.streaming.turn_pipeline import TurnPipeline
+from src.streaming.vad import create_vad, speech_spans
+from src.streaming.endpointer import Endpointer
+
+
+class LoopQueue:
+  """Speech queue for a session, filled from the turn pipeline's executor threads and read by the session's event loop."""
+
+  def __init__(self, loop):
+    self.loop = loop
+    self.queue = asyncio.Queue()
+
+  def put(self, item):
+    self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+  async def get(self):
+    return await self.queue.get()
+
+
+class VoiceSession:
+  """
+  One client connection. Endpoints the incoming PCM, runs its own TurnPipeline (own LLMWrapper history and
+  interrupt signal) and streams synthesized speech back. Whisper, RAG, web search and TTS come from the shared pools.
+  Memories stay in the session's prompt, the shared RAG's memory store would hand them to every client.
+  """
+
+  def __init__(self, session_id, reader, writer, pools):
+    self.logger = logging.getLogger(f"speech_to_speech.session_{session_id}")
+    self.session_id = session_id
+    self.reader = reader
+    self.writer = writer
+    self.pools = pools
+
+    self.interrupt_signal = InterruptSignal()
+    self.command_queue = queue.Queue()
+    self.speech_queue = LoopQueue(asyncio.get_running_loop())
+    self.speech_report_queue = queue.Queue()
+    self.turn_pipeline = None
+
+    self.active_turn_id = 0 # turn handed to the pipeline and not finished by the speaker yet, 0 when idle
+    self.last_finished_turn_id = 0
+    self.sample_rate_sent = None
+
+    self.vad = create_vad(SERVER_VAD_CHOICE)
+    self.frame_duration = self.vad.frame_length / CLIENT_SAMPLE_RATE
+    self.pending_pcm = b""
+    self.command_frames = []
+    self.command_voiced = [] # VAD decision of every command frame
+    self.voice_frames = 0
+    self.endpointer = Endpointer(self.frame_duration)
+    self.interrupt_fired = False
+    self.transcription = None # task transcribing the latest command, the frame loop does not wait for it
+
+
+  async def run(self):
+    llm = LLMWrapper(interrupt_signal=self.interrupt_signal, persist_history=False)
+    self.turn_pipeline = TurnPipeline(
+      self.interrupt_signal, self.speech_queue, self.speech_report_queue,
+      rag=self.pools["rag"].proxy(), llm=llm, websearch=self.pools["web"].proxy(), store_memories=False
+    )
+    await self.turn_pipeline.setup()
+
+    pipeline_task = asyncio.create_task(self.turn_pipeline.run(self.command_queue))
+    speaker_task = asyncio.create_task(self.speak())
+    write_event(self.writer, "ready", session_id=self.session_id)
+
+    try:
+      await self.listen()
+    except (asyncio.IncompleteReadError, ConnectionError):
+      self.logger.debug("Client disconnected")
+    finally:
+      # stop the LLM stream of an active turn and unblock the pipeline's queue reads
+      if self.active_turn_id:
+        self.interrupt_signal.fire()
+      self.command_queue.put(None)
+      self.speech_report_queue.put(None)
+      pipeline_task.cancel()
+      speaker_task.cancel()
+      if self.transcription is not None:
+        self.transcription.cancel()
+      self.turn_pipeline.shutdown()
+      self.interrupt_signal.close()
+      self.vad.delete()
+      self.writer.close()
+
+
+  async def listen(self):
+    while True:
+      frame_type, payload = await read_frame(self.reader)
+      if frame_type != FRAME_AUDIO:
+        continue
+
+      self.pending_pcm += payload
+      frame_bytes = self.vad.frame_length * 2
+      while len(self.pending_pcm) >= frame_bytes:
+        frame = self.pending_pcm[:frame_bytes]
+        self.pending_pcm = self.pending_pcm[frame_bytes:]
+        await self._process_frame(frame)
+
+
+  async def _process_frame(self, frame):
+    voice_prob = self.vad.process(np.frombuffer(frame, dtype=np.int16))
+    voiced = voice_prob > VOICE_PROBABILITY
+    if not self.command_frames and not voiced:
+      return
+
+    self.command_frames.append(frame)
+    self.command_voiced.append(voiced)
+    command_over = self.endpointer.update(voice_prob)
+    if voiced:
+      self.voice_frames += 1
+      # barge-in: the user talks over an unfinished turn
+      if self.active_turn_id and not self.interrupt_fired and self.voice_frames * self.frame_duration >= VOICE_THRESHOLD:
+        self.logger.warning("interrupt fired")
+        self.interrupt_fired = True
+        self.interrupt_signal.fire()
+        write_event(self.writer, "interrupt")
+      return
+
+    if not command_over:
+      return
+
+    command_pcm = b"".join(self.command_frames)
+    pad_frames = int(STT_SPEECH_PAD / self.frame_duration)
+    spans = speech_spans(self.command_voiced, self.vad.frame_length, pad_frames, merge_frames=2 * pad_frames)
+    enough_voice = self.voice_frames * self.frame_duration >= VOICE_THRESHOLD
+    self.command_frames = []
+    self.command_voiced = []
+    self.voice_frames = 0
+    self.endpointer.reset()
+    self.interrupt_fired = False
+    if not enough_voice:
+      return
+
+    # frames keep being read, and barge-in detected, while the command is transcribed
+    self.transcription = asyncio.create_task(self._transcribe(command_pcm, spans, self.transcription))
+
+
+  async def _transcribe(self, command_pcm, spans, previous):
+    try:
+      text = await asyncio.wrap_future(self.pools["stt"].submit("transcribe_pcm", command_pcm, spans))
+    except Exception as e:
+      self.logger.error(f"Transcription failed: {e}")
+      return
+    # commands are handed over in the order they were spoken
+    if previous is not None:
+      await asyncio.gather(previous, return_exceptions=True)
+    self.logger.info(text)
+    if not text:
+      return
+
+    write_event(self.writer, "transcript", text=text)
+    turn = Turn(text, False, time.time())
+    self.active_turn_id = turn.turn_id
+    self.command_queue.put(turn)
+
+
+  async def _speak_text(self, text, generation):
+    pcm_bytes, sample_rate = await asyncio.wrap_future(self.pools["tts"].submit("synthesize_pcm", text))
+    # interrupted while the sentence was being synthesized
+    if generation != self.interrupt_signal.generation:
+      return
+
+    if sample_rate != self.sample_rate_sent:
+      write_event(self.writer, "audio_format", sample_rate=sample_rate)
+      self.sample_rate_sent = sample_rate
+    write_audio(self.writer, pcm_bytes)
+    await self.writer.drain()
+
+
+  async def speak(self):
+    """Same role as the local speech worker: speaks the turn's text, then finishes the turn."""
+    while True:
+      message = await self.speech_queue.get()
+      if message.turn_id <= self.last_finished_turn_id:
+        continue
+
+      if message.kind == SpeechMessage.ANNOUNCE:
+        if message.generation == self.interrupt_signal.generation:
+          await self._speak_text(message.text, message.generation)
+        continue
+
+      end = message
+      while end.kind != SpeechMessage.END:
+        if end.kind == SpeechMessage.SEGMENT and end.turn_id == message.turn_id and end.generation == self.interrupt_signal.generation:
+          await self._speak_text(end.text, end.generation)
+        end = await self.speech_queue.get()
+
+      turn = end.turn
+      if self.interrupt_signal.is_set():
+        turn.interrupted = True
+        self.interrupt_signal.consume()
+      if self.active_turn_id == turn.turn_id:
+        self.active_turn_id = 0
+
+      write_event(self.writer, "turn_end", turn_id=turn.turn_id, interrupted=turn.interrupted, response=end.text)
+      self.last_finished_turn_id = turn.turn_id
+      self.speech_report_queue.put(turn)
+
+
+class SessionServer:
+  """TCP server accepting concurrent voice sessions, see session_protocol for the wire format."""
+
+  def __init__(self, pools, host=SERVER_HOST, port=SERVER_PORT, max_sessions=SERVER_MAX_SESSIONS):
+    self.logger = logging.getLogger("speech_to_speech.session_server")
+    self.pools = pools
+    self.host = host
+    self.port = port
+    self.max_sessions = max_sessions
+    self.sessions = {}
+    self.session_ids = itertools.count(1)
+
+
+  async def _handle_client(self, reader, writer):
+    if len(self.sessions) >= self.max_sessions:
+      write_event(writer, "error", message="server is full")
+      await writer.drain()
+      writer.close()
+      return
+
+    session = VoiceSession(next(self.session_ids), reader, writer, self.pools)
+    self.sessions[session.session_id] = session
+    self.logger.info(f"Session {session.session_id} connected, {len(self.sessions)} active")
+    try:
+      await session.run()
+    except Exception as e:
+      self.logger.error(f"Session {session.session_id} failed: {e}")
+    finally:
+      del self.sessions[session.session_id]
+      self.logger.info(f"Session {session.session_id} closed, {len(self.sessions)} active")
+
+
+  async def serve(self):
+    server = await asyncio.start_server(self._handle_client, self.host, self.port)
+    self.logger.info(f"Listening on {self.host}:{self.port}")
+    async with server:
+      await server.serve_forever()
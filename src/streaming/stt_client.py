@@ -0,0 +1,93 @@
+import ipaddress
+import logging
+import os
+import secrets
+import socket
+import threading
+from collections import namedtuple
+from multiprocessing.connection import Client
+import numpy as np
+from config import *
+
+# Same fields as faster-whisper's Word, which is all IncrementalTranscriber reads
+Word = namedtuple("Word", ["start", "end", "word"])
+
+
+def is_loopback(host):
+  try:
+    return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+  except (OSError, ValueError):
+    return False
+
+
+def service_key(host, create=False):
+  """
+  Shared secret of stt_service.py and its clients. The connection unpickles whatever it receives, so the key
+  is all that keeps others from running code in the service or the client:
+    - STT_SERVICE_KEY from the environment, required unless the service is on a loopback address
+    - otherwise a random key in STT_SERVICE_KEY_FILE, created by the service and only readable by its user
+  """
+  key = os.getenv("STT_SERVICE_KEY")
+  if key:
+    return key.encode("utf-8")
+  if not is_loopback(host):
+    raise RuntimeError(f"STT_SERVICE_KEY must be set to use the STT service on {host}, only a loopback address may go without it")
+
+  key_path = STT_SERVICE_KEY_FILE
+  if not os.path.isabs(key_path):
+    project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    key_path = os.path.join(project_root_dir, key_path)
+  if create and not os.path.exists(key_path):
+    os.makedirs(os.path.dirname(key_path), exist_ok=True)
+    with os.fdopen(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as key_file:
+      key_file.write(secrets.token_hex(32))
+  if not os.path.exists(key_path):
+    raise RuntimeError(f"No STT service key in {key_path}, start stt_service.py first or set STT_SERVICE_KEY")
+  with open(key_path, "r") as key_file:
+    return key_file.read().strip().encode("utf-8")
+
+
+def parse_address(address):
+  host, port = address.rsplit(":", 1)
+  return host, int(port)
+
+
+class RemoteWhisper:
+  """
+  Stand-in for STTWhisper in the voice worker that sends its commands to a shared stt_service.py
+  (STT_SERVICE_ADDRESS) instead of holding a model of its own. Calls are blocking like STTWhisper's.
+  """
+
+  def __init__(self, address=STT_SERVICE_ADDRESS):
+    self.logger = logging.getLogger("speech_to_speech.stt_client")
+    host, port = parse_address(address)
+    self.connection = Client((host, port), authkey=service_key(host))
+    # the incremental transcriber's thread and the voice worker share the connection
+    self.lock = threading.Lock()
+    self.logger.debug(f"Connected to STT service at {address}")
+
+
+  def _call(self, method, *args):
+    with self.lock:
+      self.connection.send((method, args))
+      result, error = self.connection.recv()
+    if error is not None:
+      raise RuntimeError(f"STT service {method} failed: {error}")
+    return result
+
+
+  def transcribe_text(self, pcm, spans=None):
+    # copied out of the recorder's ring buffer, a view would pickle the whole buffer
+    return self._call("transcribe_pcm", np.array(pcm, dtype=np.int16), spans)
+
+
+  def transcribe_words(self, pcm, prompt=None, final=False):
+    return [Word(*word) for word in self._call("transcribe_words", np.array(pcm, dtype=np.int16), prompt, final)]
+
+
+  def metrics(self):
+    return self._call("metrics")
+
+
+  def close(self):
+    self.connection.close()
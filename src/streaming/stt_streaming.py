@@ -0,0 +1,157 @@
+import logging
+import re
+import threading
+import numpy as np
+from config import *
+from src.streaming.stt_whisper import STTWhisper
+from src.streaming.vad import speech_spans
+
+
+def _normalize(word):
+  return re.sub(r"[^a-z0-9']", "", word.lower())
+
+
+class IncrementalTranscriber:
+  """
+  Transcribes a command while it is being recorded. Every STT_STREAMING_STEP seconds of new speech a background
+  thread re-decodes the uncommitted window and commits the words two consecutive hypotheses agree on (local
+  agreement). Committed audio is dropped from the window, so once the command is endpointed finish() only has the
+  short uncommitted tail left to decode. Like the non-streaming path only the spans the recorder's VAD marked as
+  speech, padded by STT_SPEECH_PAD, are decoded, Whisper makes up words on silence.
+
+  One instance per command: the recorder calls feed() for every frame, the voice worker then calls finish()
+  for the transcript or stop() to discard it.
+  """
+
+  def __init__(self, whisper: STTWhisper, frame_length, sample_rate=16000, step=STT_STREAMING_STEP, trim=STT_STREAMING_TRIM):
+    self.logger = logging.getLogger("speech_to_speech.stt_streaming")
+    self.whisper = whisper
+    self.frame_length = frame_length
+    self.sample_rate = sample_rate
+    self.step_samples = int(step * sample_rate)
+    self.trim = trim
+    self.pad_frames = int(STT_SPEECH_PAD * sample_rate / frame_length)
+
+    self.lock = threading.Lock()
+    self.wake = threading.Event()
+    self.stopped = False
+    self.pcm = None             # latest view of the growing command, only ever appended to
+    self.voiced = []            # the recorder's VAD decision for every frame of pcm
+    self.new_voiced_samples = 0 # voiced audio fed since the last decode was requested
+    self.window_start = 0       # sample the next decode starts at, everything before it is committed
+    self.committed = []         # (start, end, word) in seconds from the start of the command
+    self.pending = []           # words of the last hypothesis that are not committed yet
+    self.decodes = 0
+
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+
+  @property
+  def committed_end(self):
+    return self.committed[-1][1] if self.committed else 0.0
+
+
+  def committed_text(self):
+    return "".join(word for _, _, word in self.committed).strip()
+
+
+  def partial_text(self):
+    """Committed words plus the latest unconfirmed ones, e.g. for the endpointer."""
+    with self.lock:
+      return "".join(word for _, _, word in self.committed + self.pending).strip()
+
+
+  def feed(self, pcm, voiced):
+    """pcm is the whole command so far (a view is fine), voiced the VAD decision of each of its frames."""
+    with self.lock:
+      self.new_voiced_samples += sum(voiced[len(self.voiced):]) * self.frame_length
+      self.pcm = pcm
+      self.voiced = list(voiced)
+      if self.new_voiced_samples >= self.step_samples and not self.wake.is_set():
+        self.new_voiced_samples = 0
+        self.wake.set()
+
+
+  def _speech(self, pcm, voiced):
+    """
+    The voiced spans of pcm from the window start joined together, and (offset in the joined audio, start
+    sample in pcm, length) of every span to map word times back to the command.
+    """
+    spans = speech_spans(voiced[:pcm.size // self.frame_length], self.frame_length, self.pad_frames, merge_frames=2 * self.pad_frames)
+    chunks = []
+    pieces = []
+    offset = 0
+    for start, end in spans:
+      start, end = max(start, self.window_start), min(end, pcm.size)
+      if end > start:
+        chunks.append(pcm[start:end])
+        pieces.append((offset, start, end - start))
+        offset += end - start
+    return (np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)), pieces
+
+
+  def _command_time(self, seconds, pieces):
+    sample = seconds * self.sample_rate
+    for offset, start, length in pieces:
+      if sample < offset + length:
+        return (start + max(0.0, sample - offset)) / self.sample_rate
+    offset, start, length = pieces[-1]
+    return (start + length) / self.sample_rate
+
+
+  def _hypothesis(self, pcm, voiced, final=False):
+    """Decodes the speech in pcm from the window start, returns the words after the committed ones with command relative times."""
+    audio, pieces = self._speech(pcm, voiced)
+    if audio.size < self.sample_rate // 10:
+      return []
+    words = self.whisper.transcribe_words(audio, prompt=self.committed_text()[-200:], final=final)
+    self.decodes += 1
+    words = [(self._command_time(word.start, pieces), self._command_time(word.end, pieces), word.word) for word in words]
+    # the window may start slightly before the last committed word ends, drop what was already committed
+    return [word for word in words if word[0] >= self.committed_end - 0.05 and _normalize(word[2])]
+
+
+  def _run(self):
+    while True:
+      self.wake.wait()
+      if self.stopped:
+        break
+
+      with self.lock:
+        pcm, voiced = self.pcm, self.voiced
+      hypothesis = self._hypothesis(pcm, voiced)
+
+      with self.lock:
+        agreed = 0
+        while agreed < min(len(hypothesis), len(self.pending)) and _normalize(hypothesis[agreed][2]) == _normalize(self.pending[agreed][2]):
+          agreed += 1
+        self.committed.extend(hypothesis[:agreed])
+        self.pending = hypothesis[agreed:]
+
+        # keep the window short so the final decode is fast, the committed text goes in as prompt instead
+        if self.committed_end - self.window_start / self.sample_rate > self.trim:
+          self.window_start = int(self.committed_end * self.sample_rate)
+        if not self.stopped:
+          self.wake.clear()
+
+
+  def stop(self):
+    with self.lock:
+      self.stopped = True
+      self.wake.set()
+    self.thread.join()
+
+
+  def finish(self, end=None):
+    """
+    Waits for a decode in flight, decodes the uncommitted tail once and returns the full transcript.
+    end is the sample speech ends at, so the endpointing silence is not decoded.
+    """
+    self.stop()
+    if self.pcm is None:
+      return ""
+
+    tail = self._hypothesis(self.pcm[:end], self.voiced, final=True)
+    self.logger.debug(f"{len(self.committed)} words committed while recording, {self.decodes} decodes")
+    return "".join(word for _, _, word in self.committed + tail).strip()
@@ -1,25 +1,218 @@
 from faster_whisper import WhisperModel
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
 import logging
+import os
+import numpy as np
+from config import *
+
+
+def pcm_to_audio(pcm):
+  """int16 pcm to the float32 [-1, 1] array WhisperModel.transcribe takes."""
+  audio = pcm.astype(np.float32)
+  audio *= 1 / 32768
+  return audio
+
+
+def segments_text(segments):
+  return ", ".join(segment.text for segment in segments).strip()
+
+
+def available_cores():
+  """Cores this process may run on, which can be fewer than the machine has (taskset, containers)."""
+  if hasattr(os, "sched_getaffinity"):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+def resolve_profile(device, model_size=STT_MODEL_SIZE, compute_type=STT_COMPUTE_TYPE, cpu_threads=STT_CPU_THREADS,
+                    models_per_node=1, num_workers=1):
+  """
+  Fills in the 'auto' STT settings for device. On cpu the available cores are split between the models_per_node
+  models loaded on this node and the num_workers concurrent decodes each of them runs, so they do not contend.
+  Returns the WhisperModel keyword arguments and whether to decode greedy first.
+  """
+  cpu = device == "cpu"
+  if model_size == "auto":
+    model_size = STT_CPU_MODEL_SIZE if cpu else "turbo"
+  if compute_type == "auto" or (cpu and "float16" in compute_type):
+    # CTranslate2 has no float16 kernels on cpu, e.g. a server started with --device cpu on a GPU config
+    compute_type = "int8" if cpu else "int8_float16"
+
+  profile = dict(model_size_or_path=model_size, device=device, compute_type=compute_type, num_workers=num_workers)
+  if cpu:
+    profile["cpu_threads"] = cpu_threads or max(1, available_cores() // (models_per_node * num_workers))
+
+  greedy_first = STT_GREEDY_FIRST
+  if greedy_first == "auto":
+    greedy_first = cpu
+  return profile, greedy_first
 
 
 class STTWhisper:
-  def __init__(self, vad_active, device):
+  def __init__(self, vad_active, device, model_size=STT_MODEL_SIZE, compute_type=STT_COMPUTE_TYPE, cpu_threads=STT_CPU_THREADS,
+               models_per_node=1, greedy_first=None):
     self.logger = logging.getLogger("speech_to_speech.stt_whisper")
-    self.model_size = "turbo"
     self.vad = vad_active
     self.device = device
 
-    self.whisper_model = WhisperModel(self.model_size, device=self.device, compute_type="int8_float16")
-  
-  def transcribe(self, audio_buffer):
+    profile, self.greedy_first = resolve_profile(device, model_size, compute_type, cpu_threads, models_per_node)
+    if greedy_first is not None:
+      self.greedy_first = greedy_first
+    self.model_size = profile["model_size_or_path"]
+    self.profile = profile
+    self.beam_size = STT_BEAM_SIZE
+    self.decodes = 0
+    self.beam_fallbacks = 0
+
+    self.logger.debug(f"Loading Whisper {self.model_size} ({profile['compute_type']}, {profile.get('cpu_threads', 'gpu')} threads) on {device}")
+    self.whisper_model = WhisperModel(**profile)
+
+
+  def _decode(self, audio, vad_filter, beam_size):
     segments, _ = self.whisper_model.transcribe(
-      audio_buffer,
+      audio,
       language="en",
-      vad_filter=self.vad,
+      vad_filter=self.vad if vad_filter is None else vad_filter,
       vad_parameters=dict(min_silence_duration_ms=500),
-      beam_size=5)
-    
+      beam_size=beam_size)
+    return list(segments)
+
+
+  def _low_confidence(self, segments):
+    # segments Whisper itself thinks are silence are not worth a beam search
+    return any(segment.avg_logprob < STT_LOW_CONFIDENCE_LOGPROB and segment.no_speech_prob < 0.5 for segment in segments)
+
+
+  def transcribe(self, audio, vad_filter=None):
+    """audio is 16 kHz mono float32 in [-1, 1], passed straight to the model so nothing is decoded or resampled."""
+    self.decodes += 1
+    if not self.greedy_first:
+      segments = self._decode(audio, vad_filter, self.beam_size)
+    else:
+      # greedy is several times cheaper on cpu and gives the same text for clearly spoken commands
+      segments = self._decode(audio, vad_filter, 1)
+      if self._low_confidence(segments):
+        self.logger.debug("Low confidence greedy transcript, decoding again with beam search")
+        self.beam_fallbacks += 1
+        segments = self._decode(audio, vad_filter, self.beam_size)
+
     self.logger.debug("Speech Parsed!")
-    
+
+    return segments
+
+
+  def _speech_audio(self, pcm, spans):
+    """(audio, vad_filter) for transcribe(), audio is None when spans says there is no speech at all."""
+    if isinstance(pcm, (bytes, bytearray, memoryview)):
+      pcm = np.frombuffer(pcm, dtype=np.int16)
+
+    if spans is None:
+      return pcm_to_audio(pcm), None
+    if not spans:
+      return None, False
+    return pcm_to_audio(np.concatenate([pcm[start:end] for start, end in spans])), False
+
+
+  def transcribe_pcm(self, pcm, spans=None):
+    """
+    Transcribes 16 kHz int16 pcm, as a numpy array or raw bytes. With spans, the (start, end) sample ranges
+    the recorder's VAD found speech in, only those are transcribed and Whisper's own VAD pass is skipped.
+    """
+    audio, vad_filter = self._speech_audio(pcm, spans)
+    if audio is None:
+      return []
+    return self.transcribe(audio, vad_filter)
+
+
+  def transcribe_text(self, pcm, spans=None):
+    return segments_text(self.transcribe_pcm(pcm, spans))
+
+
+  def transcribe_batch(self, jobs):
+    """
+    Transcribes several commands, (pcm, spans) pairs as for transcribe_pcm, with one batched encoder and decoder
+    pass. Commands without spans (they need Whisper's VAD) or longer than Whisper's 30 s window are transcribed
+    one by one. Returns the text of every command.
+    """
+    texts = [""] * len(jobs)
+    batched = []
+    for index, (pcm, spans) in enumerate(jobs):
+      audio, vad_filter = self._speech_audio(pcm, spans)
+      if audio is None:
+        continue
+      if vad_filter is None or audio.size > self.whisper_model.feature_extractor.n_samples:
+        texts[index] = segments_text(self.transcribe(audio, vad_filter))
+      else:
+        batched.append((index, audio))
+
+    if len(batched) == 1:
+      index, audio = batched[0]
+      texts[index] = segments_text(self.transcribe(audio, False))
+    elif batched:
+      for (index, _), text in zip(batched, self._decode_batch([audio for _, audio in batched])):
+        texts[index] = text
+
+    return texts
+
+
+  def _decode_batch(self, audios):
+    model = self.whisper_model
+    self.decodes += len(audios)
+    features = np.stack([pad_or_trim(model.feature_extractor(audio)[..., :-1]) for audio in audios])
+    tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language="en")
+    prompt = model.get_prompt(tokenizer, previous_tokens=[], without_timestamps=True)
+
+    results = model.model.generate(
+      model.encode(features),
+      [list(prompt) for _ in audios],
+      beam_size=1 if self.greedy_first else self.beam_size,
+      max_length=model.max_length,
+      suppress_blank=True,
+      suppress_tokens=[-1],
+      return_scores=True,
+      return_no_speech_prob=True)
+
+    texts = []
+    for audio, result in zip(audios, results):
+      tokens = result.sequences_ids[0]
+      # generate scores are length normalised, turned into the per token average transcribe() reports
+      avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+      if self.greedy_first and avg_logprob < STT_LOW_CONFIDENCE_LOGPROB and result.no_speech_prob < 0.5:
+        self.beam_fallbacks += 1
+        texts.append(segments_text(self._decode(audio, False, self.beam_size)))
+      else:
+        texts.append(tokenizer.decode(tokens).strip())
+    return texts
+
+
+  def _decode_words(self, audio, prompt, beam_size):
+    segments, _ = self.whisper_model.transcribe(
+      audio,
+      language="en",
+      vad_filter=False,
+      beam_size=beam_size,
+      word_timestamps=True,
+      condition_on_previous_text=False,
+      initial_prompt=prompt or None)
     return list(segments)
-    
\ No newline at end of file
+
+
+  def transcribe_words(self, pcm, prompt=None, final=False):
+    """
+    Word level transcript of 16 kHz int16 pcm holding only speech, for incremental transcription. Partial
+    decodes are greedy since the window is re-decoded as it grows, the final one decodes like transcribe().
+    Returns faster-whisper Word objects (start, end in seconds from pcm[0]).
+    """
+    audio = pcm_to_audio(pcm)
+    if not final:
+      segments = self._decode_words(audio, prompt, 1)
+    elif not self.greedy_first:
+      segments = self._decode_words(audio, prompt, self.beam_size)
+    else:
+      segments = self._decode_words(audio, prompt, 1)
+      if self._low_confidence(segments):
+        self.beam_fallbacks += 1
+        segments = self._decode_words(audio, prompt, self.beam_size)
+
+    return [word for segment in segments for word in (segment.words or [])]
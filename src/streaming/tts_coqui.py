@@ -5,16 +5,17 @@ import numpy as np
 from TTS.api import TTS
 import torch
 from config import *
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.interrupt_signal import InterruptSignal
 from src.streaming.audio_output import AudioOutputter
+from src.streaming.utils import iter_text_segments
 
 class TTSCoqui:
-  def __init__(self, interrupt_count: SynchronizedClass):
+  def __init__(self, interrupt_signal: InterruptSignal):
     torch.backends.cudnn.benchmark = False  # prevents unsupported plan attempts
     torch.backends.cuda.matmul.allow_tf32 = True  # small perf boost on Ampere+
 
     self.logger = logging.getLogger("speech_to_speech.tts_xtts")
-    self.interrupt_count = interrupt_count
+    self.interrupt_signal = interrupt_signal
     
     self.model = COQUI_TTS_MODEL
     self.client = TTS(self.model).to(DEVICE)
@@ -34,7 +35,7 @@ class TTSCoqui:
         speaker=COQUI_TTS_SPEAKER
       )
 
-      if self.interrupt_count.value > 0:
+      if self.interrupt_signal.is_set():
         return None, None
   
       audio_duration = len(wav_values) / 24000 
@@ -49,36 +50,41 @@ class TTSCoqui:
     return wav_buffer, audio_duration
 
   def synthesize_and_stream(self, text):
+    """Streams speech for text, which is either a string or an iterator of sentences consumed as they arrive."""
     wav_buffer = io.BytesIO()
     wav_file = wave.open(wav_buffer, 'wb')
     wav_file.setnchannels(1)
     wav_file.setsampwidth(2)
     wav_file.setframerate(24000)
     
+    audio_speaker = AudioOutputter(self.interrupt_signal, self.logger)
+    audio_speaker.start_audio_stream(sample_rate=24000)
     audio_duration = 0
   
+    self.logger.debug("Streaming response")
     try:
-      wav_values = self.client.tts(
-        text=text,
-        speaker=COQUI_TTS_SPEAKER
-      )
+      for sentence in iter_text_segments(text):
+        if self.interrupt_signal.is_set():
+          break
 
-      if self.interrupt_count.value > 0:
-        return None, None
+        wav_values = self.client.tts(
+          text=sentence,
+          speaker=COQUI_TTS_SPEAKER
+        )
+
+        if self.interrupt_signal.is_set():
+          break
   
-      audio_duration = len(wav_values) / 24000 
-      wav_values = np.array(wav_values, dtype=np.float32)
-      wav_values *= 32767
-      wav_int16 = wav_values.astype(np.int16, copy=False)
-      wav_file.writeframes(wav_int16.tobytes())
+        audio_duration += len(wav_values) / 24000 
+        wav_values = np.array(wav_values, dtype=np.float32)
+        wav_values *= 32767
+        wav_int16 = wav_values.astype(np.int16, copy=False)
+        wav_file.writeframes(wav_int16.tobytes())
+
+        audio_speaker.play_stream_audio(wav_int16)
 
-      self.logger.debug("Playing response")
-      wav_buffer.seek(0)
-      audio_speaker = AudioOutputter(self.interrupt_count, self.logger)
-      audio_speaker.play_wav_file(wav_buffer)
-      wav_buffer.seek(0)
-    
     finally:
+      audio_speaker.stop_streaming()
       wav_file.close()
     
-    return wav_buffer, audio_duration
\ No newline at end of file
+    return wav_buffer, audio_duration
@@ -5,16 +5,17 @@ import numpy as np
 import torch
 from config import *
 from kokoro import KPipeline
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.interrupt_signal import InterruptSignal
 from src.streaming.audio_output import AudioOutputter
+from src.streaming.utils import iter_text_segments
 
 class TTSKokoro:
-  def __init__(self, interrupt_count: SynchronizedClass):
+  def __init__(self, interrupt_signal: InterruptSignal):
     torch.backends.cudnn.benchmark = False  # prevents unsupported plan attempts
     torch.backends.cuda.matmul.allow_tf32 = True  # small perf boost on Ampere+
     
     self.logger = logging.getLogger("speech_to_speech.tts_kokoro")
-    self.interrupt_count = interrupt_count
+    self.interrupt_signal = interrupt_signal
     
     self.client = KPipeline(lang_code=KOKORO_TTS_LANG, device=DEVICE, repo_id='hexgrad/Kokoro-82M') # lang code a = american, b = british
     self.voice = KOKORO_TTS_VOICE
@@ -33,7 +34,7 @@ class TTSKokoro:
       generator = self.client(text, voice=self.voice, speed=1.3 if self.voice == "af_nicole" else 1.0)
       
       for _, _,audio in generator:
-        if self.interrupt_count.value > 0:
+        if self.interrupt_signal.is_set():
           break
 
         audio = audio if isinstance(audio, torch.Tensor) else torch.from_numpy(audio).float()
@@ -50,38 +51,41 @@ class TTSKokoro:
     return wav_buffer, audio_duration
 
   def synthesize_and_stream(self, text):
+    """Streams speech for text, which is either a string or an iterator of sentences consumed as they arrive."""
     wav_buffer = io.BytesIO()
     wav_file = wave.open(wav_buffer, 'wb')
     wav_file.setnchannels(1)
     wav_file.setsampwidth(2)
     wav_file.setframerate(self.samplerate)
     
+    audio_speaker = AudioOutputter(self.interrupt_signal, self.logger)
+    audio_speaker.start_audio_stream(sample_rate=self.samplerate)
     audio_duration = 0
     
+    self.logger.debug("Streaming response")
     try:
-      generator = self.client(text, voice=self.voice, speed=1.3 if self.voice == "af_nicole" else 1.0)
-      
-      for _, _,audio in generator:
-        if self.interrupt_count.value > 0:
+      for sentence in iter_text_segments(text):
+        if self.interrupt_signal.is_set():
           break
 
-        audio = audio if isinstance(audio, torch.Tensor) else torch.from_numpy(audio).float()
-        audio = audio.numpy()
-        audio *= 32767
+        generator = self.client(sentence, voice=self.voice, speed=1.3 if self.voice == "af_nicole" else 1.0)
         
-        audio_duration = len(audio) / self.samplerate
-        wav_Data = audio.astype(np.int16, copy=False)
-        wav_file.writeframes(wav_Data.tobytes())
-        
-        self.logger.debug("Playing response")
-        wav_buffer.seek(0)
-        audio_speaker = AudioOutputter(self.interrupt_count, self.logger)
-        audio_speaker.play_wav_file(wav_buffer)
-        wav_buffer.seek(0)
+        for _, _,audio in generator:
+          if self.interrupt_signal.is_set():
+            break
+
+          audio = audio if isinstance(audio, torch.Tensor) else torch.from_numpy(audio).float()
+          audio = audio.numpy()
+          audio *= 32767
+          
+          audio_duration += len(audio) / self.samplerate
+          wav_Data = audio.astype(np.int16, copy=False)
+          wav_file.writeframes(wav_Data.tobytes())
+
+          audio_speaker.play_stream_audio(wav_Data)
 
     finally:
+      audio_speaker.stop_streaming()
       wav_file.close()
     
     return wav_buffer, audio_duration
-    
-    
\ No newline at end of file
@@ -5,17 +5,19 @@ import io
 import threading
 import queue
 import asyncio
+import numpy as np
 from snac import SNAC
 from openai import OpenAI
 from config import *
 import os
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.interrupt_signal import InterruptSignal
 from src.streaming.audio_output import AudioOutputter
+from src.streaming.utils import iter_text_segments, cancel_completion_stream
 
 class TTSOrpheus:
-  def __init__(self, interrupt_count: SynchronizedClass):
+  def __init__(self, interrupt_signal: InterruptSignal):
     self.logger = logging.getLogger("speech_to_speech.tts_orpheus")
-    self.interrupt_count = interrupt_count
+    self.interrupt_signal = interrupt_signal
 
     self.api = os.getenv("OPENAI_API")
     self.api_key = os.getenv("OPENAI_API_KEY")
@@ -30,6 +32,7 @@ class TTSOrpheus:
     self.SAMPLE_RATE = 24000  # SNAC model uses 24kHz
     
     self.client = OpenAI(base_url=self.api, api_key=self.api_key)
+    self.wasted_tokens = 0 # speech tokens streamed for audio that was cancelled by an interrupt
 
 
   def _format_prompt(self, text):
@@ -96,7 +99,7 @@ class TTSOrpheus:
           if audio_samples is not None:
             yield audio_samples
 
-  def _tokens_decoder_sync(self, syn_token_gen, wav_file):
+  def _tokens_decoder_sync(self, syn_token_gen, wav_file, audio_speaker=None):
     """Synchronous wrapper for the asynchronous token decoder."""
     audio_queue = queue.Queue()
     audio_segments = []
@@ -129,6 +132,10 @@ class TTSOrpheus:
         # Write to WAV file if provided
         if wav_file:
             wav_file.writeframes(audio)
+
+        # Stream to speaker if provided
+        if audio_speaker:
+            audio_speaker.play_stream_audio(np.frombuffer(audio, dtype=np.int16))
      
     thread.join()
     
@@ -158,12 +165,20 @@ class TTSOrpheus:
 
     # Process the streamed response
     token_counter = 0
-    for chunk in response:
-      if self.interrupt_count.value > 0:
-        return None
+    completed = False
+    try:
+      for chunk in response:
+        if self.interrupt_signal.is_set():
+          return None
 
-      token_counter += 1
-      yield chunk.choices[0].text
+        token_counter += 1
+        yield chunk.choices[0].text
+      completed = True
+
+    finally:
+      # abort the request on interrupt so the server stops generating speech tokens
+      if not completed:
+        self.wasted_tokens += cancel_completion_stream(response, token_counter, self.logger, "Orpheus speech token")
     
     logging.debug("Token generation complete")
     
@@ -179,7 +194,7 @@ class TTSOrpheus:
     
     try:
       speech_token_generator = self._generate_tokens_from_api(text)
-      if self.interrupt_count.value > 0:
+      if self.interrupt_signal.is_set():
         return None, None
       audio_segments, audio_duration = self._tokens_decoder_sync(speech_token_generator, wav_file)
 
@@ -188,30 +203,30 @@ class TTSOrpheus:
       
     return wav_buffer, audio_duration
 
-  def synthesize_and_stream(self, text): 
+  def synthesize_and_stream(self, text):
+    """Streams speech for text, which is either a string or an iterator of sentences consumed as they arrive."""
     wav_buffer = io.BytesIO()
     wav_file = wave.open(wav_buffer, 'wb')
     wav_file.setnchannels(1)
     wav_file.setsampwidth(2)
     wav_file.setframerate(24000)
     
+    audio_speaker = AudioOutputter(self.interrupt_signal, self.logger)
+    audio_speaker.start_audio_stream(sample_rate=self.SAMPLE_RATE)
     audio_duration = 0
-    audio_segments = None
     
+    self.logger.debug("Streaming response")
     try:
-      speech_token_generator = self._generate_tokens_from_api(text)
-      if self.interrupt_count.value > 0:
-        return None, None
-      audio_segments, audio_duration = self._tokens_decoder_sync(speech_token_generator, wav_file)
+      for sentence in iter_text_segments(text):
+        if self.interrupt_signal.is_set():
+          break
+
+        speech_token_generator = self._generate_tokens_from_api(sentence)
+        _, sentence_duration = self._tokens_decoder_sync(speech_token_generator, wav_file, audio_speaker)
+        audio_duration += sentence_duration
 
-      self.logger.debug("Playing response")
-      wav_buffer.seek(0)
-      audio_speaker = AudioOutputter(self.interrupt_count, self.logger)
-      audio_speaker.play_wav_file(wav_buffer)
-      wav_buffer.seek(0)
-  
     finally:
+      audio_speaker.stop_streaming()
       wav_file.close()
       
     return wav_buffer, audio_duration
-  
\ No newline at end of file
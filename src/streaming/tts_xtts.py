@@ -4,19 +4,20 @@ import io
 import numpy as np
 import torch
 from config import *
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.interrupt_signal import InterruptSignal
 from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts
 from huggingface_hub import snapshot_download
 from src.streaming.audio_output import AudioOutputter
+from src.streaming.utils import iter_text_segments
 
 class TTSXtts:
-  def __init__(self, interrupt_count: SynchronizedClass):
+  def __init__(self, interrupt_signal: InterruptSignal):
     torch.backends.cudnn.benchmark = False  # prevents unsupported plan attempts
     torch.backends.cuda.matmul.allow_tf32 = True  # small perf boost on Ampere+
 
     self.logger = logging.getLogger("speech_to_speech.tts_xtts_v2")
-    self.interrupt_count = interrupt_count
+    self.interrupt_signal = interrupt_signal
     
     self.model_name = XTTS_HUGGINGFACE_MODEL
     checkpoint_path = snapshot_download(self.model_name)
@@ -50,7 +51,7 @@ class TTSXtts:
 
       wav_chunks = []
       for i, chunk in enumerate(chunks):
-        if self.interrupt_count.value > 0:
+        if self.interrupt_signal.is_set():
           break
         wav_chunks.append(chunk)
         # wav = torch.cat(wav_chuncks, dim=0)
@@ -69,29 +70,34 @@ class TTSXtts:
   
   
   def synthesize_and_stream(self, text):
+    """Streams speech for text, which is either a string or an iterator of sentences consumed as they arrive."""
     wav_buffer = io.BytesIO()
     wav_file = wave.open(wav_buffer, 'wb')
     wav_file.setnchannels(1)
     wav_file.setsampwidth(2)
     wav_file.setframerate(24000)
     
-    audio_speaker = AudioOutputter(self.interrupt_count, self.logger)
+    audio_speaker = AudioOutputter(self.interrupt_signal, self.logger)
     audio_speaker.start_audio_stream()
     audio_duration = 0
 
     self.logger.debug("Streaming response")
     try:
-      chunks = self.model.inference_stream(
-        text,
-        "en",
-        self.gpt_cond_latent,
-        self.speaker_embedding,
-        enable_text_splitting=True
-      )
-
       wav_chunks = []
-      for i, chunk in enumerate(chunks):
-          if self.interrupt_count.value > 0:
+      for sentence in iter_text_segments(text):
+        if self.interrupt_signal.is_set():
+          break
+
+        chunks = self.model.inference_stream(
+          sentence,
+          "en",
+          self.gpt_cond_latent,
+          self.speaker_embedding,
+          enable_text_splitting=True
+        )
+
+        for i, chunk in enumerate(chunks):
+          if self.interrupt_signal.is_set():
             break
 
           wav_chunks.append(chunk)
@@ -101,15 +107,15 @@ class TTSXtts:
 
           audio_speaker.play_stream_audio(wav_pcm)
 
-      wav_values = torch.cat(wav_chunks, dim=0).squeeze().cpu().numpy()
+      if wav_chunks:
+        wav_values = torch.cat(wav_chunks, dim=0).squeeze().cpu().numpy()
+
+        audio_duration = len(wav_values) / self.sample_rate 
+        wav_int16 = np.int16(wav_values * 32767)
+        wav_file.writeframes(wav_int16.tobytes())
 
-      audio_duration = len(wav_values) / self.sample_rate 
-      wav_int16 = np.int16(wav_values * 32767)
-      wav_file.writeframes(wav_int16.tobytes())
-      
-      audio_speaker.stop_streaming()
-    
     finally:
+      audio_speaker.stop_streaming()
       wav_file.close()
     
     return wav_buffer, audio_duration
\ No newline at end of file
@@ -0,0 +1,39 @@
+import itertools
+
+
+class Turn:
+  """A single user command handed from the voice worker to the pipeline worker."""
+
+  # ids only need to be unique within the voice worker process, 0 is reserved for "no active turn"
+  _id_counter = itertools.count(1)
+
+  def __init__(self, text, continuation, timestamp, trace=None, fragment=None):
+    self.turn_id = next(Turn._id_counter)
+    self.text = text
+    self.continuation = continuation
+    # for a continuation, the newly spoken part, text is the previous command followed by it
+    self.fragment = fragment
+    self.timestamp = timestamp
+    self.interrupted = False
+    self.trace = trace # TurnTrace started by the voice worker, None if tracing is off
+
+  def __repr__(self):
+    return f"Turn(id={self.turn_id}, continuation={self.continuation}, text={self.text!r})"
+
+
+class SpeechMessage:
+  """Text handed from the pipeline worker to the speech worker, in order, over the speech queue."""
+
+  SEGMENT = "segment"   # part of the turn's reply, spoken as it arrives
+  ANNOUNCE = "announce" # side announcement such as "Searching the web", not part of the reply
+  END = "end"           # no more text for the turn, carries the Turn so the speech worker can finish it
+
+  def __init__(self, kind, turn_id, generation, text="", turn=None):
+    self.kind = kind
+    self.turn_id = turn_id
+    self.generation = generation # interrupt generation the turn started in, text from older generations is dropped
+    self.text = text
+    self.turn = turn
+
+  def __repr__(self):
+    return f"SpeechMessage({self.kind}, turn={self.turn_id}, text={self.text!r})"
@@ -0,0 +1,473 @@
+import asyncio
+import functools
+import logging
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import *
+from multiprocessing.queues import Queue as QueueClass
+from src.streaming import latency_trace
+from src.streaming.interrupt_signal import InterruptSignal
+from src.streaming.latency_trace import set_active_trace
+from src.streaming.llm_wrapper import LLMWrapper
+from src.streaming.rag_langchain import RAGLangchain
+from src.streaming.turn import SpeechMessage
+from src.streaming.web_search import WebSearcher
+
+# Words that do not move a continuation to a new topic ("..., and please be quick")
+_FILLER_WORDS = {
+  "a", "an", "the", "and", "or", "but", "so", "also", "too", "then", "to", "of", "in", "on", "at", "for", "with",
+  "about", "is", "are", "was", "be", "it", "its", "that", "this", "me", "my", "you", "your", "i", "we", "can",
+  "could", "would", "will", "please", "thanks", "thank", "just", "um", "uh", "uhm", "er", "like", "okay", "ok",
+  "yeah", "yes", "no", "now", "right", "actually", "again", "quick", "quickly", "briefly",
+}
+
+
+def new_content_words(fragment, known_text):
+  """Words of fragment, apart from filler, that known_text does not contain."""
+  known = set(re.findall(r"[a-z0-9']+", known_text.lower()))
+  return [word for word in re.findall(r"[a-z0-9']+", fragment.lower()) if word not in _FILLER_WORDS and word not in known]
+
+
+class TurnAnalysis:
+  """
+  What the classifier, RAG and web search stages found for a turn's text. Filled in as the stages finish,
+  so an interrupted turn keeps whatever was done before the interrupt for a continuation to reuse.
+  """
+
+  def __init__(self, text):
+    self.text = text
+    self.decision = None
+    self.topic = None
+    self.memory = None
+    self.memory_saved = False  # memory handed to the LLM prompt and the memory store
+    self.query_results = None  # RAG results for the text
+    self.searched_topic = None # topic whose web results were added to the RAG
+    self.topic_results = None  # RAG results for the topic
+
+
+class SpeculativeReply:
+  """
+  A reply started from the command's own RAG context while the LLM classifier decides. Its sentences are
+  held back until confirm() hands them to the speech worker, after discard() the completion is stopped at
+  its next chunk. Both are called from the event loop while the reply streams in the LLM executor.
+  """
+
+  def __init__(self, turn, send):
+    self.turn = turn
+    self.send = send # hands a sentence to the speech worker
+    self.lock = threading.Lock()
+    self.decided = threading.Event()
+    self.confirmed = False
+    self.memory = "None"
+    self.held = []
+    self.started = time.monotonic()
+    self.reply = None # future of the LLM executor job
+
+  def put(self, sentence):
+    """Holds or sends a sentence, drops it once the reply was discarded."""
+    with self.lock:
+      if self.confirmed:
+        self.send(sentence)
+      elif not self.decided.is_set():
+        self.held.append(sentence)
+
+  def confirm(self, memory):
+    """The classifier agreed, memory is what it extracted from the command. Returns the head start in seconds."""
+    with self.lock:
+      self.memory = memory
+      self.confirmed = True
+      for sentence in self.held:
+        self.send(sentence)
+      self.held.clear()
+      self.decided.set()
+    return time.monotonic() - self.started
+
+  def discarded(self):
+    return self.decided.is_set() and not self.confirmed
+
+  def discard(self):
+    with self.lock:
+      if not self.decided.is_set():
+        self.held.clear()
+        self.decided.set()
+
+
+class TurnPipeline:
+  """
+  Runs each turn as one asyncio task made of awaitable stages. Blocking components run in their own
+  single thread executor (playwright and the Chroma client must stay on one thread), so stages that do
+  not depend on each other run concurrently. A barge-in cancels the turn task, and a turn that runs past
+  TURN_DEADLINE is abandoned. With SPECULATIVE_REPLY the reply starts while the LLM classifier is still
+  deciding and is only kept when no web search is needed.
+  """
+
+  def __init__(self, interrupt_signal: InterruptSignal, speech_queue: QueueClass, speech_report_queue: QueueClass, rag=None, llm=None, websearch=None, store_memories=True, persist_history=True):
+    self.logger = logging.getLogger("speech_to_speech.turn_pipeline")
+    self.interrupt_signal = interrupt_signal
+    self.speech_queue = speech_queue
+    self.speech_report_queue = speech_report_queue
+
+    self.queue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="command_queue")
+    self.llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+    # the LLM classifier has its own thread so it is not queued behind a speculative reply
+    self.classifier_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classifier")
+    self.rag_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag")
+    self.web_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="web")
+    # orders a turn's segments before its end message, see _send_segment
+    self.speech_lock = threading.Lock()
+
+    # components can be passed in, e.g. server sessions share pooled RAG and web search workers
+    self.rag = rag
+    self.llm = llm
+    self.websearch = websearch
+    # memories go to the RAG's memory store, server sessions share it and keep theirs in the LLM prompt only
+    self.store_memories = store_memories
+    # whether the LLMWrapper built by setup() writes the chat history log
+    self.persist_history = persist_history
+    # number of turns handed to the speech worker that have not been reported back yet
+    self.unreported_turns = 0
+    # stages of the latest turn, a continuation of it starts from these
+    self.analysis = None
+    # speculative reply of the current turn, and how the speculative replies fared so far
+    self.speculation = None
+    self.speculation_hits = 0
+    self.speculation_misses = 0
+    self.speculation_saved = 0.0 # seconds of head start the confirmed replies got
+
+
+  async def _run(self, executor, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+  async def setup(self):
+    if self.rag is None:
+      self.rag = await self._run(self.rag_executor, RAGLangchain, self.interrupt_signal)
+    if self.llm is None:
+      memories = await self._run(self.rag_executor, self.rag.get_memories)
+      self.llm = LLMWrapper(interrupt_signal=self.interrupt_signal, memories=memories, persist_history=self.persist_history)
+    if self.websearch is None:
+      # playwright is bound to the thread that started it
+      self.websearch = await self._run(self.web_executor, WebSearcher, self.interrupt_signal)
+
+
+  def shutdown(self):
+    for executor in (self.queue_executor, self.llm_executor, self.classifier_executor, self.rag_executor, self.web_executor):
+      executor.shutdown(wait=False, cancel_futures=True)
+    if self.llm is not None:
+      self.llm.close()
+
+
+  async def collect_speech_reports(self, backlog=SPEECH_BACKLOG_TURNS):
+    """
+    Applies the reports of the turns the speech worker finished. Turns still playing are only waited for while
+    more than backlog of them are unreported, so a new turn does not sit behind the previous reply's audio.
+    """
+    while self.unreported_turns > 0:
+      if self.unreported_turns > backlog:
+        finished_turn = await self._run(self.queue_executor, self.speech_report_queue.get)
+      else:
+        try:
+          finished_turn = self.speech_report_queue.get_nowait()
+        except queue.Empty:
+          return
+      if finished_turn is None:
+        # server session closed
+        return
+      self.unreported_turns -= 1
+      if finished_turn.interrupted:
+        self.llm.interrupt_context.append(finished_turn.text)
+      else:
+        # Finished without being interrupted, clear llm interrupt_context
+        self.llm.interrupt_context.clear()
+
+
+  async def _classify_locally(self, text):
+    """Web search / memory decision from the local classifier, None when the LLM classifier has to decide."""
+    with latency_trace.span("local_classifier"):
+      result = await self._run(self.rag_executor, self.rag.classify_intent, text)
+    latency_trace.note("classifier", "local" if result is not None else "llm")
+    return result
+
+
+  async def _classify_with_llm(self, text):
+    with latency_trace.span("classifier"):
+      return await self._run(self.classifier_executor, self.llm.decide_websearch_memory, text)
+
+
+  async def _store_memory(self, memory, timestamp):
+    if self.store_memories:
+      await self._run(self.rag_executor, self.rag.add_memory, memory, timestamp)
+
+
+  async def _query_rag(self, text, stage):
+    with latency_trace.span(stage):
+      return await self._run(self.rag_executor, self.rag.query, text)
+
+
+  async def _search_web(self, turn, topic, generation):
+    # Speech worker plays search speech while web search occurs
+    self.speech_queue.put(SpeechMessage(SpeechMessage.ANNOUNCE, turn.turn_id, generation, f"Searching the web for {topic}"))
+
+    # Get list of websites
+    with latency_trace.span("ddg_search"):
+      websites = await self._run(self.web_executor, self.websearch.ddg_search, topic)
+
+    # Fetch content from websites
+    self.logger.debug(f"Fetching website contents")
+    with latency_trace.span("fetch"):
+      web_contents = await self._run(self.web_executor, self.websearch.fetch_content, websites)
+
+    # Add website data to RAG
+    self.logger.debug(f"Adding contents to RAG")
+    with latency_trace.span("ingest"):
+      for document in web_contents:
+        self.logger.info(document)
+        try:
+          await self._run(self.rag_executor, self.rag.add_document, document)
+        except Exception as e:
+          self.logger.warning(e)
+
+
+  def _send_segment(self, turn, generation, ended, text):
+    """Hands reply text to the speech worker, unless the turn already ended (abandoned after TURN_DEADLINE)."""
+    with self.speech_lock:
+      if not ended.is_set():
+        self.speech_queue.put(SpeechMessage(SpeechMessage.SEGMENT, turn.turn_id, generation, text))
+
+
+  def _stream_reply(self, turn, generation, ended, text, memory, context):
+    """Runs in the LLM executor, hands each sentence to the speech worker as soon as it is complete."""
+    if TTS_AUDIO_STREAMING:
+      for sentence in self.llm.send_to_llm(text, turn.timestamp, memory, context, stream=True, should_stop=ended.is_set):
+        self._send_segment(turn, generation, ended, sentence)
+      return self.llm.last_response
+
+    response = self.llm.send_to_llm(text, turn.timestamp, memory, context, should_stop=ended.is_set)
+    if response:
+      self._send_segment(turn, generation, ended, response)
+    return response
+
+
+  def _stream_speculative_reply(self, speculation, ended, text, context):
+    """Runs in the LLM executor like _stream_reply, the reply is only spoken and saved once it is confirmed."""
+    turn = speculation.turn
+    # checked on every chunk, a discarded reply must not hold the LLM thread the real reply waits for
+    should_stop = lambda: ended.is_set() or speculation.discarded()
+    if TTS_AUDIO_STREAMING:
+      for sentence in self.llm.send_to_llm(text, turn.timestamp, context=context, stream=True, save=False, should_stop=should_stop):
+        speculation.put(sentence)
+    else:
+      response = self.llm.send_to_llm(text, turn.timestamp, context=context, save=False, should_stop=should_stop)
+      if response:
+        speculation.put(response)
+
+    # a finished reply waits for the classifier, the turn discards it on every other way out
+    speculation.decided.wait()
+    if not speculation.confirmed:
+      latency_trace.forget("llm_first_token", "llm_first_sentence", "llm_done")
+      return None
+    if speculation.memory != "None":
+      self.llm.add_memory(speculation.memory, turn.timestamp)
+    self.llm.save_exchange()
+    return self.llm.last_response
+
+
+  async def _query_and_speculate(self, turn, generation, ended, text):
+    """RAG lookup for the command, then starts the speculative reply from its results."""
+    query_results = await self._query_rag(text, "rag_query")
+    if SPECULATIVE_REPLY:
+      self.speculation = SpeculativeReply(turn, functools.partial(self._send_segment, turn, generation, ended))
+      self.speculation.reply = asyncio.get_running_loop().run_in_executor(
+        self.llm_executor, self._stream_speculative_reply, self.speculation, ended, text, self._context(query_results)
+      )
+    return query_results
+
+
+  def _needs_search(self, previous, topic, query_results):
+    """Whether a web search recommended for topic would add to the context, the RAG results may already cover it."""
+    if previous and previous.searched_topic == topic:
+      return False
+    # add extra 0 in case RAG is empty and returns empty list
+    return max([query["score"] for query in query_results] + [0]) < RAG_CONFIDENCE_THRESHOLD
+
+
+  def _settle_speculation(self, decision, search, memory):
+    """Confirms the speculative reply unless a web search changes its context, then discards it. True if confirmed."""
+    speculation = self.speculation
+    if decision is None:
+      # the classifier was interrupted, the turn is being cancelled
+      speculation.discard()
+      return False
+    if not search:
+      saved = speculation.confirm(memory)
+      self.speculation_hits += 1
+      self.speculation_saved += saved
+      latency_trace.note("speculation", "hit")
+      latency_trace.note("speculation_saved_ms", round(saved * 1000, 1))
+    else:
+      speculation.discard()
+      self.speculation_misses += 1
+      latency_trace.note("speculation", "miss")
+
+    total = self.speculation_hits + self.speculation_misses
+    saved_per_hit = self.speculation_saved / self.speculation_hits * 1000 if self.speculation_hits else 0
+    self.logger.debug(f"Speculative replies kept {self.speculation_hits}/{total}, {saved_per_hit:.0f} ms saved per kept reply")
+    return speculation.confirmed
+
+
+  def _context(self, query_results):
+    """Content of the RAG results confident enough for the prompt."""
+    context = ""
+    for result in query_results:
+      if result["score"] >= RAG_CONFIDENCE_THRESHOLD:
+        context += result["content"]
+    return context
+
+
+  def _reusable_analysis(self, turn):
+    """The previous turn's analysis when turn continues it without changing the topic, otherwise None."""
+    previous = self.analysis
+    if not (CONTINUATION_REUSE and turn.continuation and turn.fragment and previous):
+      return None
+    if previous.decision is None or not turn.text.startswith(previous.text):
+      return None
+    if len(new_content_words(turn.fragment, f"{previous.text} {previous.topic}")) > CONTINUATION_MAX_NEW_WORDS:
+      return None
+    return previous
+
+
+  async def run_turn(self, turn, generation, ended):
+    """
+    All stages of one turn, returns the response text. Cancelled as a whole on interrupt, the ended event
+    stops the reply still streaming in the LLM executor once the turn is over.
+    """
+    text = turn.text
+    previous = self.analysis if turn.continuation else None
+    reused = self._reusable_analysis(turn)
+    analysis = TurnAnalysis(text)
+    self.analysis = analysis
+
+    if reused:
+      # the fragment only finishes the previous command, its classification and RAG results still hold
+      self.logger.debug("Continuation on the same topic, reusing the previous classification and context")
+      latency_trace.mark("continuation_reused")
+      decision, topic = reused.decision, reused.topic
+      memory = "None" if reused.memory_saved else reused.memory
+      query_results = reused.query_results
+    else:
+      # First decide if websearch is needed for prompt. The local classifier answers most commands in a few ms,
+      # only while the LLM classifier decides is there time to win with a speculative reply.
+      local = await self._classify_locally(text)
+      if local is not None:
+        (decision, topic), memory = local
+        query_results = await self._query_rag(text, "rag_query")
+      else:
+        query_results, ((decision, topic), memory) = await asyncio.gather(
+          self._query_and_speculate(turn, generation, ended, text),
+          self._classify_with_llm(text),
+        )
+    analysis.decision, analysis.topic, analysis.memory, analysis.query_results = decision, topic, memory, query_results
+    self.logger.debug(f"Websearch recommended?: {decision} - {topic}")
+    search = decision == "yes" and self._needs_search(previous, topic, query_results)
+    if decision == "yes" and previous and previous.searched_topic == topic:
+      self.logger.debug(f"Already searched for {topic} in the previous command")
+      analysis.searched_topic = topic
+
+    if self.speculation is not None and self._settle_speculation(decision, search, memory):
+      # the reply is already streaming from the command's own context, the memory is stored meanwhile
+      analysis.memory_saved = True
+      response, _ = await asyncio.gather(
+        self.speculation.reply,
+        self._store_memory(memory, turn.timestamp),
+      )
+      self.logger.info(response)
+      return response
+
+    # Only perform the recommended websearch if not good data in RAG
+    if search:
+      self.logger.debug(f"Not enough confident info in RAG, perform search")
+      await self._search_web(turn, topic, generation)
+      analysis.searched_topic = topic
+    elif decision == "yes" and analysis.searched_topic is None:
+      self.logger.debug(f"Info in RAG exists, no search needed")
+
+    # Query the RAG, unless the previous command already did for the same topic and nothing was added since
+    if previous and previous.topic == topic and previous.topic_results is not None and previous.searched_topic == analysis.searched_topic:
+      query_results = previous.topic_results
+    else:
+      query_results = await self._query_rag(topic, "rag_topic_query")
+    analysis.topic_results = query_results
+    self.logger.info(query_results)
+
+    context = self._context(query_results)
+
+    # Send text and context to LLM for response, the memory is stored meanwhile
+    self.logger.debug("Sending to LLM")
+    analysis.memory_saved = True
+    response, _ = await asyncio.gather(
+      self._run(self.llm_executor, self._stream_reply, turn, generation, ended, text, memory, context),
+      self._store_memory(memory, turn.timestamp),
+    )
+    self.logger.info(response)
+    return response
+
+
+  async def handle_turn(self, turn):
+    # a continuation replaces the interrupt context its interrupted turn's report adds, so it waits for that report
+    await self.collect_speech_reports(0 if turn.continuation else SPEECH_BACKLOG_TURNS)
+    set_active_trace(turn.trace)
+    latency_trace.mark("turn_received")
+    generation = self.interrupt_signal.generation
+    response = None
+
+    if turn.continuation:
+      if len(self.llm.interrupt_context) > 0:
+        self.llm.interrupt_context.pop()
+
+    loop = asyncio.get_running_loop()
+    # cancelling the task does not reach the executor threads, a turn abandoned after TURN_DEADLINE stops them with this
+    ended = threading.Event()
+    task = asyncio.create_task(self.run_turn(turn, generation, ended))
+    # a barge-in cancels the whole turn, whichever stage it is in
+    subscription = self.interrupt_signal.subscribe(lambda: loop.call_soon_threadsafe(task.cancel))
+    if self.interrupt_signal.is_set():
+      task.cancel()
+
+    try:
+      response = await asyncio.wait_for(task, TURN_DEADLINE)
+    except asyncio.CancelledError:
+      self.logger.warning("Pipeline Interrupted")
+      turn.interrupted = True
+    except asyncio.TimeoutError:
+      self.logger.error(f"Turn {turn.turn_id} abandoned after {TURN_DEADLINE}s")
+    except Exception as e:
+      # stages cut short by an interrupt can fail before the cancellation reaches them
+      if self.interrupt_signal.is_set():
+        turn.interrupted = True
+      else:
+        self.logger.error(f"Turn {turn.turn_id} failed: {e}")
+    finally:
+      self.interrupt_signal.unsubscribe(subscription)
+      # a speculative reply still waiting for the classifier is dropped with the turn
+      if self.speculation is not None:
+        self.speculation.discard()
+        self.speculation = None
+      # the speech worker finishes every turn and consumes its interrupt, the pipeline only flags the turn
+      set_active_trace(None)
+      with self.speech_lock:
+        ended.set()
+        self.speech_queue.put(SpeechMessage(SpeechMessage.END, turn.turn_id, generation, response or "", turn=turn))
+      self.unreported_turns += 1
+
+
+  async def run(self, command_queue: QueueClass):
+    while True:
+      # blocks until the voice worker hands over a turn, no CPU is used while idle
+      turn = await self._run(self.queue_executor, command_queue.get)
+      if turn is None:
+        break
+      self.logger.debug(turn)
+      await self.handle_turn(turn)
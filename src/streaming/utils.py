@@ -4,8 +4,8 @@ import array
 import threading
 from pvspeaker import PvSpeaker
 from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
-from multiprocessing.synchronize import Lock as LockClass
 from multiprocessing.queues import Queue as QueueClass
+from src.streaming.interrupt_signal import InterruptSignal
 from typing import Union
 from config import *
 
@@ -39,11 +39,57 @@ def save_wav_file(wav_bytes, text, wav_filename, logger):
   logger.debug(f"Audio successfully saved to {wav_filename}")
 
 
-def is_queue_empty(lock: LockClass, queue: QueueClass):
-  empty = False
+def save_pcm_wav_file(pcm, sample_rate, text, wav_filename, logger):
+  """Archives mono int16 pcm, the only place a recorded command is encoded as wav."""
+  with wave.open(wav_filename, 'wb') as out_wav:
+    out_wav.setnchannels(1)
+    out_wav.setsampwidth(2)
+    out_wav.setframerate(sample_rate)
+    out_wav.writeframes(pcm.tobytes())
+
+  with open(wav_filename.replace(".wav", ".txt"), "w") as txt_file:
+    txt_file.write(text.replace("\n", " "))
+
+  logger.debug(f"Audio successfully saved to {wav_filename}")
+
+
+def is_pipeline_busy(active_turn: SynchronizedClass, queue: QueueClass):
+  """Pipeline is busy when it is working on a turn or a turn is waiting to be picked up."""
+  return active_turn.value != 0 or not queue.empty()
+
+
+def fire_interrupt_if_busy(active_turn: SynchronizedClass, queue: QueueClass, interrupt_signal: InterruptSignal):
+  """Fires the interrupt signal only if there is a turn to interrupt. Returns True if the interrupt was fired."""
+  # hold the active turn lock so the pipeline cannot finish the turn between the check and the fire
+  with active_turn.get_lock():
+    if not is_pipeline_busy(active_turn, queue):
+      return False
+
+    interrupt_signal.fire()
+
+  return True
+
+
+def iter_text_segments(text):
+  """Yields text segments to synthesize, accepts either a full string or an iterator of sentences."""
+  if isinstance(text, str):
+    yield text
+    return
+
+  for segment in text:
+    if segment:
+      yield segment
+
 
-  lock.acquire()
-  empty = queue.empty()
-  lock.release()
+def cancel_completion_stream(stream, tokens_read, logger, source):
+  """
+  Closes an OpenAI completion stream before it is finished. Closing the response aborts the HTTP connection,
+  which tells the inference server to stop generating. Returns the number of streamed tokens that were discarded.
+  """
+  try:
+    stream.close()
+  except Exception as e:
+    logger.error(f"Failed to close {source} stream: {e}")
 
-  return empty
+  logger.warning(f"{source} stream cancelled, {tokens_read} tokens wasted")
+  return tokens_read
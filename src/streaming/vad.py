@@ -0,0 +1,142 @@
+import logging
+import os
+import numpy as np
+from config import *
+
+
+class VAD:
+  """
+  Frame level voice activity detector. process() takes `frame_length` int16 samples at `sample_rate` and returns
+  the probability that the frame is speech, compared against VOICE_PROBABILITY by the callers.
+  """
+
+  sample_rate = 16000
+  frame_length = 512
+
+  def process(self, pcm):
+    raise NotImplementedError
+
+  def reset(self):
+    """Forgets any state carried between frames, call before an unrelated stream."""
+    pass
+
+  def delete(self):
+    pass
+
+
+class CobraVAD(VAD):
+  """Picovoice Cobra, needs PICOVOICE_API_KEY."""
+
+  def __init__(self):
+    import pvcobra
+    self.logger = logging.getLogger("speech_to_speech.vad_cobra")
+    self.cobra = pvcobra.create(access_key=os.getenv("PICOVOICE_API_KEY"))
+    self.sample_rate = self.cobra.sample_rate
+    self.frame_length = self.cobra.frame_length
+
+  def process(self, pcm):
+    return self.cobra.process(pcm)
+
+  def delete(self):
+    self.cobra.delete()
+
+
+class SileroVAD(VAD):
+  """Silero VAD v5 ONNX model on onnxruntime's CPU provider, see SILERO_VAD_MODEL."""
+
+  CONTEXT_SIZE = 64 # samples of the previous frame the model expects in front of each 512 sample frame
+
+  def __init__(self, model_path=SILERO_VAD_MODEL):
+    import onnxruntime
+    self.logger = logging.getLogger("speech_to_speech.vad_silero")
+    if not os.path.isabs(model_path):
+      project_root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+      model_path = os.path.join(project_root_dir, model_path)
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = 1
+    options.inter_op_num_threads = 1
+    self.session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+    self.sample_rate_input = np.array(self.sample_rate, dtype=np.int64)
+    self.reset()
+
+  def reset(self):
+    self.state = np.zeros((2, 1, 128), dtype=np.float32)
+    self.context = np.zeros((1, self.CONTEXT_SIZE), dtype=np.float32)
+
+  def process(self, pcm):
+    audio = (np.asarray(pcm, dtype=np.float32) / 32768).reshape(1, -1)
+    audio = np.concatenate((self.context, audio), axis=1)
+    output, self.state = self.session.run(None, {"input": audio, "state": self.state, "sr": self.sample_rate_input})
+    self.context = audio[:, -self.CONTEXT_SIZE:]
+    return float(output[0][0])
+
+
+class EnergyVAD(VAD):
+  """
+  NumPy only detector: a frame is speech when its RMS clears both VAD_ENERGY_THRESHOLD and VAD_ENERGY_MARGIN
+  times the tracked noise floor, and its zero crossing rate is below VAD_ZCR_MAX (broadband hiss crosses zero
+  far more often than voice). Cheapest backend and needs no model or API key.
+  """
+
+  NOISE_FLOOR_RATE = 0.05 # how fast the noise floor follows non speech frames
+
+  def __init__(self, energy_threshold=VAD_ENERGY_THRESHOLD, energy_margin=VAD_ENERGY_MARGIN, zcr_max=VAD_ZCR_MAX):
+    self.energy_threshold = energy_threshold
+    self.energy_margin = energy_margin
+    self.zcr_max = zcr_max
+    self.reset()
+
+  def reset(self):
+    # until some non speech has been heard only the absolute threshold applies
+    self.noise_floor = self.energy_threshold / self.energy_margin
+
+  def process(self, pcm):
+    samples = np.asarray(pcm, dtype=np.int16)
+    audio = samples.astype(np.float32)
+    rms = float(np.sqrt(np.dot(audio, audio) / audio.size))
+    zcr = np.count_nonzero(np.signbit(samples[1:]) != np.signbit(samples[:-1])) / (samples.size - 1)
+
+    voiced = rms > self.energy_threshold and rms > self.energy_margin * self.noise_floor and zcr < self.zcr_max
+    if not voiced:
+      self.noise_floor += self.NOISE_FLOOR_RATE * (rms - self.noise_floor)
+
+    return 1.0 if voiced else 0.0
+
+
+def speech_spans(voiced, frame_length, pad_frames, merge_frames=0):
+  """
+  Sample ranges (start, end) covering the voiced frames, each widened by pad_frames on both sides. Spans
+  separated by merge_frames or fewer frames of silence are joined.
+  """
+  voiced = np.asarray(voiced, dtype=bool)
+  if not voiced.any():
+    return []
+
+  # run boundaries: index where voice starts and index just after it stops
+  edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+  starts = np.flatnonzero(edges == 1)
+  ends = np.flatnonzero(edges == -1)
+
+  spans = []
+  for start, end in zip(starts, ends):
+    start = max(0, start - pad_frames)
+    end = min(voiced.size, end + pad_frames)
+    if spans and start - spans[-1][1] <= merge_frames:
+      spans[-1][1] = end
+    else:
+      spans.append([start, end])
+
+  return [(int(start) * frame_length, int(end) * frame_length) for start, end in spans]
+
+
+def create_vad(choice=VAD_CHOICE):
+  """Creates the detector selected by VAD_CHOICE. Backends import their runtime here so unused ones are not required."""
+  if choice == "cobra":
+    return CobraVAD()
+  elif choice == "silero":
+    return SileroVAD()
+  elif choice == "energy":
+    return EnergyVAD()
+
+  raise ValueError(f"Unknown VAD_CHOICE: {choice}")
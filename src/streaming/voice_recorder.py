@@ -1,81 +1,70 @@
 import pvporcupine
 from pvrecorder import PvRecorder
 from pvspeaker import PvSpeaker
-import pvcobra
 import numpy as np
-import wave
-import io
-import struct
 import logging
 import os
+import time
 from config import *
 from multiprocessing import Event
 from multiprocessing.synchronize import Event as EventClass
-from src.streaming.utils import is_queue_empty
+from src.streaming.utils import fire_interrupt_if_busy
+from src.streaming import latency_trace
+from src.streaming.replay_io import is_replay, WavFrameSource
+from src.streaming.pcm_buffer import PcmRingBuffer, PcmAccumulator
+from src.streaming.audio_capture import AudioCapture
+from src.streaming.vad import VAD, create_vad, speech_spans
+from src.streaming.endpointer import Endpointer
 
 
 class AudioBuffer:
-  def __init__(self, recorder, cobra, framelength, buffer_signal: EventClass):
-    self.cobra = cobra
-    self.recorder = recorder
+  def __init__(self, capture: AudioCapture, vad: VAD, framelength, buffer_signal: EventClass):
+    self.vad = vad
+    self.capture = capture
     self.buffer_signal = buffer_signal
     self.logger = logging.getLogger("speech_to_speech.voice_recording_buffer")
 
     self.framelength = framelength
-    self.frame_duration = self.framelength / self.recorder.sample_rate
+    self.frame_duration = self.framelength / self.capture.sample_rate
     self.buffer_size = int(AUDIO_BUFFER_DURATION / self.frame_duration)
-    
-    self.pcm_buffer = [None] * self.buffer_size
-    self.pos = 0
+
+    self.pcm_buffer = PcmRingBuffer(self.buffer_size * self.framelength)
+    self.voiced = PcmRingBuffer(self.buffer_size, dtype=np.bool_) # VAD decision of every buffered frame
     self.voice_frames = 0
-    self.full = False 
+    self.end_position = None # capture position the last fill stopped at, the command continues from there
 
 
   def get_buffer(self):
-    buffer = self.pcm_buffer[:self.pos]
-    if self.full:
-      buffer = self.pcm_buffer[self.pos:] + self.pcm_buffer[:self.pos]
-
-    return buffer, self.voice_frames
+    """Returns (buffered int16 pcm oldest first, voiced flag per frame, voiced frame count). Both arrays are views into the rings."""
+    return self.pcm_buffer.view(), self.voiced.view(), self.voice_frames
 
 
   def clear_buffer(self):
-    self.pcm_buffer = [None] * self.buffer_size
-    self.pos = 0
+    self.pcm_buffer.clear()
+    self.voiced.clear()
     self.voice_frames = 0
-    self.full = False
+    self.end_position = None
 
 
-  def fill_buffer(self):
+  def fill_buffer(self, start_position=None):
     silence_threshold_sec = SILENCE_THRESHOLD # Change to 0.5 if you prefer
     silence_frames_required = int(silence_threshold_sec / self.frame_duration)
     silence_frame_count = 0
     voice_frame_count = 0
     total_frame_count = 0
+    cursor = self.capture.cursor(start_position)
 
     try:
       # self.logger.warning("Starting Buffer Recording")
-      self.recorder.start()
-
       while self.buffer_signal.is_set():
-        frame = None
-        try:
-          frame = self.recorder.read()
-        except Exception as e:
-          continue
-        pcm = np.array(frame, dtype=np.int16)
+        pcm = cursor.read()
         total_frame_count += pcm.size
-        
-        self.pcm_buffer[self.pos] = frame
-        self.pos = (self.pos + 1) % self.buffer_size
-        # if we go in circle, set full to be true
-        if self.pos == 0:
-          self.full = True
 
-        voice_prob = self.cobra.process(pcm)
+        voice_prob = self.vad.process(pcm)
         # print(voice_prob)
 
-        if voice_prob <= VOICE_PROBABILITY:
+        is_voiced = voice_prob > VOICE_PROBABILITY
+        if not is_voiced:
           silence_frame_count += 1
         else:
           voice_frame_count += 1
@@ -83,17 +72,15 @@ class AudioBuffer:
 
         # print(silence_frame_count)
 
-        if silence_frame_count >= silence_frames_required:
-          self.pos = (self.pos - 1) % self.buffer_size
-          # reset full flag
-          if self.pos == self.buffer_size - 1:
-            self.full = False
-          self.pcm_buffer[self.pos] = None
+        # once the silence threshold is reached further silence is not buffered
+        if silence_frame_count < silence_frames_required:
+          self.pcm_buffer.append(pcm)
+          self.voiced.append(is_voiced)
 
     finally:
       self.voice_frames = voice_frame_count
+      self.end_position = cursor.position
       # self.logger.warning("Stopping Buffer Recording")
-      self.recorder.stop()
 
 
 class Recorder:
@@ -104,101 +91,123 @@ class Recorder:
       keywords=[WAKE_KEYWORD]
     )
 
-    self.cobra = pvcobra.create(
-      access_key=os.getenv("PICOVOICE_API_KEY"),
-    )
+    self.vad = create_vad()
   
     self.framelength =  self.porcupine.frame_length
     self.recorder_device = AUDIO_IN_DEVICE
-    self.recorder = PvRecorder(frame_length=self.framelength, device_index=self.recorder_device)
-    self.audio_buffer = AudioBuffer(self.recorder, self.cobra, self.framelength, buffer_signal)
+    if is_replay():
+      # replay.py feeds recorded commands instead of the microphone
+      self.recorder = WavFrameSource(frame_length=self.framelength)
+    else:
+      self.recorder = PvRecorder(frame_length=self.framelength, device_index=self.recorder_device)
+
+    # the device runs for the lifetime of the recorder, wake word, command and buffer read from their own cursors
+    self.capture = AudioCapture(self.recorder, int(CAPTURE_HISTORY_DURATION * self.recorder.sample_rate / self.framelength))
+    self.capture.start()
+    self.cursor = self.capture.cursor()
+    self.wake_word_preroll_frames = int(WAKE_WORD_PREROLL_DURATION * self.recorder.sample_rate / self.framelength)
+    self.audio_buffer = AudioBuffer(self.capture, self.vad, self.framelength, buffer_signal)
 
 
   def get_audio_buffer_instance(self):
     return self.audio_buffer
   
 
-  def record_wake_word(self):
-    try:
-      self.recorder.start()
+  def command_end_position(self):
+    """Capture position right after the last recorded command, where buffering for the next one starts."""
+    return self.cursor.position
 
-      while True:
-        frame = self.recorder.read()
-        pcm = np.array(frame, dtype=np.int16)
-        keyword_index = self.porcupine.process(pcm)
-        if keyword_index >= 0:
-          self.logger.debug("Wake word detected!")
-          break   
-    finally:
-      self.recorder.stop()      
-    
-  def record_command(self, ask_wakeword=None, command_queue=None, command_queue_lock=None, interrupt_count=None):
-    wav_buffer = io.BytesIO()
-    wav_file = wave.open(wav_buffer, 'wb')
-    wav_file.setparams((1, 2, self.recorder.sample_rate, self.recorder.frame_length, "NONE", "NONE"))
+
+  def record_wake_word(self):
+    # only listen to what is said from now on, the command then continues from the frame after the keyword
+    self.cursor.seek_live()
+    while True:
+      pcm = self.cursor.read()
+      keyword_index = self.porcupine.process(pcm)
+      if keyword_index >= 0:
+        self.logger.debug("Wake word detected!")
+        break
+
+    # Porcupine fires a little after the keyword ends, step back so a command said in the same breath keeps its first syllables
+    self.cursor.seek(self.cursor.position - self.wake_word_preroll_frames)
+
+
+  def record_command(self, ask_wakeword=None, command_queue=None, active_turn=None, interrupt_signal=None, transcriber=None):
+    """
+    Returns the command as contiguous 16 kHz int16 pcm, its duration in seconds and the (start, end) sample
+    ranges the VAD heard speech in, padded by STT_SPEECH_PAD, so STT can skip the silence.
+    An IncrementalTranscriber is fed every frame so it can transcribe while the command is spoken.
+    """
+    # room for a full pre-roll buffer plus as much speech again before the first resize
+    command_pcm = PcmAccumulator(int(2 * AUDIO_BUFFER_DURATION * self.recorder.sample_rate))
+    voiced_frames = []
 
     frame_duration = self.framelength / self.recorder.sample_rate  # Typically 512 / 16000 = 0.032s
-    silence_threshold_sec = SILENCE_THRESHOLD # Change to 0.5 if you prefer
     voice_interrupt_threshold_sec = VOICE_THRESHOLD # seconds of total voice required to consider as interrupt
-    silence_frames_required = int(silence_threshold_sec / frame_duration)
-    # print(silence_frames_required)
-    silence_frame_count = 0
+    endpointer = Endpointer(frame_duration)
     voice_interrupt_frames_required = int(voice_interrupt_threshold_sec / frame_duration)
     voice_frame_count = 0
     interrupt_fired = False
     total_frame_count = 0
+    last_voice_time = None
 
     try:
-      # write audio buffer contents to file
-      frames, voice_frame_count = self.audio_buffer.get_buffer()
-      for frame in frames:
-        wav_file.writeframes(struct.pack("h" * len(frame), *frame))
-      total_frame_count = len(frames)
-
-      self.recorder.start()
+      # start the command with the audio buffered while the previous command was transcribed
+      buffered_pcm, buffered_voiced, voice_frame_count = self.audio_buffer.get_buffer()
+      command_pcm.append(buffered_pcm)
+      voiced_frames.extend(buffered_voiced.tolist())
+      endpointer.prime(buffered_voiced)
+      if transcriber:
+        transcriber.feed(command_pcm.view(), voiced_frames)
+      total_frame_count = buffered_pcm.size
+      if self.audio_buffer.end_position is not None:
+        # continue exactly where the buffer stopped so no frame is skipped or read twice
+        self.cursor.seek(self.audio_buffer.end_position)
+      self.audio_buffer.clear_buffer()
 
       while True:
-        frame = None
-        try:
-          frame = self.recorder.read()
-        except Exception as e:
-          continue
-        pcm = np.array(frame, dtype=np.int16)
+        pcm = self.cursor.read()
         total_frame_count += pcm.size
+        command_pcm.append(pcm)
 
-        wav_file.writeframes(struct.pack("h" * len(frame), *frame))
-
-        voice_prob = self.cobra.process(pcm)
+        voice_prob = self.vad.process(pcm)
         # print(voice_prob)
 
-        if voice_prob <= VOICE_PROBABILITY:
-          silence_frame_count += 1
-        else:
+        is_voiced = voice_prob > VOICE_PROBABILITY
+        voiced_frames.append(is_voiced)
+        if is_voiced:
           voice_frame_count += 1
-          silence_frame_count = 0
+          last_voice_time = time.monotonic()
 
-        # print(silence_frame_count)
+        if transcriber:
+          transcriber.feed(command_pcm.view(), voiced_frames)
+          # a partial transcript ending mid sentence keeps the endpointer waiting
+          if not is_voiced:
+            endpointer.hint_transcript(transcriber.partial_text())
 
-        if silence_frame_count >= silence_frames_required:
-          self.logger.debug("Silence detected, stopping recording")
+        if endpointer.update(voice_prob):
+          self.logger.debug(f"Silence detected after {endpointer.silence_time:.2f}s, stopping recording")
           break
 
         if voice_frame_count >= voice_interrupt_frames_required:
-          if ask_wakeword != None and command_queue and interrupt_count:
+          if ask_wakeword != None and command_queue and interrupt_signal:
             # Ensure only 1 interrupt is fired
-            if not ask_wakeword and not is_queue_empty(command_queue_lock, command_queue) and not interrupt_fired:
+            if not ask_wakeword and not interrupt_fired and fire_interrupt_if_busy(active_turn, command_queue, interrupt_signal):
               self.logger.warning("interrupt fired")
               interrupt_fired = True
-              interrupt_count.value += 1
 
     finally:
-      self.recorder.stop()
-      wav_file.close()
       interrupt_fired = False
 
+    if last_voice_time is not None:
+      latency_trace.mark_at("last_voice", last_voice_time)
+    latency_trace.mark("end_of_speech")
+
     duration_sec = total_frame_count / self.recorder.sample_rate
-    
-    return wav_buffer, duration_sec
+    pad_frames = int(STT_SPEECH_PAD / frame_duration)
+    spans = speech_spans(voiced_frames, self.framelength, pad_frames, merge_frames=2 * pad_frames)
+
+    return command_pcm.view(), duration_sec, spans
       
       
       
@@ -10,21 +10,27 @@ from urllib.robotparser import RobotFileParser
 import urllib.request
 from playwright.sync_api import sync_playwright, TimeoutError
 from bs4 import BeautifulSoup
-from multiprocessing import Value
-from multiprocessing.sharedctypes import Synchronized as SynchronizedClass
+from src.streaming.interrupt_signal import InterruptSignal
 import pandas as pd
 from io import StringIO
 import requests
 import re
+from pathlib import Path
+from src.streaming.replay_io import WEB_FIXTURES_ENV
 
 class WebSearcher:
-  def __init__(self, interrupt_count : SynchronizedClass):
+  def __init__(self, interrupt_signal: InterruptSignal):
     self.logger = logging.getLogger("speech_to_speech.web_search")
-    self.interrupt_count = interrupt_count
+    self.interrupt_signal = interrupt_signal
 
     self.robot_parser = RobotFileParser()
-    self.playwright = sync_playwright().start()
-    self.browser = self.playwright.firefox.launch(headless=True)
+    # replay.py serves local html fixtures instead of searching the web
+    self.fixture_dir = os.getenv(WEB_FIXTURES_ENV)
+    self.playwright = None
+    self.browser = None
+    if not self.fixture_dir:
+      self.playwright = sync_playwright().start()
+      self.browser = self.playwright.firefox.launch(headless=True)
     self.timeout = 5000 # milliseconds
     self.website_scrape_limit = 3
         
@@ -155,6 +161,10 @@ class WebSearcher:
       self.logger.error(e)
       return None, None
 
+    return self._extract_text(html), []
+
+
+  def _extract_text(self, html):
     soup = BeautifulSoup(html, "html.parser")
     
     # Remove unwanted tags
@@ -177,7 +187,33 @@ class WebSearcher:
     text = soup.get_text(separator=" ")
     text = " ".join(text.split())  # Collapse multiple spaces
 
-    return text.replace("\n", ""), []
+    return text.replace("\n", "")
+
+
+  def _fetch_fixture_content(self, website):
+    with open(urllib.request.url2pathname(urlparse(website).path), "r", encoding="utf-8") as fixture_file:
+      html = fixture_file.read()
+
+    return self._extract_text(html), self.parse_tables(html, "wikitable")
+
+
+  def _fixture_search(self, request):
+    """Ranks the html fixtures by how many words of the request they contain."""
+    words = set(re.findall(r"\w+", request.lower()))
+    scored = []
+
+    for name in sorted(os.listdir(self.fixture_dir)):
+      if not name.lower().endswith((".html", ".htm")):
+        continue
+      path = os.path.abspath(os.path.join(self.fixture_dir, name))
+      with open(path, "r", encoding="utf-8") as fixture_file:
+        fixture_words = set(re.findall(r"\w+", fixture_file.read().lower()))
+      score = len(words & fixture_words)
+      if score > 0:
+        scored.append((score, Path(path).as_uri()))
+
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [url for _, url in scored[:10]]
 
 
   def fetch_content(self, websites):
@@ -185,12 +221,14 @@ class WebSearcher:
     website_data = []
 
     for website in websites:
-      if self.interrupt_count.value > 0:
+      if self.interrupt_signal.is_set():
         return None
 
       content = None
       tables = []
-      if "wikipedia.org" in website:
+      if website.startswith("file://"):
+        content, tables = self._fetch_fixture_content(website)
+      elif "wikipedia.org" in website:
         content, tables = self._fetch_wiki_content(website)
       elif "fandom.com" in website:
         content, tables = self._fetch_fandom_content(website)
@@ -215,6 +253,9 @@ class WebSearcher:
 
 
   def ddg_search(self, request):
+    if self.fixture_dir:
+      return self._fixture_search(request)
+
     retry_search = True
     results = None
 
@@ -240,7 +281,7 @@ class WebSearcher:
 if __name__ == "__main__":
   # for testing purposes
 
-  client = WebSearcher(Value("i", 0))
+  client = WebSearcher(InterruptSignal())
   content = client.fetch_content([])
 
   print(content)
\ No newline at end of file
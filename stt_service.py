@@ -0,0 +1,140 @@
+"""
+Shared Whisper service. Loads STT_SERVICE_WORKERS copies of Whisper once for every voice assistant on the
+machine instead of one per assistant, and decodes commands that arrive close together as one batch.
+Point the assistants at it with STT_SERVICE_ADDRESS = "127.0.0.1:8766" in config.py.
+
+  python stt_service.py --device cpu --workers 1
+
+Clients authenticate with STT_SERVICE_KEY, which must be set to listen on anything but a loopback address.
+Without it a loopback service creates a random key in STT_SERVICE_KEY_FILE for the clients on this machine.
+
+Queue depth, queue wait percentiles and the mean batch size are logged every STT_METRICS_INTERVAL seconds
+and returned by RemoteWhisper.metrics().
+"""
+from dotenv import load_dotenv
+import argparse
+import os
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, answer_challenge, deliver_challenge
+import warnings
+warnings.filterwarnings("ignore")
+
+from src.streaming.logging_config import setup_logging, start_listener, stop_listener, get_log_queue
+from src.streaming.model_pool import ModelPool
+from src.streaming.stt_client import service_key
+from config import *
+
+os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
+
+# the methods clients may call on the STT pool
+SERVED_METHODS = {"transcribe_pcm", "transcribe_words"}
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Serve Whisper to the voice assistants on this machine")
+  parser.add_argument("--host", default="127.0.0.1", help="listen address, any but loopback needs STT_SERVICE_KEY")
+  parser.add_argument("--port", type=int, default=STT_SERVICE_PORT)
+  parser.add_argument("--workers", type=int, default=STT_SERVICE_WORKERS)
+  parser.add_argument("--device", default=DEVICE, help="'cuda' or 'cpu' for the Whisper workers")
+  return parser.parse_args()
+
+
+class HandshakeConnection:
+  """Gives up on a client that stops answering during the key handshake instead of waiting for it forever."""
+
+  def __init__(self, connection, timeout):
+    self.connection = connection
+    self.timeout = timeout
+
+  def send_bytes(self, data):
+    self.connection.send_bytes(data)
+
+  def recv_bytes(self, maxlength=None):
+    if not self.connection.poll(self.timeout):
+      raise AuthenticationError(f"no handshake reply within {self.timeout}s")
+    return self.connection.recv_bytes(maxlength)
+
+
+def serve_connection(connection, address, authkey, pool, logger):
+  """Runs on the connection's own thread, so a slow handshake only holds up its own client."""
+  with connection:
+    try:
+      handshake = HandshakeConnection(connection, STT_SERVICE_HANDSHAKE_TIMEOUT)
+      deliver_challenge(handshake, authkey)
+      answer_challenge(handshake, authkey)
+    except (AuthenticationError, EOFError, OSError) as e:
+      # a client with the wrong key, keep serving the others
+      logger.warning(f"Rejected connection from {address}: {e}")
+      return
+    logger.debug(f"Client connected from {address}")
+
+    while True:
+      try:
+        method, args = connection.recv()
+      except (EOFError, OSError):
+        break
+
+      if method == "metrics":
+        connection.send((pool.metrics(), None))
+      elif method not in SERVED_METHODS:
+        connection.send((None, f"unknown method {method}"))
+      else:
+        try:
+          connection.send((pool.call(method, *args), None))
+        except Exception as e:
+          connection.send((None, str(e)))
+  logger.debug("Client disconnected")
+
+
+def log_metrics(pool, logger, stop_event):
+  while not stop_event.wait(STT_METRICS_INTERVAL):
+    metrics = pool.metrics()
+    if metrics["wait_p50_ms"] is None:
+      continue
+    logger.info(
+      f"queue depth {metrics['queue_depth']}, wait p50 {metrics['wait_p50_ms']:.0f} ms p95 {metrics['wait_p95_ms']:.0f} ms, "
+      f"mean batch {metrics['mean_batch']:.2f}, {metrics['completed']} requests")
+
+
+def main():
+  args = parse_args()
+
+  start_listener()
+  logger = setup_logging()
+  try:
+    authkey = service_key(args.host, create=True)
+  except RuntimeError as e:
+    logger.error(e)
+    stop_listener()
+    return
+
+  pool = ModelPool("stt", args.workers, get_log_queue(), device=args.device)
+  stop_event = threading.Event()
+
+  try:
+    pool.start()
+    threading.Thread(target=log_metrics, args=(pool, logger, stop_event), daemon=True).start()
+
+    # no authkey on the listener, its accept() would run the handshake on this thread and one slow client
+    # would keep every other voice worker from connecting. serve_connection authenticates instead.
+    with Listener((args.host, args.port)) as listener:
+      logger.info(f"STT service listening on {args.host}:{args.port}")
+      while True:
+        try:
+          connection = listener.accept()
+        except OSError as e:
+          logger.warning(f"Accepting a connection failed: {e}")
+          continue
+        threading.Thread(target=serve_connection, args=(connection, listener.last_accepted, authkey, pool, logger), daemon=True).start()
+  except KeyboardInterrupt:
+    logger.info("Shutting down")
+  finally:
+    stop_event.set()
+    pool.stop()
+    stop_listener()
+
+
+if __name__ == "__main__":
+  load_dotenv()
+  main()